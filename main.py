@@ -1,17 +1,18 @@
 import os
+import subprocess
 import sys
 import time
 
 from dotenv import load_dotenv
 
-from src.database import add_to_database, cleanup_cache
+from src.database import add_to_database, cleanup_cache, get_newsletter, store_articles
 from src.gmail import get_raw_mail_text, parse_emails_to_dict
 from justdays import Day
 
-from src.ai import generate_ai_summary, edit_articles, generate_ai_image, generate_infographic, select_articles_for_visuals
+from src.ai import generate_ai_summary, edit_articles, generate_ai_image, generate_infographic, select_articles_for_visuals, image_urls
 from src.formatter import create_html_email
 from justlog import lg, setup_logging
-from src.mailer import send_newsletter, already_sent_today
+from src.mailer import send_newsletter, already_sent_today, interrupted_today
 from src.undelivered import handle_undelivered
 
 VERBOSE = True
@@ -39,6 +40,12 @@ def parse_command_line():
     sys.exit(1)
 
 
+def option(name: str) -> str:
+    """Value of --name=value on the command line, or ''."""
+    prefix = f'--{name}='
+    return next((arg[len(prefix):] for arg in sys.argv[1:] if arg.startswith(prefix)), '')
+
+
 def print_usage():
     print("Usage: python main.py <command> [--cached]")
     print("Commands:")
@@ -47,6 +54,8 @@ def print_usage():
     print("Options:")
     print("   --cached  - Use cached data when available")
     print("   --dry-run - Generate newsletter but don't send")
+    print("   --workers=N - Send with N worker processes, each with its own shard of the list")
+    print("   --shard=i/n - Worker: send today's stored newsletter to shard i of n")
 
 
 def create_title(schedule: str) -> str:
@@ -64,9 +73,17 @@ def main():
     lg.info("============ Starting application ============")
     cleanup_cache()
     schedule, cached, dry_run = parse_command_line()
+    workers = int(option('workers') or 1)
+
+    if shard := option('shard'):
+        send_shard(schedule, shard)
+        return
 
-    if already_sent_today(schedule) and not '--resend' in sys.argv:
-        lg.info(f"Newsletter '{schedule}' already sent today. Skipping.")
+    if already_sent_today(schedule, shared=workers > 1) and not '--resend' in sys.argv:
+        if interrupted_today(schedule, shared=workers > 1):
+            lg.warning(f"Newsletter '{schedule}' was only partly sent today. Run with --resend to send it to the rest.")
+        else:
+            lg.info(f"Newsletter '{schedule}' already sent today. Skipping.")
         return
 
     text = get_raw_mail_text(schedule, cached=cached, verbose=VERBOSE)
@@ -83,7 +100,7 @@ def main():
     visual_selection = select_articles_for_visuals(articles)
 
     # Image
-    article_index, image_url = generate_ai_image(articles, schedule, cached=cached, article_index=visual_selection['image_article'])
+    article_index, image_uploads = generate_ai_image(articles, schedule, cached=cached, article_index=visual_selection['image_article'])
     articles = [articles[article_index]] + articles[:article_index] + articles[article_index + 1:]
 
     # Adjust infographic index after reordering (image article moved to front)
@@ -102,19 +119,48 @@ def main():
     visual_selection['infographic_article'] = infographic_adjusted_index
 
     # Infographic
-    infographic_article_index, infographic_url = generate_infographic(articles, emails_dict, schedule, cached=cached, visual_selection=visual_selection)
+    infographic_article_index, infographic_uploads = generate_infographic(articles, emails_dict, schedule, cached=cached, visual_selection=visual_selection)
+
+    # Wait for the background S3 uploads of both visuals
+    image_url, image_srcset = image_urls(image_uploads)
+    infographic_url, infographic_srcset = image_urls(infographic_uploads)
 
     title = create_title(schedule)
-    html_mail = create_html_email(schedule, articles, title, image_url, infographic_url, infographic_article_index)
+    html_mail = create_html_email(schedule, articles, title, image_url, infographic_url, infographic_article_index,
+                                  image_srcset=image_srcset, infographic_srcset=infographic_srcset)
     add_to_database(schedule, title, html_mail, image_url)
+    store_articles(schedule, Day(), articles)
     if dry_run:
         lg.info('Dry run: newsletter generated but not sent')
         return
-    send_newsletter(schedule, html_mail, title)
+    if workers > 1:
+        send_with_workers(schedule, workers)
+    else:
+        send_newsletter(schedule, html_mail, title)
     time.sleep(60)
     handle_undelivered()
 
 
+def send_shard(schedule: str, shard: str):
+    """Worker mode: send today's newsletter, as stored by the main run, to one shard of the subscribers."""
+    newsletter = get_newsletter(schedule, Day())
+    if not newsletter:
+        lg.error(f"No '{schedule}' newsletter stored for today, nothing to send for shard {shard}")
+        sys.exit(1)
+    title, html_mail = newsletter
+    send_newsletter(schedule, html_mail, title, shard=shard)
+
+
+def send_with_workers(schedule: str, workers: int):
+    """Start one worker process per shard and wait for all of them. Workers on other hosts can
+    join by running main.py with the same --shard=i/n."""
+    processes = [subprocess.Popen([sys.executable, os.path.abspath(__file__), schedule, f'--shard={i}/{workers}'])
+                 for i in range(1, workers + 1)]
+    failed = [i for i, process in enumerate(processes, 1) if process.wait() != 0]
+    if failed:
+        lg.error(f"Send workers {failed} of {workers} failed, rerun them with --shard=i/{workers}")
+
+
 if __name__ == '__main__':
     os.chdir(os.path.dirname(os.path.abspath(__file__)))
     load_dotenv(override=True)
@@ -1,5 +1,6 @@
 import json
 import time
+from concurrent.futures import Future
 from pathlib import Path
 import os
 from typing import Tuple
@@ -11,13 +12,18 @@ from justdays import Day
 from pydantic import BaseModel, Field, HttpUrl
 from typing import Annotated
 
+from src import circuit
 from src.database import get_last_newsletter_summaries, cache_file_prefix
-from src.s3 import S3
+from src.hedge import hedged_call
+from src.images import optimize_image
+from src.scheduler import ScheduledModel, CRITICAL, NORMAL
+from src.s3 import upload_manager
 from justlog import lg
 
 COPY_WRITE_MODEL = 'claude-sonnet-4-6'
 COPY_WRITE_MODEL_NAME = 'Claude Sonnet 4.6'
 SELECTION_MODEL = 'gpt-5'
+SELECTION_MODEL_NAME = 'GPT-5'
 ART_MODEL = 'gpt-image-2-2026-04-21'
 ART_MODEL_NAME = 'GPT Image 2'
 INFOGRAPHIC_MODEL = 'gemini-3.1-flash-image-preview'
@@ -25,6 +31,27 @@ INFOGRAPHIC_MODEL_NAME = 'Nano Banana 2'
 EDITOR_MODEL = 'claude-opus-4-7'
 EDITOR_MODEL_NAME = 'Claude Opus 4.7'
 
+MODEL_NAMES = {
+    COPY_WRITE_MODEL: COPY_WRITE_MODEL_NAME,
+    SELECTION_MODEL: SELECTION_MODEL_NAME,
+    EDITOR_MODEL: EDITOR_MODEL_NAME,
+}
+
+# Per stage: primary model first, then the fallbacks in order of preference
+FALLBACK_MODELS = {
+    'copywrite': [COPY_WRITE_MODEL, SELECTION_MODEL],
+    'editor': [EDITOR_MODEL, COPY_WRITE_MODEL],
+    'selection': [SELECTION_MODEL, COPY_WRITE_MODEL],
+}
+ATTEMPTS_PER_MODEL = 5
+# Transport and overload errors: retried with backoff, and counted against the model's circuit
+TRANSIENT_ERRORS = (RatelimitException, ModelOverloadException, ConnectionException)
+# Other errors, such as an answer that is not valid JSON or fails validation: retried straight away
+ANSWER_ATTEMPTS_PER_MODEL = 3
+
+# Models that actually answered per stage in this run, used in the Colofon
+used_models: dict[str, list[str]] = {}
+
 PROMPTS_DIR = Path(__file__).parent / 'prompts'
 COLORS = ['rood', 'groen', 'grijs', 'bruin', 'oranje', 'paars', 'blauw']
 
@@ -34,6 +61,72 @@ def load_prompt(name: str, **kwargs) -> str:
     return text.format(**kwargs) if kwargs else text
 
 
+def scheduled_model(model_name: str, priority: int = NORMAL, stage: str = '', **kwargs) -> ScheduledModel:
+    """A justai Model whose calls are queued through the shared rate-limit scheduler."""
+    return ScheduledModel(Model(model_name, **kwargs), model_name, priority=priority, stage=stage,
+                          max_tokens=kwargs.get('max_tokens', 0))
+
+
+def used_model_name(stage: str) -> str:
+    """Display name of the model(s) that handled stage, or of its primary model if none ran."""
+    models = used_models.get(stage) or FALLBACK_MODELS[stage][:1]
+    return ' / '.join(MODEL_NAMES.get(m, m) for m in models)
+
+
+def prompt_with_fallback(stage: str, prompt: str, model_kwargs: dict | None = None, **prompt_kwargs):
+    """Prompt the models of a stage's fallback chain in order until one succeeds.
+    Models with an open circuit are skipped straight away, unless all of them are open."""
+    chain = FALLBACK_MODELS[stage]
+    available = [m for m in chain if not circuit.is_open(m)]
+    if not available:
+        lg.warning(f'All circuits for {stage} are open, trying them anyway')
+        available = chain
+
+    last_error = None
+    for model_name in available:
+        model = scheduled_model(model_name, priority=CRITICAL, stage=stage, **(model_kwargs or {}))
+        try:
+            result = retry_prompt(model, prompt, circuit_key=model_name, **prompt_kwargs)
+        except Exception as e:
+            last_error = e
+            lg.warning(f'{stage} with {model_name} failed: {e}. Trying next model...')
+            continue
+        if model_name not in used_models.setdefault(stage, []):
+            used_models[stage].append(model_name)
+        return result
+    raise last_error
+
+
+def retry_prompt(model, prompt, circuit_key: str | None = None, **prompt_kwargs):
+    """Prompt model, retrying TRANSIENT_ERRORS with exponential backoff (5, 10, 20, 40s).
+    With circuit_key those errors count as failures of that circuit and the retries stop as soon
+    as it opens. Other errors, such as a response that fails validation, are retried straight away
+    up to ANSWER_ATTEMPTS_PER_MODEL times and leave the circuit alone."""
+    transient = invalid = 0
+    while True:
+        try:
+            result = model.prompt(prompt, cached=False, **prompt_kwargs)
+        except TRANSIENT_ERRORS as e:
+            transient += 1
+            if circuit_key:
+                circuit.record(circuit_key, ok=False)
+            if transient == ATTEMPTS_PER_MODEL or (circuit_key and circuit.is_open(circuit_key)):
+                raise
+            wait = min(5 * 2 ** (transient - 1), 60)
+            lg.warning(f'{type(e).__name__}: {e}. Retrying in {wait}s '
+                       f'(attempt {transient}/{ATTEMPTS_PER_MODEL})...')
+            time.sleep(wait)
+            continue
+        except Exception as e:
+            invalid += 1
+            if invalid == ANSWER_ATTEMPTS_PER_MODEL:
+                raise
+            lg.warning(f'{type(e).__name__}: {e}. Retrying (attempt {invalid}/{ANSWER_ATTEMPTS_PER_MODEL})...')
+            continue
+        if circuit_key:
+            circuit.record(circuit_key, ok=True)
+        return result
+
 
 class Article(BaseModel):
     title: str = Field(
@@ -119,7 +212,6 @@ def generate_ai_summary(schedule: str, text: str, verbose=False, cached=True):
             return summary
 
     # Generate new summary
-    model = Model(COPY_WRITE_MODEL, max_tokens=5000)
     max_articles = 6 if schedule == 'daily' else 8
     latest_newsletters = get_last_newsletter_summaries(schedule, limit=5)
     prompt = load_prompt('copywrite',
@@ -127,17 +219,7 @@ def generate_ai_summary(schedule: str, text: str, verbose=False, cached=True):
                          latest_newsletters=latest_newsletters,
                          news_emails=text)
     lg.info('Generating summary...')
-
-    for attempt in range(5):
-        try:
-            result = model.prompt(prompt, response_format=Summary, cached=False)
-            break
-        except Exception as e:
-            wait_time = 5 * (2 ** attempt)
-            lg.warning(f'Summary generation attempt {attempt + 1}/5 failed: {e}. Retrying in {wait_time}s...')
-            time.sleep(wait_time)
-    else:
-        result = model.prompt(prompt, response_format=Summary, cached=False)
+    result = prompt_with_fallback('copywrite', prompt, model_kwargs={'max_tokens': 5000}, response_format=Summary)
 
     summary = Summary(**result) if isinstance(result, dict) else result
 
@@ -187,24 +269,16 @@ def edit_articles(schedule: str, articles: list[dict], cached: bool = True, verb
             return edited
 
     lg.info('Editing articles...')
-    model = Model(EDITOR_MODEL, max_tokens=2000)
     edited: list[dict] = []
     for idx, article in enumerate(articles):
         prompt = load_prompt('editor',
                              title=article.get('title', ''),
                              summary=article.get('summary', ''))
-        result = None
-        for attempt in range(5):
-            try:
-                result = model.prompt(prompt, response_format=EditedArticle, cached=False)
-                break
-            except Exception as e:
-                wait_time = 5 * (2 ** attempt)
-                lg.warning(f'Editor attempt {attempt + 1}/5 for article {idx} failed: {e}. '
-                           f'Retrying in {wait_time}s...')
-                time.sleep(wait_time)
-        if result is None:
-            raise RuntimeError(f'Editor failed for article {idx} after 5 attempts')
+        try:
+            result = prompt_with_fallback('editor', prompt, model_kwargs={'max_tokens': 2000},
+                                          response_format=EditedArticle)
+        except Exception as e:
+            raise RuntimeError(f'Editor failed for article {idx} with all models') from e
 
         ea = EditedArticle(**result) if isinstance(result, dict) else result
         edited.append({
@@ -219,8 +293,27 @@ def edit_articles(schedule: str, articles: list[dict], cached: bool = True, verb
     return edited
 
 
-def generate_ai_image(articles: list[dict], schedule: str, cached: bool, article_index: int, max_retries: int = 5) -> Tuple[int, str]:
-    """Genereer header image met gpt-image-2 in Art Deco stijl."""
+def upload_image(path: Path) -> list[tuple[Future, int]]:
+    """Optimaliseer een gegenereerde afbeelding naar 1x/2x varianten en start de upload naar S3
+    op de achtergrond, onder een content-hash key die altijd gecached mag worden.
+    Geeft per variant (future met de url, density) terug."""
+    manager = upload_manager('harmsen.nl')
+    return [(manager.submit_hashed(variant, 'nieuwsbrief/'), density)
+            for variant, density in optimize_image(path)]
+
+
+def image_urls(uploads: list[tuple[Future, int]]) -> Tuple[str | None, str]:
+    """Wacht op de uploads van upload_image. Geeft de url van de 1x variant en een srcset terug."""
+    if not uploads:
+        return None, ''
+    urls = [(future.result(), density) for future, density in uploads]
+    srcset = ', '.join(f'{url} {density}x' for url, density in urls) if len(urls) > 1 else ''
+    return urls[0][0], srcset
+
+
+def generate_ai_image(articles: list[dict], schedule: str, cached: bool, article_index: int, max_retries: int = 5, hedge: bool = True) -> Tuple[int, list[tuple[Future, int]]]:
+    """Genereer header image met gpt-image-2 in Art Deco stijl.
+    Met hedge=True wordt een tweede request gestart als het eerste trager is dan gebruikelijk."""
     out_path = Path(cache_file_prefix(schedule) + '.png')
 
     if cached and os.path.isfile(out_path):
@@ -239,13 +332,14 @@ def generate_ai_image(articles: list[dict], schedule: str, cached: bool, article
                              color=color)
 
         lg.info('Generating image...')
-        model = Model(ART_MODEL)
         for attempt in range(max_retries):
             try:
                 if attempt > 0:
                     lg.warning(f'Generating image (attempt {attempt + 1}/{max_retries})...')
 
-                img = model.generate_image(prompt, size=(550, 275))
+                img = hedged_call(ART_MODEL,
+                                  lambda: scheduled_model(ART_MODEL, stage='image').generate_image(prompt, size=(550, 275)),
+                                  hedge=hedge)
                 img.save(out_path, format='PNG')
                 lg.info('Image generated successfully')
                 break
@@ -264,20 +358,8 @@ def generate_ai_image(articles: list[dict], schedule: str, cached: bool, article
                 lg.error(f'Error generating image: {str(e)}. Retrying...')
                 time.sleep(min(30 * 2 ** attempt, 300))
 
-    # Upload to S3
-    s3 = S3('harmsen.nl')
-    s3_attempts = 5
-    for attempt in range(s3_attempts):
-        try:
-            url = s3.add(str(out_path), 'nieuwsbrief/' + out_path.name)
-            return article_index, url
-        except Exception as e:
-            wait_time = 5 * (2 ** attempt)
-            lg.error(f'S3 upload attempt {attempt + 1}/{s3_attempts} failed: '
-                     f'{type(e).__name__}: {e}. Retrying in {wait_time}s...')
-            if attempt < s3_attempts - 1:
-                time.sleep(wait_time)
-    raise TimeoutError(f'Failed to upload image to S3 after {s3_attempts} attempts')
+    # Upload to S3 in the background
+    return article_index, upload_image(out_path)
 
 
 def extract_relevant_source_text(article: dict, source_text: str) -> str:
@@ -287,11 +369,11 @@ def extract_relevant_source_text(article: dict, source_text: str) -> str:
                          summary=article.get('summary', ''),
                          source_text=source_text)
 
-    model = Model('claude-haiku-4-5')
+    model = scheduled_model('claude-haiku-4-5', stage='extract_source')
     return model.prompt(prompt, return_json=False, cached=False)
 
 
-def generate_infographic(articles: list[dict], emails_dict: dict[str, str], schedule: str, cached: bool, visual_selection: dict, max_retries: int = 5) -> Tuple[int | None, str | None]:
+def generate_infographic(articles: list[dict], emails_dict: dict[str, str], schedule: str, cached: bool, visual_selection: dict, max_retries: int = 5, hedge: bool = True) -> Tuple[int | None, list[tuple[Future, int]]]:
     out_path = Path(cache_file_prefix(schedule) + "_infographic.png")
 
     if cached and os.path.isfile(out_path):
@@ -319,7 +401,6 @@ def generate_infographic(articles: list[dict], emails_dict: dict[str, str], sche
 
     if not (cached and os.path.isfile(out_path)):
         lg.info("Generating infographic...")
-        model = Model(INFOGRAPHIC_MODEL)
         generated = False
         # Retry logic with exponential backoff
         for attempt in range(max_retries):
@@ -327,7 +408,9 @@ def generate_infographic(articles: list[dict], emails_dict: dict[str, str], sche
                 if attempt > 0:
                     lg.warning(f"Generating infographic (attempt {attempt + 1}/{max_retries})...")
 
-                img = model.generate_image(prompt)
+                img = hedged_call(INFOGRAPHIC_MODEL,
+                                  lambda: scheduled_model(INFOGRAPHIC_MODEL, stage='infographic').generate_image(prompt),
+                                  hedge=hedge)
                 if img is None:
                     raise ValueError('Image generation returned None')
                 img.save(out_path, format="PNG")
@@ -351,22 +434,10 @@ def generate_infographic(articles: list[dict], emails_dict: dict[str, str], sche
                 time.sleep(min(30 * 2 ** attempt, 300))
 
         if not generated:
-            return None, None
+            return None, []
 
-    # Upload to S3
-    s3 = S3("harmsen.nl")
-    s3_attempts = 5
-    for attempt in range(s3_attempts):
-        try:
-            url = s3.add(str(out_path), "nieuwsbrief/" + out_path.name)
-            return article_index, url
-        except Exception as e:
-            wait_time = 5 * (2 ** attempt)
-            lg.error(f'S3 infographic upload attempt {attempt + 1}/{s3_attempts} failed: '
-                     f'{type(e).__name__}: {e}. Retrying in {wait_time}s...')
-            if attempt < s3_attempts - 1:
-                time.sleep(wait_time)
-    raise TimeoutError(f"Failed to upload infographic to S3 after {s3_attempts} attempts")
+    # Upload to S3 in the background
+    return article_index, upload_image(out_path)
 
 
 def select_articles_for_visuals(articles: list[dict]) -> dict:
@@ -376,19 +447,4 @@ def select_articles_for_visuals(articles: list[dict]) -> dict:
                          articles=articles,
                          max_index=len(articles) - 1)
 
-    model = Model(SELECTION_MODEL)
-    return retry_prompt(model, prompt)
-
-
-def retry_prompt(model, prompt) -> dict:
-    attempts = 5
-    for attempt in range(attempts):
-        try:
-            return model.prompt(prompt, return_json=True, cached=False)
-        except (RatelimitException, ModelOverloadException, ConnectionException) as e:
-            if attempt == attempts - 1:
-                raise
-            wait = min(5 * 2 ** attempt, 60)
-            lg.warning(f'{type(e).__name__}: {e}. Retrying in {wait}s '
-                       f'(attempt {attempt + 1}/{attempts})...')
-            time.sleep(wait)
+    return prompt_with_fallback('selection', prompt, return_json=True)
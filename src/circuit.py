@@ -0,0 +1,73 @@
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+from justlog import lg
+
+"""
+Per-model circuit breaker, persisted across runs in data/circuits.json.
+
+A model's circuit opens when at least FAILURE_RATE of its calls in the last WINDOW seconds
+failed (with a minimum of MIN_CALLS calls). While open, callers should route to a fallback
+model immediately. After OPEN_SECONDS the circuit is half-open: the next call is allowed
+through as a probe, a success closes the circuit and a failure opens it again.
+"""
+
+STATE_FILE = Path(__file__).parent.parent / 'data' / 'circuits.json'
+WINDOW = 30 * 60
+MIN_CALLS = 3
+FAILURE_RATE = 0.5
+OPEN_SECONDS = 10 * 60
+
+_lock = threading.Lock()
+
+
+def _load() -> dict[str, dict]:
+    try:
+        with open(STATE_FILE, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def _save(state: dict[str, dict]) -> None:
+    """Write via a temporary file and os.replace, so a reader never sees a half-written file."""
+    STATE_FILE.parent.mkdir(parents=True, exist_ok=True)
+    tmp = STATE_FILE.with_name(f'{STATE_FILE.name}.{os.getpid()}.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp, STATE_FILE)
+
+
+def is_open(model: str) -> bool:
+    """True if calls to model should be skipped right now."""
+    opened_at = _load().get(model, {}).get('opened_at')
+    return opened_at is not None and time.time() - opened_at < OPEN_SECONDS
+
+
+def record(model: str, ok: bool) -> None:
+    """Record the outcome of a call to model and open or close its circuit accordingly."""
+    now = time.time()
+    with _lock:
+        state = _load()
+        entry = state.get(model, {'events': [], 'opened_at': None})
+        events = [e for e in entry['events'] if now - e[0] < WINDOW] + [[round(now), ok]]
+        opened_at = entry['opened_at']
+
+        if ok:
+            if opened_at is not None:
+                lg.info(f'Circuit for {model} closed again')
+                events = []
+            opened_at = None
+        else:
+            failures = sum(1 for _, success in events if not success)
+            half_open = opened_at is not None
+            if half_open or (len(events) >= MIN_CALLS and failures / len(events) >= FAILURE_RATE):
+                if not half_open or now - opened_at >= OPEN_SECONDS:
+                    lg.warning(f'Circuit for {model} opened: {failures}/{len(events)} recent calls failed')
+                opened_at = now
+
+        state[model] = {'events': events, 'opened_at': opened_at}
+        _save(state)
@@ -2,15 +2,22 @@ import json
 import os
 import re
 import sys
-from datetime import datetime, timezone, timedelta
+import threading
+from datetime import date, datetime, timedelta
 from pathlib import Path
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+from zoneinfo import ZoneInfo
 
-from sqlalchemy import create_engine, MetaData, text, select, desc, func, and_
+from sqlalchemy import create_engine, MetaData, Table, select, desc, and_, or_, func, literal_column
 from sqlalchemy.dialects.postgresql import insert as pg_insert
 from justdays import Day
 
 from justlog import lg
 
+from src import schema
+
+AMSTERDAM_TZ = ZoneInfo('Europe/Amsterdam')  # CET in winter, CEST in summer
+
 
 def normalize_db_url(db_url):
     """Ensure the database URL uses the postgresql:// scheme."""
@@ -19,33 +26,59 @@ def normalize_db_url(db_url):
     return db_url
 
 
-def db_connect():
-    """Connect to the PostgreSQL database and return the engine and podcast table."""
-    # Get and normalize the database URL
-    db_url = normalize_db_url(os.getenv("DATABASE_URL"))
-    assert db_url, "DATABASE_URL environment variable not set"
+# One engine per process with a connection pool; tables not declared in schema.py are reflected once
+_engine = None
+_metadata = MetaData()
+_lock = threading.Lock()
 
-    try:
-        engine = create_engine(db_url)
 
-        # Test the connection
-        with engine.connect() as conn:
-            conn.execute(text("SELECT 1"))
+def get_engine():
+    """The process-wide pooled engine for DATABASE_URL, created on first use."""
+    global _engine
+    with _lock:
+        if _engine is None:
+            db_url = normalize_db_url(os.getenv("DATABASE_URL"))
+            if not db_url:
+                raise ValueError("DATABASE_URL environment variable not set or invalid")
+            # pool_pre_ping replaces connections the server closed while they sat idle in the pool
+            _engine = create_engine(db_url, pool_pre_ping=True, pool_size=5, max_overflow=5)
+        return _engine
 
-        metadata = MetaData()
-        metadata.reflect(bind=engine)
 
-        # Get the podcast table
-        assert 'nieuwsbrief_newsletter' in metadata.tables, "Table 'nieuwsbrief_newsletter' not found in the database"
+def get_table(name: str) -> Table:
+    """Table name as declared in schema.py, or else reflected from the database on first use and
+    cached for the rest of the process."""
+    if name in schema.metadata.tables:
+        return schema.metadata.tables[name]
+    with _lock:
+        table = _metadata.tables.get(name)
+    if table is None:
+        engine = get_engine()
+        with _lock:
+            if name not in _metadata.tables:
+                _metadata.reflect(bind=engine, only=[name])
+            table = _metadata.tables[name]
+    return table
 
-        newsletter_table = metadata.tables['nieuwsbrief_newsletter']
-        return engine, newsletter_table
 
+def db_connect():
+    """Return the shared engine and the newsletter table."""
+    try:
+        return get_engine(), get_table('nieuwsbrief_newsletter')
     except Exception as e:
-        lg.error(f"Error connecting to the database: {e}\nDatabase URL: {db_url}")
+        lg.error(f"Error connecting to the database: {e}\nDatabase URL: {os.getenv('DATABASE_URL')}")
         sys.exit(1)
 
 
+def day_range(day, tz=AMSTERDAM_TZ) -> tuple[datetime, datetime]:
+    """Start of day and of the next day in tz, for `sent >= start AND sent < end`. Unlike
+    date(sent) = day, that condition can use the (schedule, sent) index. Both are local midnight,
+    so the days on which the clocks change are 23 and 25 hours long."""
+    following = day + timedelta(days=1)
+    return (datetime(day.year, day.month, day.day, tzinfo=tz),
+            datetime(following.year, following.month, following.day, tzinfo=tz))
+
+
 def add_to_database(schedule, title, newsletter_html, image_url):
     """
     Voeg een nieuwsbrief toe aan de database, waarbij er maar één per dag per schedule kan bestaan.
@@ -55,15 +88,16 @@ def add_to_database(schedule, title, newsletter_html, image_url):
     engine, table = db_connect()
     
     # Huidige tijd in Amsterdam tijdzone
-    amsterdam_tz = timezone(timedelta(hours=2))  # CEST (UTC+2)
-    now = datetime.now(amsterdam_tz)
+    now = datetime.now(AMSTERDAM_TZ)
+    start, end = day_range(now.date())
     
     with engine.begin() as conn:
         # Delete any existing newsletter with the same schedule on the same day
         delete_stmt = table.delete().where(
             and_(
                 table.c.schedule == schedule,
-                func.date(table.c.sent) == now.date()
+                table.c.sent >= start,
+                table.c.sent < end
             )
         )
         conn.execute(delete_stmt)
@@ -81,46 +115,146 @@ def add_to_database(schedule, title, newsletter_html, image_url):
     lg.info(f"✅ Nieuwsbrief toegevoegd aan de database (heeft eventuele bestaande voor {now.date()} vervangen).")
 
 
+def get_newsletter(schedule: str, day: Day) -> tuple[str, str] | None:
+    """Titel en HTML van de nieuwsbrief voor schedule op day, of None. Gebruikt door send workers (--shard)."""
+    engine, table = db_connect()
+    start, end = day_range(day.as_date())
+    with engine.connect() as conn:
+        row = conn.execute(
+            select(table.c.title, table.c.text)
+            .where(table.c.schedule == schedule, table.c.sent >= start, table.c.sent < end)
+            .order_by(desc(table.c.sent))
+            .limit(1)
+        ).fetchone()
+    return (row[0], row[1]) if row else None
+
+
 MONTHS_NL = ['januari', 'februari', 'maart', 'april', 'mei', 'juni',
              'juli', 'augustus', 'september', 'oktober', 'november', 'december']
 
 
-def get_last_newsletter_summaries(schedule: str, limit: int = 5) -> str:
-    """Lees de laatste N summary JSONL-bestanden uit de cache en formatteer voor dedupe."""
-    cache_dir = Path(__file__).parent.parent / 'cache'
-    suffix = '_summary.jsonl'
+def canonical_url(url: str) -> str:
+    """Link zoals opgeslagen in de artikelhistorie: scheme en host in kleine letters, zonder fragment,
+    utm_-parameters en afsluitende slash."""
+    parts = urlsplit(url.strip())
+    query = urlencode([(key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+                       if not key.lower().startswith('utm_')])
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path.rstrip('/'), query, ''))
 
-    if schedule == 'daily':
-        pattern = re.compile(r'^(\d{4}-\d{2}-\d{2})' + re.escape(suffix) + '$')
-    else:
-        pattern = re.compile(r'^(week\d+)' + re.escape(suffix) + '$')
 
-    # Vind en sorteer bestanden (nieuwste eerst)
-    matches = []
-    for f in cache_dir.iterdir():
-        m = pattern.match(f.name)
-        if m:
-            matches.append((m.group(1), f))
-    matches.sort(key=lambda x: x[0], reverse=True)
+def store_articles(schedule: str, day: Day, articles: list[dict]) -> None:
+    """Sla de artikelen van een nieuwsbrief op in de historie. Vervangt eerder opgeslagen artikelen
+    van dezelfde schedule en dag."""
+    articles_t, links_t = schema.article_table, schema.article_link_table
+    try:
+        engine = get_engine()
+        schema.metadata.create_all(engine, tables=schema.ARTICLE_TABLES, checkfirst=True)
+        with engine.begin() as conn:
+            existing = select(articles_t.c.id).where(articles_t.c.schedule == schedule,
+                                                     articles_t.c.day == day.as_date())
+            conn.execute(links_t.delete().where(links_t.c.article_id.in_(existing)))
+            conn.execute(articles_t.delete().where(articles_t.c.schedule == schedule,
+                                                   articles_t.c.day == day.as_date()))
+            for position, article in enumerate(articles):
+                article_id = conn.execute(articles_t.insert().values(
+                    schedule=schedule, day=day.as_date(), position=position,
+                    title=article['title'], summary=article['summary'])).inserted_primary_key[0]
+                urls = {canonical_url(str(link)) for link in article.get('links', [])}
+                if urls:
+                    conn.execute(links_t.insert(), [{'article_id': article_id, 'url': url} for url in sorted(urls)])
+        lg.info(f'{len(articles)} artikelen opgeslagen in de historie ({schedule} {day})')
+    except Exception as e:
+        lg.error(f'Kon artikelen niet opslaan in de historie: {e}')
 
-    # Skip vandaag (dat is de huidige run)
-    today_prefix = str(Day()) if schedule == 'daily' else f'week{Day().week_number()}'
-    matches = [(prefix, path) for prefix, path in matches if prefix != today_prefix]
 
-    parts = []
-    for prefix, path in matches[:limit]:
-        articles = [json.loads(line) for line in path.read_text().splitlines() if line.strip()]
-        if schedule == 'daily':
-            d = Day(prefix)
-            label = f'{d.d} {MONTHS_NL[d.m - 1]} {d.y}'
+def get_last_issues(schedule: str, limit: int = 5, before: Day | None = None) -> list[tuple[date, list[dict]]]:
+    """De laatste limit nummers van schedule vóór before (standaard vandaag), nieuwste eerst,
+    elk als (dag, [{'title', 'summary'}, ...])."""
+    t = schema.article_table
+    days = (select(t.c.day).where(t.c.schedule == schedule, t.c.day < (before or Day()).as_date())
+            .group_by(t.c.day).order_by(desc(t.c.day)).limit(limit).subquery())
+    query = (select(t.c.day, t.c.title, t.c.summary)
+             .where(t.c.schedule == schedule, t.c.day.in_(select(days.c.day)))
+             .order_by(desc(t.c.day), t.c.position))
+    issues = {}
+    with get_engine().connect() as conn:
+        for day, title, summary in conn.execute(query):
+            issues.setdefault(day, []).append({'title': title, 'summary': summary})
+    return list(issues.items())
+
+
+def has_appeared(url: str | None = None, topic: str | None = None, days: int = 90) -> bool:
+    """True als url, of een artikel over topic, in de laatste days dagen in een nieuwsbrief stond.
+    Zoekt topic met de full-text index op PostgreSQL, elders met LIKE."""
+    if not url and not topic:
+        raise ValueError('has_appeared needs a url or a topic')
+    articles_t, links_t = schema.article_table, schema.article_link_table
+    query = select(articles_t.c.id).where(articles_t.c.day >= (Day() - days).as_date()).limit(1)
+    if url:
+        query = query.join(links_t, links_t.c.article_id == articles_t.c.id).where(links_t.c.url == canonical_url(url))
+    engine = get_engine()
+    if topic:
+        if engine.dialect.name == 'postgresql':
+            tsquery = func.websearch_to_tsquery(literal_column("'dutch'::regconfig"), topic)
+            query = query.where(schema.article_search.bool_op('@@')(tsquery))
         else:
-            label = prefix
+            query = query.where(or_(articles_t.c.title.ilike(f'%{topic}%'), articles_t.c.summary.ilike(f'%{topic}%')))
+    with engine.connect() as conn:
+        return conn.execute(query).first() is not None
+
+
+def get_last_newsletter_summaries(schedule: str, limit: int = 5) -> str:
+    """Haal de laatste N nummers uit de artikelhistorie en formatteer voor dedupe."""
+    # Skip vandaag of deze week (dat is de huidige run)
+    before = Day() if schedule == 'daily' else Day().last_monday()
+    try:
+        issues = get_last_issues(schedule, limit, before)
+    except Exception as e:
+        lg.error(f'Kon de artikelhistorie niet lezen: {e}')
+        return ''
+
+    parts = []
+    for day, articles in issues:
+        d = Day(day)
+        label = f'{d.d} {MONTHS_NL[d.m - 1]} {d.y}' if schedule == 'daily' else f'week{d.week_number()}'
         lines = [f'- "{a["title"]}": {a["summary"][:150]}' for a in articles]
         parts.append(f'Nieuwsbrief {label}:\n' + '\n'.join(lines))
 
     return '\n\n'.join(parts)
 
 
+def backfill_articles(cache_dir: Path | None = None) -> int:
+    """Importeer de nummers uit cache/*_summary.jsonl (of de geredigeerde *_edited.jsonl) die nog niet
+    in de historie staan. Geeft het aantal geïmporteerde nummers."""
+    cache_dir = Path(cache_dir or Path(__file__).parent.parent / 'cache')
+    pattern = re.compile(r'^(\d{4}-\d{2}-\d{2}|week(\d+))_summary\.jsonl$')
+    t = schema.article_table
+    with get_engine().connect() as conn:
+        stored = set(conn.execute(select(t.c.schedule, t.c.day).distinct()).all())
+
+    imported = 0
+    for path in sorted(cache_dir.glob('*_summary.jsonl')):
+        m = pattern.match(path.name)
+        if not m:
+            continue
+        if m.group(2):
+            # Weeknummer zonder jaar: de laatste week met dat nummer, niet in de toekomst
+            schedule, year = 'weekly', Day().y
+            if date.fromisocalendar(year, int(m.group(2)), 1) > Day().as_date():
+                year -= 1
+            day = Day(date.fromisocalendar(year, int(m.group(2)), 1))
+        else:
+            schedule, day = 'daily', Day(m.group(1))
+        if (schedule, day.as_date()) in stored:
+            continue
+        edited = path.with_name(path.name.replace('_summary.jsonl', '_edited.jsonl'))
+        source = edited if edited.exists() else path
+        articles = [json.loads(line) for line in source.read_text(encoding='utf-8').splitlines() if line.strip()]
+        store_articles(schedule, day, articles)
+        imported += 1
+    return imported
+
+
 def cache_file_prefix(schedule: str) -> str:
     name =  str(Day()) if schedule == "daily" else f"week{Day().week_number()}"
     return str(Path(__file__).parent.parent / 'cache' / name)
@@ -0,0 +1,103 @@
+import random
+import socketserver
+import threading
+import time
+
+"""
+A local stand-in for the SMTP provider, for load tests and tests of the sending code.
+
+FakeSmtpServer speaks just enough SMTP for smtplib (EHLO/HELO, MAIL, RCPT, DATA, RSET, NOOP,
+QUIT) and accepts everything, except for the errors it is asked to inject: per message a
+latency before the DATA response, a 451 deferral, a 550 rejection or a dropped connection.
+It advertises neither STARTTLS nor AUTH, so smtp_login skips both.
+"""
+
+
+class _SmtpHandler(socketserver.StreamRequestHandler):
+    def reply(self, line: str) -> None:
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        self.reply('220 fakesmtp ESMTP ready')
+        while line := self.rfile.readline():
+            command = line.decode('ascii', 'replace').strip()
+            verb = command[:4].upper()
+            if verb == 'EHLO':
+                self.reply('250-fakesmtp')
+                self.reply('250-8BITMIME')
+                self.reply('250 SIZE 52428800')
+            elif verb == 'HELO':
+                self.reply('250 fakesmtp')
+            elif verb == 'MAIL':
+                if server.roll(server.drop_rate):
+                    return  # Drop the connection without a reply
+                self.reply('250 2.1.0 Ok')
+            elif verb == 'RCPT':
+                if server.roll(server.defer_rate):
+                    self.reply('451 4.7.1 Try again later')
+                elif server.roll(server.error_rate):
+                    self.reply('550 5.1.1 No such user')
+                else:
+                    self.reply('250 2.1.5 Ok')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                size = 0
+                while (data := self.rfile.readline()) not in (b'.\r\n', b''):
+                    size += len(data)
+                if server.latency:
+                    time.sleep(server.latency)
+                server.accepted(size)
+                self.reply(f'250 2.0.0 Ok: queued as {server.messages}')
+            elif verb in ('RSET', 'NOOP'):
+                self.reply('250 2.0.0 Ok')
+            elif verb == 'QUIT':
+                self.reply('221 2.0.0 Bye')
+                return
+            else:
+                self.reply('502 5.5.2 Command not implemented')
+
+
+class FakeSmtpServer(socketserver.ThreadingTCPServer):
+    """Threaded fake SMTP server. Rates are probabilities per message, latency is in seconds.
+
+    with FakeSmtpServer(latency=0.01, defer_rate=0.01) as server:
+        send to f'smtp://127.0.0.1:{server.port}'
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0.0, error_rate: float = 0.0,
+                 defer_rate: float = 0.0, drop_rate: float = 0.0, seed: int | None = None):
+        super().__init__((host, port), _SmtpHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.defer_rate = defer_rate
+        self.drop_rate = drop_rate
+        self.messages = 0
+        self.bytes = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def roll(self, rate: float) -> bool:
+        if not rate:
+            return False
+        with self._lock:
+            return self._random.random() < rate
+
+    def accepted(self, size: int) -> None:
+        with self._lock:
+            self.messages += 1
+            self.bytes += size
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, name='fakesmtp', daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
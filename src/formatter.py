@@ -1,18 +1,53 @@
 import html
+import re
 from datetime import date
 from pathlib import Path
 
 from src.ai import (
-    COPY_WRITE_MODEL_NAME,
-    EDITOR_MODEL_NAME,
     ART_MODEL_NAME,
     INFOGRAPHIC_MODEL_NAME,
+    used_model_name,
 )
 from src.database import cache_file_prefix
+from src.html_optimizer import optimize_html
 from justlog import lg
 
+# Per-recipient placeholders in the newsletter HTML and the render() keyword that fills them
+RECIPIENT_SLOTS = {'[EMAIL]': 'email'}
 
-def build_html_email(schedule: str, items: list[dict], newsletter_title: str, intro_text: str, image_url: str, infographic_url: str | None = None, infographic_article_index: int | None = None) -> str:
+
+class CompiledTemplate:
+    """Newsletter HTML split once into static segments around the per-recipient slots.
+    Rendering a recipient is then a single join instead of a scan-and-copy per placeholder."""
+
+    def __init__(self, segments: list[str], slots: list[str]):
+        assert len(segments) == len(slots) + 1
+        self.segments = segments
+        self.slots = slots
+        self._single_slot = slots[0] if slots and len(set(slots)) == 1 else None
+
+    @classmethod
+    def compile(cls, html_doc: str, slots: dict[str, str] = RECIPIENT_SLOTS) -> 'CompiledTemplate':
+        pattern = '(' + '|'.join(re.escape(placeholder) for placeholder in slots) + ')'
+        parts = re.split(pattern, html_doc)
+        return cls(parts[0::2], [slots[placeholder] for placeholder in parts[1::2]])
+
+    def render(self, **values: str) -> str:
+        if self._single_slot:
+            return values[self._single_slot].join(self.segments)
+        parts = [self.segments[0]]
+        for slot, segment in zip(self.slots, self.segments[1:]):
+            parts.append(values[slot])
+            parts.append(segment)
+        return ''.join(parts)
+
+
+def _srcset_attr(srcset: str) -> str:
+    # Retina-varianten voor clients die srcset ondersteunen; de rest valt terug op src (1x)
+    return f' srcset="{html.escape(srcset)}"' if srcset else ''
+
+
+def build_html_email(schedule: str, items: list[dict], newsletter_title: str, intro_text: str, image_url: str, infographic_url: str | None = None, infographic_article_index: int | None = None, image_srcset: str = '', infographic_srcset: str = '') -> str:
 
     schedule_naam = 'dagelijkse' if schedule == 'daily' else 'weekelijkse'
     switch_url = 'https://harmsen.nl/nieuwsbrief/'
@@ -24,6 +59,8 @@ def build_html_email(schedule: str, items: list[dict], newsletter_title: str, in
         switch_text = 'dagelijkse'
 
     today = date.today().strftime("%d %b %Y")
+    copy_write_model_name = used_model_name('copywrite')
+    editor_model_name = used_model_name('editor')
     # Kaarten opbouwen
     cards_html = []
     for idx, item in enumerate(items):
@@ -36,7 +73,7 @@ def build_html_email(schedule: str, items: list[dict], newsletter_title: str, in
         if infographic_url and infographic_article_index is not None and idx == infographic_article_index:
             infographic_html = f"""
             <!-- Infographic -->
-            <img src="{infographic_url}" alt="Infographic" style="width:100%; height:auto; display:block; border-radius:8px;" />
+            <img src="{infographic_url}"{_srcset_attr(infographic_srcset)} alt="Infographic" style="width:100%; height:auto; display:block; border-radius:8px;" />
             """
         # Linklijst
         links = item.get("links") or []
@@ -115,7 +152,7 @@ def build_html_email(schedule: str, items: list[dict], newsletter_title: str, in
                     <!-- Image -->
                     <tr>
                         <td style="padding:0 24px 16px 24px;">
-                            <img src="{image_url}" alt="" style="width:100%; max-width:552px; height:auto; display:block; border-radius:8px;" />
+                            <img src="{image_url}"{_srcset_attr(image_srcset)} alt="" style="width:100%; max-width:552px; height:auto; display:block; border-radius:8px;" />
                         </td>
                     </tr>
                     <tr><td style="height:10px;line-height:10px;font-size:0;">&nbsp;</td></tr>
@@ -132,11 +169,11 @@ def build_html_email(schedule: str, items: list[dict], newsletter_title: str, in
                         <td style="padding:14px 24px 20px 24px;border-top:1px solid #e6ecf3;background:#fbfcfe;border-radius:0 0 12px 12px;">
                             <p style="margin:0;font-family:Inter,Segoe UI,Arial,sans-serif;font-size:12px;color:#6b7280;">
                                 <b>Colofon</b><br>
-                                Nieuwsselectie: {COPY_WRITE_MODEL_NAME}<br>
-                                Teksten: {COPY_WRITE_MODEL_NAME}<br>
+                                Nieuwsselectie: {copy_write_model_name}<br>
+                                Teksten: {copy_write_model_name}<br>
                                 Header graphic art direction én design: {ART_MODEL_NAME}<br>
                                 Infographic: {INFOGRAPHIC_MODEL_NAME}<br>
-                                Eindredactie: {EDITOR_MODEL_NAME}<br>
+                                Eindredactie: {editor_model_name}<br>
                                 Aansturen van alle AI: HP<br><br> 
                                 Je ontvangt deze mail omdat je bent aangemeld voor de <b>{schedule_naam}</b> nieuwsbrief.
                             </p>
@@ -157,19 +194,45 @@ def build_html_email(schedule: str, items: list[dict], newsletter_title: str, in
     return html_doc
 
 
-def create_html_email(schedule: str, items: list, title: str, image_url: str, infographic_url: str | None = None, infographic_article_index: int | None = None):
+def create_html_email(schedule: str, items: list, title: str, image_url: str, infographic_url: str | None = None, infographic_article_index: int | None = None, image_srcset: str = '', infographic_srcset: str = ''):
     html_email = build_html_email(schedule,
         items,
         newsletter_title=title,
         intro_text="Actueel, concreet en to-the-point",
         image_url=image_url,
         infographic_url=infographic_url,
-        infographic_article_index=infographic_article_index
+        infographic_article_index=infographic_article_index,
+        image_srcset=image_srcset,
+        infographic_srcset=infographic_srcset
     )
+    html_email = optimize_html(html_email)
     # Schrijf naar bestand voor test/preview
     cache_file = Path(cache_file_prefix(schedule) + ".html")
 
     with open(cache_file, "w", encoding="utf-8") as f:
         f.write(html_email)
     lg.info(f"HTML e-mail opgeslagen als {cache_file.stem}.html")
-    return html_email
\ No newline at end of file
+    return html_email
+
+
+def _benchmark(recipients: int = 10_000):
+    """Vergelijk per-recipient render-kosten van str.replace met het gecompileerde template."""
+    import timeit
+    items = [{'title': f'Artikel {i}', 'summary': 'Een samenvatting van een paar zinnen. ' * 8,
+              'links': ['https://example.com/artikel?utm_source=x', 'https://openai.com/blog/foo']}
+             for i in range(8)]
+    html_doc = build_html_email('daily', items, 'HP\'s AI daily', 'Actueel, concreet en to-the-point',
+                                'https://example.com/image.jpg')
+    emails = [f'lezer{i}@example.com' for i in range(recipients)]
+    template = CompiledTemplate.compile(html_doc)
+    assert template.render(email=emails[0]) == html_doc.replace('[EMAIL]', emails[0])
+
+    replace_time = timeit.timeit(lambda: [html_doc.replace('[EMAIL]', e) for e in emails], number=1)
+    render_time = timeit.timeit(lambda: [template.render(email=e) for e in emails], number=1)
+    print(f'{len(html_doc) / 1024:.1f} KB HTML, {len(template.slots)} slots, {recipients} recipients')
+    print(f'str.replace: {replace_time / recipients * 1e6:.2f} µs per recipient ({replace_time:.3f}s total)')
+    print(f'compiled:    {render_time / recipients * 1e6:.2f} µs per recipient ({render_time:.3f}s total)')
+
+
+if __name__ == '__main__':
+    _benchmark()
@@ -3,8 +3,13 @@ import os
 import imaplib
 import email
 import email.header
+import binascii
 import json
+import quopri
+import re
+from collections import defaultdict
 from datetime import datetime, timezone, timedelta
+from email.message import Message
 from email.utils import parseaddr, parsedate_to_datetime
 from email.header import decode_header
 from pathlib import Path
@@ -13,6 +18,17 @@ from src.database import cache_file_prefix
 from justlog import lg
 
 FILTER_ON_LABEL='y_ai_news'
+SEARCH_CHUNK = 100  # Message-IDs per combined IMAP search
+FETCH_CHUNK = 200  # UIDs per IMAP FETCH when reading bounces
+PART_LIMIT = 16384  # bytes fetched per body part of a bounce
+DELIVERY_STATUS_TYPES = ('message/delivery-status', 'message/global-delivery-status')
+SPAM_INDICATORS = [
+    r'listed on.*spamrl\.com',
+    r'URL.*is listed',
+    r'spam.*filter',
+    r'blacklist',
+    r'blocked.*spam'
+]
 # SELECTED_SENDERS = [
 # 'aitidbits+ai-coding@substack.com',
 # 'aiminds@mail.beehiiv.com'
@@ -44,37 +60,56 @@ class Mail:
             identifier: Either a UID (numeric string) or Message-ID
             folder: Mailbox to search in (default: Sent Mail)
         """
+        return self.delete_emails([identifier], folder) == 1
+
+    def delete_emails(self, identifiers, folder='[Gmail]/Sent Mail') -> int:
+        """
+        Move many emails to trash in one go: one SELECT, the Message-IDs resolved with combined
+        searches of SEARCH_CHUNK at a time, then one UID COPY and STORE over the whole UID set
+        and one EXPUNGE.
+
+        Args:
+            identifiers: UIDs (numeric strings) and/or Message-IDs, with or without angle brackets
+            folder: Mailbox to delete from (default: Sent Mail)
+
+        Returns:
+            The number of emails deleted
+        """
+        identifiers = [identifier.strip().strip('<>') for identifier in identifiers]
+        if not identifiers:
+            return 0
         try:
-            # Select the folder
             status, _ = self.mail.select(f'"{folder}"' if '/' in folder else folder, readonly=False)
             if status != 'OK':
                 lg.error(f"✗ Failed to select {folder} folder")
-                return False
-
-            # Determine if identifier is a UID or Message-ID
-            if identifier.isdigit():
-                # It's a UID, use it directly
-                email_uid = identifier.encode('utf-8')
-            else:
-                # It's a Message-ID, search for it
-                status, email_uids = self.mail.uid('search', None, f'(HEADER Message-ID "{identifier}")')
-                if status != 'OK' or not email_uids or not email_uids[0]:
-                    lg.error(f"✗ Email with Message-ID {identifier} not found in {folder}")
-                    return False
-                email_uid = email_uids[0].split()[0]
-
-            # Move to trash
-            result = self.mail.uid('copy', email_uid, '[Gmail]/Trash')
-            if result[0] == 'OK':
-                self.mail.uid('store', email_uid, '+FLAGS', '\\Deleted')
-                self.mail.expunge()
-                lg.info(f"✓ Deleted email {identifier} from {folder}")
-                return True
-            lg.error(f"✗ Failed to delete email {identifier} from {folder}.\nResult was {result}")
-            return False
+                return 0
+
+            uids = {int(identifier) for identifier in identifiers if identifier.isdigit()}
+            message_ids = [identifier for identifier in identifiers if not identifier.isdigit()]
+            for i in range(0, len(message_ids), SEARCH_CHUNK):
+                chunk = message_ids[i:i + SEARCH_CHUNK]
+                # IMAP OR takes two keys: OR OR a b c matches any of a, b, c
+                criteria = 'OR ' * (len(chunk) - 1) + ' '.join(f'HEADER Message-ID "{m}"' for m in chunk)
+                status, email_uids = self.mail.uid('search', None, f'({criteria})')
+                if status == 'OK' and email_uids and email_uids[0]:
+                    uids.update(int(uid) for uid in email_uids[0].split())
+            if len(uids) < len(identifiers):
+                lg.warning(f"{len(identifiers) - len(uids)} of {len(identifiers)} emails not found in {folder}")
+            if not uids:
+                return 0
+
+            uid_set = _uid_set(uids)
+            result = self.mail.uid('copy', uid_set, '[Gmail]/Trash')
+            if result[0] != 'OK':
+                lg.error(f"✗ Failed to delete {len(uids)} emails from {folder}.\nResult was {result}")
+                return 0
+            self.mail.uid('store', uid_set, '+FLAGS', '\\Deleted')
+            self.mail.expunge()
+            lg.info(f"✓ Deleted {len(uids)} emails from {folder}")
+            return len(uids)
         except Exception as e:
-            lg.error(f"✗ Failed to delete email {identifier} from {folder}\nException was: {str(e)}")
-            return False
+            lg.error(f"✗ Failed to delete emails from {folder}\nException was: {str(e)}")
+            return 0
 
     def get_emails(self):
         """Retrieve all email UIDs from the specified label."""
@@ -218,6 +253,10 @@ class Mail:
         """
         Get undelivered emails from Mail Delivery Subsystem.
 
+        Reads the BODYSTRUCTURE of all bounces with FETCH_CHUNK UIDs per command, then fetches
+        only their delivery-status and first text/plain part (at most PART_LIMIT bytes each),
+        one command per part layout and chunk. The quoted original newsletter is never downloaded.
+
         Returns:
             List of dicts with 'email_id' and 'recipient_email' keys
         """
@@ -237,22 +276,43 @@ class Mail:
             status, email_uids = self.mail.uid('search', None, '(OR (FROM "Mail Delivery Subsystem") (FROM "Mail Delivery System"))')
             if status != 'OK' or not email_uids or not email_uids[0]:
                 return []
+            uids = [int(uid) for uid in email_uids[0].split()]
+
+            # Structure and X-Failed-Recipients header of every bounce
+            headers, layouts = {}, defaultdict(list)
+            for uid, items in self._fetch(uids, '(BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (X-FAILED-RECIPIENTS)])').items():
+                headers[uid] = next((value for key, value in items.items() if key.startswith('BODY[HEADER')), b'')
+                parts = _body_parts(items.get('BODYSTRUCTURE') or [])
+                wanted = [part for part in parts if part[1] in DELIVERY_STATUS_TYPES]
+                wanted += [part for part in parts if part[1] == 'text/plain'][:1]
+                layouts[tuple(wanted)].append(uid)
+
+            # The parts that matter, for all bounces with the same layout at once
+            texts = {}
+            for wanted, layout_uids in layouts.items():
+                fetched = {}
+                if wanted:
+                    spec = ' '.join(f'BODY.PEEK[{number}]<0.{PART_LIMIT}>' for number, *_ in wanted)
+                    fetched = self._fetch(layout_uids, f'({spec})')
+                for uid in layout_uids:
+                    items = fetched.get(uid, {})
+                    texts[uid] = [(content_type, _decode_part(items.get(f'BODY[{number}]<0>') or
+                                                              items.get(f'BODY[{number}]') or b'', encoding, charset))
+                                  for number, content_type, charset, encoding in wanted]
 
             undelivered_emails = []
-
-            for email_uid in email_uids[0].split():
-                # Get the full email message
-                status, msg_data = self.mail.uid('fetch', email_uid, '(RFC822)')
-                if status != 'OK' or not msg_data or not isinstance(msg_data[0], tuple):
+            for uid in uids:
+                if uid not in texts:
                     continue
-
-                msg = email.message_from_bytes(msg_data[0][1])
+                dsn = '\n\n'.join(text for content_type, text in texts[uid] if content_type in DELIVERY_STATUS_TYPES)
+                body = next((text for content_type, text in texts[uid] if content_type == 'text/plain'), '')
+                failed_recipients = email.message_from_bytes(headers[uid] or b'').get('X-Failed-Recipients', '')
 
                 # Extract the original recipient from the bounce message
-                recipient_info = self._extract_original_recipient(msg)
+                recipient_info = self._bounce_recipient(dsn, body, failed_recipients)
                 if recipient_info and recipient_info.get('recipient_email'):
                     undelivered_emails.append({
-                        'email_id': email_uid.decode('utf-8'),
+                        'email_id': str(uid),
                         'recipient_email': recipient_info['recipient_email'],
                         'is_spam_rejection': recipient_info.get('is_spam_rejection', False),
                         'is_permanent': recipient_info.get('is_permanent', False)
@@ -264,6 +324,42 @@ class Mail:
             lg.error(f'Error getting undelivered emails: {str(e)}')
             return []
 
+    def _fetch(self, uids: list[int], items: str) -> dict[int, dict]:
+        """UID FETCH items for uids, FETCH_CHUNK at a time. Returns {uid: {item: value}}."""
+        fetched = {}
+        for i in range(0, len(uids), FETCH_CHUNK):
+            status, data = self.mail.uid('fetch', _uid_set(uids[i:i + FETCH_CHUNK]), items)
+            if status == 'OK' and data:
+                fetched.update(_parse_fetch(data))
+        return fetched
+
+    def _bounce_recipient(self, dsn: str, body: str, failed_recipients: str = '') -> dict | None:
+        """
+        Original recipient of a bounce from the fields of its delivery-status part, falling back
+        to the X-Failed-Recipients header and the text/plain body (_extract_original_recipient).
+
+        Returns:
+            Dict with 'recipient_email', 'is_spam_rejection' and 'is_permanent' keys, or None if not found
+        """
+        for fields in _parse_dsn(dsn):
+            if fields.get('action', 'failed').lower() not in ('failed', 'delayed'):
+                continue
+            address = fields.get('final-recipient') or fields.get('original-recipient') or ''
+            email_match = re.search(r'[\w\.-]+@[\w\.-]+\.\w+', address)
+            if email_match:
+                diagnostic = fields.get('diagnostic-code', '')
+                return {
+                    'recipient_email': email_match.group(),
+                    'is_spam_rejection': _is_spam_rejection(diagnostic + '\n' + body),
+                    'is_permanent': bool(re.search(r'5\.\d+\.\d+', fields.get('status', '') + ' ' + diagnostic))
+                }
+
+        msg = Message()
+        if failed_recipients:
+            msg['X-Failed-Recipients'] = failed_recipients
+        msg.set_payload(body, 'utf-8')
+        return self._extract_original_recipient(msg)
+
     def _extract_original_recipient(self, msg) -> dict | None:
         """
         Extract the original recipient email from a bounce message.
@@ -315,18 +411,7 @@ class Mail:
                 import re
 
                 # Check if this is a spam filter rejection
-                spam_indicators = [
-                    r'listed on.*spamrl\.com',
-                    r'URL.*is listed',
-                    r'spam.*filter',
-                    r'blacklist',
-                    r'blocked.*spam'
-                ]
-
-                is_spam_rejection = any(
-                    re.search(indicator, body, re.IGNORECASE)
-                    for indicator in spam_indicators
-                )
+                is_spam_rejection = _is_spam_rejection(body)
 
                 # Detect permanent (5xx) vs temporary (4xx) bounce
                 # Look for SMTP status codes like "550", "5.1.1", "452", "4.2.2"
@@ -372,6 +457,126 @@ class Mail:
                 pass
 
 
+def _uid_set(uids) -> str:
+    """{1, 2, 3, 7, 9, 10} -> '1:3,7,9:10'"""
+    ranges = []
+    for uid in sorted(uids):
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ','.join(str(a) if a == b else f'{a}:{b}' for a, b in ranges)
+
+
+def _is_spam_rejection(text: str) -> bool:
+    return any(re.search(indicator, text, re.IGNORECASE) for indicator in SPAM_INDICATORS)
+
+
+def _imap_tokens(data):
+    """Tokens of a FETCH response as returned by imaplib: '(' and ')', atoms and quoted strings
+    as str, NIL as None and literals (the second half of imaplib's tuples) as bytes."""
+    for item in data:
+        line, literal = item if isinstance(item, tuple) else (item, None)
+        i = 0
+        while i < len(line):
+            c = line[i:i + 1]
+            if c in b' \r\n':
+                i += 1
+            elif c in b'()':
+                yield c.decode()
+                i += 1
+            elif c == b'"':
+                value, i = bytearray(), i + 1
+                while line[i:i + 1] not in (b'"', b''):
+                    if line[i:i + 1] == b'\\':
+                        i += 1
+                    value += line[i:i + 1]
+                    i += 1
+                yield value.decode('utf-8', errors='replace')
+                i += 1
+            elif c == b'{':
+                i = line.index(b'}', i) + 1
+                yield literal
+            else:
+                # Atoms like BODY[HEADER.FIELDS (X-FAILED-RECIPIENTS)]<0> include everything between brackets
+                start, depth = i, 0
+                while i < len(line) and (depth or line[i:i + 1] not in b' ()\r\n'):
+                    depth += {b'[': 1, b']': -1}.get(line[i:i + 1], 0)
+                    i += 1
+                atom = line[start:i].decode('utf-8', errors='replace')
+                yield None if atom.upper() == 'NIL' else atom
+
+
+def _parse_fetch(data) -> dict[int, dict]:
+    """imaplib UID FETCH data -> {uid: {'BODYSTRUCTURE': [...], 'BODY[2]': b'...', ...}}"""
+    tokens = _imap_tokens(data)
+
+    def parse_list():
+        values = []
+        for token in tokens:
+            if token == ')':
+                break
+            values.append(parse_list() if token == '(' else token)
+        return values
+
+    messages = {}
+    for token in tokens:
+        if token == '(':
+            values = parse_list()
+            items = {str(key).upper(): value for key, value in zip(values[0::2], values[1::2])}
+            if items.get('UID'):
+                messages.setdefault(int(items.pop('UID')), {}).update(items)
+    return messages
+
+
+def _body_parts(structure: list, number: str = '') -> list[tuple[str, str, str | None, str]]:
+    """(part number, content type, charset, transfer encoding) of each leaf part of a BODYSTRUCTURE.
+    Attached messages (message/rfc822, the bounced newsletter) are not descended into."""
+    if not structure:
+        return []
+    if isinstance(structure[0], list):
+        # Multipart: the child parts, then the subtype and extension data
+        children = []
+        for child in structure:
+            if not isinstance(child, list):
+                break
+            children.append(child)
+        return [part for n, child in enumerate(children, 1)
+                for part in _body_parts(child, f'{number}.{n}' if number else str(n))]
+    params = structure[2] if isinstance(structure[2], list) else []
+    params = {str(key).lower(): value for key, value in zip(params[0::2], params[1::2])}
+    return [(number or '1', f'{structure[0]}/{structure[1]}'.lower(), params.get('charset'),
+             str(structure[5] or '7bit').lower())]
+
+
+def _decode_part(data: bytes, encoding: str, charset: str | None) -> str:
+    """Text of a (possibly truncated) body part."""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    if encoding == 'base64':
+        data = b''.join(data.split())
+        try:
+            data = binascii.a2b_base64(data[:len(data) // 4 * 4])
+        except binascii.Error:
+            return ''
+    elif encoding == 'quoted-printable':
+        data = quopri.decodestring(data)
+    try:
+        return data.decode(charset or 'utf-8', errors='replace')
+    except LookupError:
+        return data.decode('utf-8', errors='replace')
+
+
+def _parse_dsn(text: str) -> list[dict[str, str]]:
+    """The per-recipient field groups of a delivery-status part (RFC 3464), with lowercase names."""
+    recipients = []
+    for block in re.split(r'\r?\n[ \t]*\r?\n', text.strip()):
+        fields = email.message_from_string(block.strip() + '\n')
+        if fields.get('Final-Recipient') or fields.get('Original-Recipient'):
+            recipients.append({name.lower(): ' '.join(str(value).split()) for name, value in fields.items()})
+    return recipients
+
+
 def get_raw_mail_text(schedule: str, cached: bool=False, verbose: bool=False):
     cache_file = Path(cache_file_prefix(schedule) + '_emails.txt')
 
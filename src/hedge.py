@@ -0,0 +1,138 @@
+import json
+import threading
+import time
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+from pathlib import Path
+from typing import Callable, TypeVar
+
+from justlog import lg
+
+"""
+Hedged requests for slow, spiky model calls (image generation).
+
+The first request is started as usual. If it has not returned once it is slower than
+HEDGE_PERCENTILE of the recorded history for that model, a second identical request is
+started and whichever finishes first wins. The loser keeps running in a daemon thread
+and its result is discarded. MAX_HEDGES_PER_RUN caps the extra spend per process.
+
+The history holds the latency the caller saw, measured from the start of the original
+request. Requests that failed, or were still running when another one won, are stored as
+censored samples ({"censored": seconds}: slower than that) so the slow tail stays visible.
+"""
+
+HISTORY_FILE = Path(__file__).parent.parent / 'data' / 'latency.json'
+HISTORY_SIZE = 50  # Latency samples kept per model
+MIN_SAMPLES = 5  # Below this, DEFAULT_THRESHOLD is used
+HEDGE_PERCENTILE = 90
+DEFAULT_THRESHOLD = 120.0  # Seconds
+MIN_THRESHOLD = 10.0  # Never hedge sooner than this
+MAX_HEDGES_PER_RUN = 2
+
+T = TypeVar('T')
+
+_lock = threading.Lock()
+_hedges_used = 0
+
+
+def load_history() -> dict[str, list[float | dict]]:
+    try:
+        with open(HISTORY_FILE, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def record_latency(key: str, seconds: float, censored: bool = False) -> None:
+    """Append a call duration to the persisted history of key. censored: the call did not
+    complete (it failed or was abandoned), so it took at least seconds."""
+    sample = {'censored': round(seconds, 2)} if censored else round(seconds, 2)
+    with _lock:
+        history = load_history()
+        samples = history.get(key, []) + [sample]
+        history[key] = samples[-HISTORY_SIZE:]
+        HISTORY_FILE.parent.mkdir(parents=True, exist_ok=True)
+        with open(HISTORY_FILE, 'w') as f:
+            json.dump(history, f, indent=2)
+
+
+def percentile(samples: list[float | dict], pct: float) -> float:
+    """Nearest-rank percentile, with censored samples taken into account by the Kaplan-Meier
+    estimator. If censoring hides the percentile, the longest time seen is returned."""
+    events = sorted((sample['censored'], True) if isinstance(sample, dict) else (sample, False) for sample in samples)
+    at_risk, survival = len(events), 1.0
+    for seconds, censored in events:
+        if not censored:
+            survival *= 1 - 1 / at_risk
+            if 1 - survival >= pct / 100 - 1e-9:
+                return seconds
+        at_risk -= 1
+    return events[-1][0]
+
+
+def hedge_threshold(key: str) -> float:
+    """Seconds to wait for the first request before hedging, learned from history."""
+    samples = load_history().get(key, [])
+    if len(samples) < MIN_SAMPLES:
+        return DEFAULT_THRESHOLD
+    return max(percentile(samples, HEDGE_PERCENTILE), MIN_THRESHOLD)
+
+
+def _claim_hedge() -> bool:
+    global _hedges_used
+    with _lock:
+        if _hedges_used >= MAX_HEDGES_PER_RUN:
+            return False
+        _hedges_used += 1
+        return True
+
+
+def _start(fn: Callable[[], T]) -> Future:
+    """Run fn in a daemon thread so an abandoned request never blocks shutdown."""
+    future = Future()
+
+    def run():
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+
+def hedged_call(key: str, fn: Callable[[], T], hedge: bool = True) -> T:
+    """Call fn, starting a second identical call if the first is unusually slow.
+    Returns the first successful result; raises the last error if all calls fail."""
+    started = time.monotonic()
+    futures = [_start(fn)]
+    if hedge:
+        threshold = hedge_threshold(key)
+        done, _ = wait(futures, timeout=threshold)
+        if not done:
+            if _claim_hedge():
+                lg.warning(f'{key}: no response after {threshold:.0f}s, starting hedged request')
+                futures.append(_start(fn))
+            else:
+                lg.info(f'{key}: slow response but hedge budget ({MAX_HEDGES_PER_RUN}) is used up')
+
+    pending = set(futures)
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            duration = time.monotonic() - started
+            if future.exception() is None:
+                record_latency(key, duration)
+                if not futures[0].done():
+                    # The original request is still hanging: it takes at least this long
+                    record_latency(key, duration, censored=True)
+                if len(futures) > 1:
+                    winner = 'hedged' if future is futures[1] else 'original'
+                    lg.info(f'{key}: {winner} request won after {duration:.0f}s')
+                return future.result()
+            error = future.exception()
+            if future is futures[0]:
+                record_latency(key, duration, censored=True)
+    raise error
@@ -0,0 +1,100 @@
+import re
+from collections import Counter
+
+from justlog import lg
+
+"""
+Size optimizer for the rendered newsletter HTML.
+
+Every byte is sent to every subscriber, and Gmail clips messages whose HTML exceeds
+about 102KB. The optimizer only does transformations that are safe in email clients:
+comments (except Outlook conditional comments) are removed, whitespace is collapsed,
+style declarations are normalized and empty attributes dropped. Whitespace is only
+removed next to block-level tags; inline elements such as img keep their surrounding space.
+
+Optionally (DEDUPE_STYLES, off by default) inline styles that repeat at least
+DEDUPE_MIN_REPEATS times are moved to classes in a <style> block in the head. Only
+width, max-width, height and display stay inline then (KEEP_INLINE), so clients that strip
+<style>, such as Gmail with non-Google accounts, lose colours, fonts and spacing. Enable it
+only for a list that reads the newsletter in clients that keep <style>.
+"""
+
+GMAIL_CLIP_BYTES = 102 * 1024
+CLIP_WARNING_RATIO = 0.9
+DEDUPE_STYLES = False
+DEDUPE_MIN_REPEATS = 3
+# Properties that clients that strip <style> (e.g. Gmail for non-Google accounts) must still see
+KEEP_INLINE = ('width', 'max-width', 'height', 'display')
+
+BLOCK_TAGS = ('html', 'head', 'meta', 'title', 'style', 'body', 'table', 'tbody', 'tr', 'td', 'th',
+              'div', 'p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6')
+
+_COMMENT = re.compile(r'<!--(?!\[if|<!\[endif).*?-->', re.DOTALL)
+_BLOCK = '|'.join(BLOCK_TAGS)
+_SPACE_BEFORE_BLOCK = re.compile(rf'\s+(?=</?(?:{_BLOCK})\b)', re.IGNORECASE)
+_SPACE_AFTER_BLOCK = re.compile(rf'(</?(?:{_BLOCK})\b[^>]*>)\s+', re.IGNORECASE)
+_STYLE_ATTR = re.compile(r'\sstyle="([^"]*)"')
+_EMPTY_ATTR = re.compile(r'\s(?:style|class)=""')
+
+
+def normalize_style(style: str) -> str:
+    """'margin: 0; color : #333;' -> 'margin:0;color:#333'"""
+    declarations = []
+    for declaration in style.split(';'):
+        prop, sep, value = declaration.partition(':')
+        if sep and prop.strip() and value.strip():
+            declarations.append(f'{prop.strip().lower()}:{" ".join(value.split())}')
+    return ';'.join(declarations)
+
+
+def _split_inline(style: str) -> tuple[str, str]:
+    """Split a normalized style into (declarations to keep inline, declarations for a class)."""
+    keep, shared = [], []
+    for declaration in style.split(';'):
+        (keep if declaration.split(':', 1)[0] in KEEP_INLINE else shared).append(declaration)
+    return ';'.join(keep), ';'.join(shared)
+
+
+def _dedupe_styles(html_doc: str) -> str:
+    counts = Counter(_STYLE_ATTR.findall(html_doc))
+    classes = {}
+    for style, count in counts.most_common():
+        _, shared = _split_inline(style)
+        if count >= DEDUPE_MIN_REPEATS and shared:
+            classes[style] = f's{len(classes)}'
+    if not classes or '</head>' not in html_doc:
+        return html_doc
+
+    def replace(match):
+        style = match.group(1)
+        if style not in classes:
+            return match.group(0)
+        keep, _ = _split_inline(style)
+        return f' class="{classes[style]}"' + (f' style="{keep}"' if keep else '')
+
+    html_doc = _STYLE_ATTR.sub(replace, html_doc)
+    rules = ''.join(f'.{name}{{{_split_inline(style)[1]}}}' for style, name in classes.items())
+    return html_doc.replace('</head>', f'<style>{rules}</style></head>', 1)
+
+
+def optimize_html(html_doc: str, label: str = 'newsletter') -> str:
+    """Return a smaller, equivalent version of html_doc and log the size before and after."""
+    before = len(html_doc.encode('utf-8'))
+
+    html_doc = _COMMENT.sub('', html_doc)
+    html_doc = re.sub(r'\s+', ' ', html_doc)
+    html_doc = _SPACE_BEFORE_BLOCK.sub('', html_doc)
+    html_doc = _SPACE_AFTER_BLOCK.sub(r'\1', html_doc)
+    html_doc = _STYLE_ATTR.sub(lambda m: f' style="{normalize_style(m.group(1))}"', html_doc)
+    html_doc = _EMPTY_ATTR.sub('', html_doc)
+    if DEDUPE_STYLES:
+        html_doc = _dedupe_styles(html_doc)
+    html_doc = html_doc.strip()
+
+    after = len(html_doc.encode('utf-8'))
+    lg.info(f'Optimized {label} HTML: {before / 1024:.1f} KB -> {after / 1024:.1f} KB '
+            f'({100 * (before - after) / before:.0f}% smaller)')
+    if after >= GMAIL_CLIP_BYTES * CLIP_WARNING_RATIO:
+        lg.warning(f'{label} HTML is {after / 1024:.1f} KB, Gmail clips messages above '
+                   f'{GMAIL_CLIP_BYTES / 1024:.0f} KB')
+    return html_doc
@@ -0,0 +1,70 @@
+from io import BytesIO
+from pathlib import Path
+
+from PIL import Image
+from justlog import lg
+
+"""
+Post-processing of generated images before they are uploaded and mailed.
+
+Models return large lossless PNGs. The newsletter shows images in a 552px wide slot
+(see build_html_email), so each image is resized to 1x and 2x that width and encoded in
+whichever allowed format is smallest. WebP gives the smallest files but Outlook desktop
+does not display it, so it is only used when explicitly allowed.
+"""
+
+SLOT_WIDTH = 552
+DENSITIES = (1, 2)
+JPEG_QUALITY = 82
+WEBP_QUALITY = 80
+EMAIL_SAFE_FORMATS = ('JPEG', 'PNG')
+EXTENSIONS = {'JPEG': 'jpg', 'PNG': 'png', 'WEBP': 'webp'}
+
+
+def encode(image: Image.Image, fmt: str) -> bytes | None:
+    """Encode image as fmt with size-tuned settings. Returns None if fmt can't represent it."""
+    buffer = BytesIO()
+    if fmt == 'JPEG':
+        if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+            return None  # JPEG has no alpha channel
+        image.convert('RGB').save(buffer, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+    elif fmt == 'PNG':
+        if image.getcolors(maxcolors=256) is not None:
+            image = image.quantize(256)  # Few colours (typical for infographics): lossless palette PNG
+        image.save(buffer, 'PNG', optimize=True)
+    elif fmt == 'WEBP':
+        image.save(buffer, 'WEBP', quality=WEBP_QUALITY, method=6)
+    else:
+        raise ValueError(f'Unsupported image format {fmt}')
+    return buffer.getvalue()
+
+
+def optimize_image(path: Path, formats: tuple[str, ...] = EMAIL_SAFE_FORMATS) -> list[tuple[Path, int]]:
+    """Write 1x/2x width variants of path, each in the smallest of formats.
+    Returns a list of (variant path, density); a 2x variant is skipped when the source
+    is not wider than the 1x variant."""
+    path = Path(path)
+    original_size = path.stat().st_size
+    with Image.open(path) as source:
+        source.load()
+
+    variants = []
+    report = []
+    previous_width = 0
+    for density in DENSITIES:
+        width = min(SLOT_WIDTH * density, source.width)
+        if width <= previous_width:
+            break
+        previous_width = width
+        height = round(source.height * width / source.width)
+        image = source if width == source.width else source.resize((width, height), Image.LANCZOS)
+
+        encoded = [(data, fmt) for fmt in formats if (data := encode(image, fmt)) is not None]
+        data, fmt = min(encoded, key=lambda e: len(e[0]))
+        variant = path.with_name(f'{path.stem}_{density}x.{EXTENSIONS[fmt]}')
+        variant.write_bytes(data)
+        variants.append((variant, density))
+        report.append(f'{density}x {width}px {fmt} {len(data) / 1024:.0f} KB')
+
+    lg.info(f'Optimized {path.name} ({original_size / 1024:.0f} KB): ' + ', '.join(report))
+    return variants
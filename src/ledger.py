@@ -0,0 +1,210 @@
+import hashlib
+import socket
+import threading
+import time
+import uuid
+
+from justdays import Day
+from sqlalchemy import (Column, Float, Integer, MetaData, String, Table, Text, bindparam, func,
+                        select, update)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from src.database import get_engine
+from src.sendqueue import FAILED, FLUSH_ROWS, FLUSH_SECONDS, MAX_ATTEMPTS, PENDING, SENDING, SENT
+
+"""
+Shared send ledger for sending one newsletter from several worker processes or hosts.
+
+The subscriber list is split into shards by a stable hash of the address (shard_of), and each
+worker only handles its own shard. All workers record their sends in one table in the
+subscriber database, with the same rows and states as the local SendQueue. A recipient is
+claimed with a single UPDATE ... WHERE status = 'pending' RETURNING, which the database
+serializes per row, so even overlapping workers never send to the same recipient twice.
+
+A claim holds a lease: the row gets the claim token of the SendLedger (one per process) and
+claimed_until, which is extended while that process keeps recording results. Rows left in
+'sending' are only claimed again once their lease has expired, so a second process for the same
+shard can't take over recipients that are still being sent to, and a crashed one's recipients are
+retried CLAIM_LEASE seconds later. SendLedger has the interface of SendQueue, so
+mailer.deliver() works with either.
+"""
+
+CHUNK = 1000  # recipients per statement
+CLAIM_LEASE = 3600  # seconds a claimed row stays reserved for its worker without a sign of life
+
+metadata = MetaData()
+ledger_table = Table(
+    'nieuwsbrief_send_ledger', metadata,
+    Column('schedule', String(16), primary_key=True),
+    Column('day', String(10), primary_key=True),
+    Column('recipient', String(254), primary_key=True),
+    Column('status', String(10), nullable=False, default=PENDING, index=True),
+    Column('attempts', Integer, nullable=False, default=0),
+    Column('retry_at', Float),
+    Column('worker', String(64)),
+    Column('claim_token', String(32)),
+    Column('claimed_until', Float),
+    Column('smtp_response', Text),
+    Column('message_id', String(255)),
+    Column('updated_at', Float, nullable=False),
+)
+
+
+def shard_of(recipient: str, shards: int) -> int:
+    """Stable shard number in range(shards) for recipient, the same in every process and on every host."""
+    digest = hashlib.sha1(recipient.strip().lower().encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % shards
+
+
+def parse_shard(spec: str) -> tuple[int, int]:
+    """'2/4' -> (2, 4). Shards are numbered from 1."""
+    shard, _, shards = spec.partition('/')
+    shard, shards = int(shard), int(shards)
+    if not 1 <= shard <= shards:
+        raise ValueError(f'Invalid shard {spec}, expected i/n with 1 <= i <= n')
+    return shard, shards
+
+
+class SendLedger:
+    def __init__(self, shard: int = 1, shards: int = 1, engine=None, lease: float = CLAIM_LEASE):
+        self.engine = engine = engine or get_engine()
+        self.shard = shard
+        self.shards = shards
+        self.worker = f'{socket.gethostname()}:{shard}/{shards}'
+        self.token = uuid.uuid4().hex
+        self.lease = lease
+        self._renewed = 0.0
+        self._enqueued = []
+        self._insert = pg_insert if engine.dialect.name == 'postgresql' else sqlite_insert
+        self._lock = threading.RLock()
+        self._buffer = []
+        self._last_flush = time.monotonic()
+        metadata.create_all(engine, tables=[ledger_table], checkfirst=True)
+
+    def in_shard(self, recipient: str) -> bool:
+        return shard_of(recipient, self.shards) == self.shard - 1
+
+    def enqueue(self, schedule: str, day: Day, recipients: list[str]) -> None:
+        """Add this worker's share of recipients as pending rows; existing rows are left alone."""
+        now = time.time()
+        rows = [{'schedule': schedule, 'day': str(day), 'recipient': recipient, 'status': PENDING,
+                 'attempts': 0, 'worker': self.worker, 'updated_at': now}
+                for recipient in recipients if self.in_shard(recipient)]
+        self._enqueued += [row['recipient'] for row in rows]
+        with self.engine.begin() as conn:
+            for i in range(0, len(rows), CHUNK):
+                conn.execute(self._insert(ledger_table).values(rows[i:i + CHUNK]).on_conflict_do_nothing())
+
+    def claim(self, schedule: str, day: Day, recipients: list[str] | None = None) -> list[str]:
+        """Claim and return the recipients in this shard that still need the newsletter: pending rows
+        (deferred ones once their retry time has come), rows in 'sending' whose lease has expired and
+        failed rows due for a retry. Recipients that got another schedule's newsletter today are
+        marked sent instead. Considers recipients, or everything this worker enqueued."""
+        t = ledger_table
+        day, now = str(day), time.time()
+        recipients = [r for r in recipients if self.in_shard(r)] if recipients is not None else self._enqueued
+        claimed = []
+        with self.engine.begin() as conn:
+            for i in range(0, len(recipients), CHUNK):
+                chunk = recipients[i:i + CHUNK]
+                sent_elsewhere = select(t.c.recipient).where(t.c.day == day, t.c.status == SENT,
+                                                              t.c.schedule != schedule, t.c.recipient.in_(chunk))
+                conn.execute(update(t).where(t.c.schedule == schedule, t.c.day == day,
+                                             t.c.recipient.in_(sent_elsewhere.scalar_subquery()),
+                                             t.c.status != SENT)
+                             .values(status=SENT, updated_at=now))
+                claimable = (((t.c.status == PENDING) & (t.c.retry_at.is_(None) | (t.c.retry_at <= now)))
+                             | ((t.c.status == SENDING) & (t.c.claimed_until.is_(None) | (t.c.claimed_until < now)))
+                             | ((t.c.status == FAILED) & (t.c.attempts < MAX_ATTEMPTS) & (t.c.retry_at <= now)))
+                result = conn.execute(update(t).where(t.c.schedule == schedule, t.c.day == day,
+                                                      t.c.recipient.in_(chunk), claimable)
+                                      .values(status=SENDING, worker=self.worker, claim_token=self.token,
+                                              claimed_until=now + self.lease, updated_at=now)
+                                      .returning(t.c.recipient))
+                claimed += [row[0] for row in result]
+        self._renewed = now
+        return claimed
+
+    def cancel_pending(self, schedule: str, day: Day) -> int:
+        """Give up on rows this worker enqueued earlier that are still pending after all current
+        subscribers were claimed, i.e. recipients who have unsubscribed since. Deferred rows that are
+        not due yet are left alone."""
+        t, now = ledger_table, time.time()
+        with self.engine.begin() as conn:
+            return conn.execute(update(t).where(t.c.schedule == schedule, t.c.day == str(day),
+                                                t.c.status == PENDING, t.c.worker == self.worker,
+                                                t.c.retry_at.is_(None) | (t.c.retry_at <= now))
+                                .values(status=FAILED, attempts=MAX_ATTEMPTS, smtp_response='No longer subscribed',
+                                        updated_at=now)).rowcount
+
+    def mark_sent(self, schedule: str, day: Day, recipient: str, message_id: str, smtp_response: str = '') -> None:
+        """Written at once, together with buffered failures, so a crash can't make the next run send it again."""
+        self._record(schedule, day, recipient, SENT, smtp_response, message_id, None, flush=True)
+
+    def mark_failed(self, schedule: str, day: Day, recipient: str, smtp_response: str, retry_in: float = 600) -> None:
+        self._record(schedule, day, recipient, FAILED, smtp_response, None, time.time() + retry_in)
+
+    def defer(self, schedule: str, day: Day, recipient: str, smtp_response: str, retry_in: float = 600) -> None:
+        """Put a recipient the receiving server deferred (4xx) back to pending from retry_in seconds from
+        now, without counting an attempt."""
+        t, now = ledger_table, time.time()
+        with self.engine.begin() as conn:
+            conn.execute(update(t).where(t.c.schedule == schedule, t.c.day == str(day), t.c.recipient == recipient)
+                         .values(status=PENDING, retry_at=now + retry_in, smtp_response=smtp_response,
+                                 claim_token=None, claimed_until=None, updated_at=now))
+
+    def _record(self, schedule, day, recipient, status, smtp_response, message_id, retry_at, flush=False) -> None:
+        with self._lock:
+            self._buffer.append({'b_schedule': schedule, 'b_day': str(day), 'b_recipient': recipient,
+                                 'b_status': status, 'b_retry_at': retry_at, 'b_response': smtp_response,
+                                 'b_message_id': message_id, 'b_updated_at': time.time()})
+            if flush or len(self._buffer) >= FLUSH_ROWS or time.monotonic() - self._last_flush >= FLUSH_SECONDS:
+                self.flush()
+
+    def flush(self) -> None:
+        """Write buffered results in one transaction, and extend the lease on this worker's claimed rows
+        every quarter lease."""
+        t = ledger_table
+        with self._lock:
+            now = time.time()
+            renew = now - self._renewed >= self.lease / 4
+            if self._buffer or renew:
+                with self.engine.begin() as conn:
+                    if self._buffer:
+                        conn.execute(update(t)
+                                     .where(t.c.schedule == bindparam('b_schedule'), t.c.day == bindparam('b_day'),
+                                            t.c.recipient == bindparam('b_recipient'))
+                                     .values(status=bindparam('b_status'), attempts=t.c.attempts + 1,
+                                             retry_at=bindparam('b_retry_at'), smtp_response=bindparam('b_response'),
+                                             message_id=func.coalesce(bindparam('b_message_id'), t.c.message_id),
+                                             updated_at=bindparam('b_updated_at')),
+                                     self._buffer)
+                    if renew:
+                        conn.execute(update(t).where(t.c.status == SENDING, t.c.claim_token == self.token)
+                                     .values(claimed_until=now + self.lease))
+                        self._renewed = now
+                self._buffer = []
+            self._last_flush = time.monotonic()
+
+    def counts(self, schedule: str, day: Day) -> dict[str, int]:
+        """{status: number of recipients} for schedule on day, over all workers."""
+        t = ledger_table
+        with self.engine.connect() as conn:
+            rows = conn.execute(select(t.c.status, func.count()).where(t.c.schedule == schedule, t.c.day == str(day))
+                                .group_by(t.c.status))
+            return {status: count for status, count in rows}
+
+    def sent_count(self, day: Day) -> int:
+        """Messages sent on day by all workers, for the daily SMTP quota."""
+        t = ledger_table
+        with self.engine.connect() as conn:
+            return conn.execute(select(func.count()).where(t.c.day == str(day), t.c.status == SENT)).scalar()
+
+    def is_complete(self, schedule: str, day: Day) -> bool:
+        """True if schedule was sent on day and nothing is left pending or half-sent by any worker."""
+        counts = self.counts(schedule, day)
+        return counts.get(SENT, 0) > 0 and not counts.get(PENDING) and not counts.get(SENDING)
+
+    def close(self) -> None:
+        self.flush()
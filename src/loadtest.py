@@ -0,0 +1,88 @@
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+from src.fakesmtp import FakeSmtpServer
+from src.formatter import build_html_email
+from src.html_optimizer import optimize_html
+from src.mailer import deliver, transport
+from src.sender import DOMAIN_MAX_RATE, DomainScheduler, SendLimiter, SendStats
+from src.sendqueue import SendQueue
+
+"""
+Load test for the send path: a synthetic subscriber list is pushed through the real rendering,
+MIME building, send queue and parallel sender, into a local FakeSmtpServer or a Maildir.
+Nothing is sent to the real SMTP server and the real send queue is not touched.
+
+    python -m src.loadtest --recipients 50000 --connections 8 --latency 0.005 --defer-rate 0.01
+    python -m src.loadtest --recipients 10000 --transport maildir
+"""
+
+
+def synthetic_recipients(count: int, domains: int) -> list[str]:
+    # A few large providers and a long tail, roughly like the real list
+    big = ['gmail.com', 'outlook.com', 'hotmail.com', 'ziggo.nl', 'kpnmail.nl']
+    names = big + [f'bedrijf{i}.nl' for i in range(max(domains - len(big), 0))]
+    return [f'lezer{i}@{names[0 if i % 3 == 0 else i % len(names)]}' for i in range(count)]
+
+
+def synthetic_newsletter() -> str:
+    items = [{'title': f'Artikel {i}', 'summary': 'Een samenvatting van een paar zinnen over AI. ' * 10,
+              'links': ['https://example.com/artikel?utm_source=x', 'https://openai.com/blog/foo']}
+             for i in range(10)]
+    return optimize_html(build_html_email('daily', items, "HP's AI daily", 'Actueel, concreet en to-the-point',
+                                          'https://example.com/image.jpg'))
+
+
+def run(recipients: int, connections: int, spec: str, domains: int, domain_rate: float,
+        **server_options) -> SendStats:
+    html_doc = synthetic_newsletter()
+    emails = synthetic_recipients(recipients, domains)
+    unlimited = SendLimiter(per_second=1e9, per_minute=1e9, per_day=1e9)
+    # Without a domain rate the test measures the send path itself instead of the throttle
+    domain_rate = domain_rate or 1e9
+    scheduler = DomainScheduler(rate=domain_rate, max_rate=max(domain_rate, DOMAIN_MAX_RATE), defer_delay=1)
+    with tempfile.TemporaryDirectory() as tmp:
+        queue = SendQueue(Path(tmp) / 'sendqueue.db', Path(tmp) / 'mailerlog.txt')
+        stats = SendStats()
+        options = dict(limiter=unlimited, stats=stats, connections=connections, scheduler=scheduler,
+                       metrics_dir=Path(tmp))
+        try:
+            if spec == 'fake':
+                with FakeSmtpServer(**server_options) as server:
+                    deliver('loadtest', html_doc, 'Load test', emails, queue,
+                            transport(stats, f'smtp://127.0.0.1:{server.port}'), **options)
+                received = f'{server.messages} messages, {server.bytes / 1e6:.0f} MB received by the fake server'
+            else:
+                deliver('loadtest', html_doc, 'Load test', emails, queue, transport(stats, f'maildir:{tmp}/maildir'),
+                        **options)
+                received = f'{len(list(Path(tmp, "maildir", "new").iterdir()))} messages in the maildir'
+        finally:
+            queue.close()
+    print(f'{recipients} recipients over {connections} connections ({spec}): {received}')
+    print(stats.report(unlimited))
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the newsletter send path without sending mail')
+    parser.add_argument('--recipients', type=int, default=50_000)
+    parser.add_argument('--connections', type=int, default=8)
+    parser.add_argument('--domains', type=int, default=500, help='number of distinct recipient domains')
+    parser.add_argument('--domain-rate', type=float, default=0,
+                        help='start rate per domain in msg/s, as in production (default: unthrottled)')
+    parser.add_argument('--transport', choices=('fake', 'maildir'), default='fake')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds before the fake server accepts DATA')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of recipients rejected with 550')
+    parser.add_argument('--defer-rate', type=float, default=0.0, help='fraction of recipients deferred with 451')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='fraction of messages that drop the connection')
+    args = parser.parse_args()
+    started = time.monotonic()
+    run(args.recipients, args.connections, args.transport, args.domains, args.domain_rate, latency=args.latency,
+        error_rate=args.error_rate, defer_rate=args.defer_rate, drop_rate=args.drop_rate)
+    print(f'Total {time.monotonic() - started:.1f}s including rendering and queue setup')
+
+
+if __name__ == '__main__':
+    main()
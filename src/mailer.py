@@ -1,22 +1,67 @@
 import os
+import quopri
 import smtplib
 import json
 import time
+import uuid
 from datetime import datetime, timezone
 from pathlib import Path
+from email.header import Header
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.utils import formataddr, make_msgid
 from contextlib import contextmanager
+from itertools import batched
+from typing import Iterable
+from urllib.parse import quote
 
 from justdays import Day
 
-from src.subscribers import get_subscribers
+from src.formatter import CompiledTemplate
+from src.subscribers import iter_subscribers
 from src.gmail import Mail
+from src.sender import (SMTP_CONNECTIONS, SMTP_MAX_PER_DAY, SMTP_MAX_PER_MINUTE, SMTP_MAX_PER_SECOND,
+                        Deferred, DomainScheduler, SendLimiter, SendStats, send_parallel)
+from src.sendqueue import SENT, SendQueue
+from src.ledger import SendLedger, parse_shard
 from justlog import lg
 
+# 'smtp' (EMAIL_HOST), 'smtp://host:port' (plain and unauthenticated: a local FakeSmtpServer) or 'maildir:<directory>'
+MAIL_TRANSPORT = os.getenv('MAIL_TRANSPORT', 'smtp')
 REPLY_TO_EMAIL = "nieuwsbrief@harmsen.nl"
 DISPLAY_FROM_EMAIL = "nieuwsbrief@harmsen.nl"
+UNSUBSCRIBE_URL = "https://harmsen.nl/nieuwsbrief/afmelden/?email={recipient}"
+SMTP_TIMEOUT = 60
+CLAIM_CHUNK = 500  # recipients enqueued and claimed per transaction
+SMTP_SEND_ATTEMPTS = 4
+SMTP_RETRY_BACKOFF = 2  # seconds, doubled on every retry
+PLAIN_TEXT = """Je ontvangt dit bericht omdat je je hebt aangemeld voor de AI nieuwsbrief.
+    Als je deze e-mail niet kunt lezen, bekijk deze dan in je browser: {url}
+    
+    Uitschrijven kan hier: {unsubscribe}"""
+
+
+def smtp_login(host: str | None = None, port: int | None = None, secure: bool = True) -> smtplib.SMTP:
+    """Open an SMTP connection with STARTTLS and log in. Defaults to the server in the environment.
+    secure=False connects without STARTTLS and login, only for a local test server (smtp://host:port)."""
+    # Get SMTP settings from environment
+    smtp_server = host or os.getenv('EMAIL_HOST')
+    smtp_port = port or int(os.getenv('EMAIL_PORT', '587'))
+    username = os.getenv('EMAIL_HOST_USER')
+    password = os.getenv('EMAIL_HOST_PASSWORD')
+
+    if not smtp_server or secure and not all([username, password]):
+        raise ValueError("Missing required SMTP configuration in environment variables")
+
+    server = smtplib.SMTP(smtp_server, smtp_port, timeout=SMTP_TIMEOUT)
+    try:
+        if secure:
+            server.starttls()
+            server.login(username, password)
+    except Exception:
+        server.close()
+        raise
+    return server
 
 
 @contextmanager
@@ -25,18 +70,7 @@ def logged_in_smtp():
 
     server = None
     try:
-        # Get SMTP settings from environment
-        smtp_server = os.getenv('EMAIL_HOST')
-        smtp_port = int(os.getenv('EMAIL_PORT', '587'))
-        username = os.getenv('EMAIL_HOST_USER')
-        password = os.getenv('EMAIL_HOST_PASSWORD')
-        
-        if not all([smtp_server, username, password]):
-            raise ValueError("Missing required SMTP configuration in environment variables")
-        
-        server = smtplib.SMTP(smtp_server, smtp_port)
-        server.starttls()
-        server.login(username, password)
+        server = smtp_login()
         yield server
     except Exception as e:
         lg.error(f"SMTP Error: {e}")
@@ -62,17 +96,14 @@ def create_message(recipient: str, subject: str, html_content: str, reply_to: st
     msg["X-Entity-Type"] = "newsletter"
     
     # Required headers for bulk email
-    unsubscribe_url = f"https://harmsen.nl/nieuwsbrief/afmelden/?email={recipient}"
-    msg["List-Unsubscribe"] = f"<mailto:{reply_to}?subject=unsubscribe>, <{unsubscribe_url}>"
+    unsubscribe_url = UNSUBSCRIBE_URL.format(recipient=recipient)
+    msg["List-Unsubscribe"] = f"<mailto:{reply_to}?subject=unsubscribe>, <{unsubscribe_header_url(recipient)}>"
     msg["List-Unsubscribe-Post"] = "List-Unsubscribe=One-Click"
     msg["Precedence"] = "bulk"
     msg["X-Auto-Response-Suppress"] = "OOF, AutoReply"
     
     # Create the plain-text version
-    text = """Je ontvangt dit bericht omdat je je hebt aangemeld voor de AI nieuwsbrief.
-    Als je deze e-mail niet kunt lezen, bekijk deze dan in je browser: {url}
-    
-    Uitschrijven kan hier: {unsubscribe}""".format(
+    text = PLAIN_TEXT.format(
         url=unsubscribe_url.replace("afmelden/", ""),
         unsubscribe=unsubscribe_url
     )
@@ -88,6 +119,83 @@ def create_message(recipient: str, subject: str, html_content: str, reply_to: st
     return msg
 
 
+def unsubscribe_header_url(recipient: str) -> str:
+    """The unsubscribe URL for the List-Unsubscribe header, with the address percent-encoded so that
+    it is ASCII also for an internationalized address."""
+    return UNSUBSCRIBE_URL.format(recipient=quote(recipient, safe='@'))
+
+
+def _qp(text: str) -> str:
+    """Quoted-printable encode text as UTF-8, with CRLF line endings."""
+    return quopri.encodestring(text.encode('utf-8')).decode('ascii').replace('\n', '\r\n')
+
+
+def _header(value: str) -> str:
+    return value if value.isascii() else Header(value, 'utf-8').encode()
+
+
+class BulkMessageBuilder:
+    """Builds the same newsletter for many recipients, producing the same message as create_message.
+
+    The text and HTML parts are quoted-printable encoded once, as segments around the [EMAIL] slots.
+    Per recipient only the address is encoded and spliced in between soft line breaks ("=" + CRLF,
+    which decode to nothing), and only To, Message-ID and List-Unsubscribe are generated.
+    """
+
+    def __init__(self, subject: str, html_content: str, reply_to: str, campaign_id: str = ''):
+        self.reply_to = reply_to
+        boundary = f'==============={uuid.uuid4().hex}=='
+        static_headers = [
+            ('Subject', _header(subject)),
+            ('From', formataddr(("HP's AI nieuwsbrief", "nieuwsbrief@harmsen.nl"))),
+            ('Reply-To', reply_to),
+            ('X-Entity-Type', 'newsletter'),
+            ('List-Unsubscribe-Post', 'List-Unsubscribe=One-Click'),
+            ('Precedence', 'bulk'),
+            ('X-Auto-Response-Suppress', 'OOF, AutoReply'),
+        ]
+        if campaign_id:
+            static_headers.append(('X-Campaign-ID', campaign_id))
+        static_headers += [
+            ('MIME-Version', '1.0'),
+            ('Content-Type', f'multipart/alternative;\r\n boundary="{boundary}"'),
+        ]
+        self._head = ''.join(f'{name}: {value}\r\n' for name, value in static_headers)
+
+        part_headers = 'Content-Type: text/{subtype}; charset="utf-8"\r\nContent-Transfer-Encoding: quoted-printable\r\n\r\n'
+        self._text_start = f'\r\n--{boundary}\r\n' + part_headers.format(subtype='plain')
+        self._html_start = f'\r\n--{boundary}\r\n' + part_headers.format(subtype='html')
+        self._end = f'\r\n--{boundary}--\r\n'
+
+        text = PLAIN_TEXT.format(url=UNSUBSCRIBE_URL.replace("afmelden/", "").format(recipient='[EMAIL]'),
+                                 unsubscribe=UNSUBSCRIBE_URL.format(recipient='[EMAIL]'))
+        self._text = self._encode_template(text)
+        self._html = self._encode_template(html_content)
+
+    @staticmethod
+    def _encode_template(content: str) -> CompiledTemplate:
+        template = CompiledTemplate.compile(content)
+        return CompiledTemplate([_qp(segment) for segment in template.segments], template.slots)
+
+    def build(self, recipient: str) -> tuple[str, bytes]:
+        """Returns the Message-ID and the complete message for recipient, ready for sendmail."""
+        message_id = make_msgid(domain="harmsen.nl")
+        unsubscribe_url = unsubscribe_header_url(recipient)
+        email_fragment = '=\r\n' + _qp(recipient) + '=\r\n'
+        message = ''.join((
+            self._head,
+            f'To: {_header(recipient)}\r\n',
+            f'Message-ID: {message_id}\r\n',
+            f'List-Unsubscribe: <mailto:{self.reply_to}?subject=unsubscribe>,\r\n <{unsubscribe_url}>\r\n',
+            self._text_start,
+            self._text.render(email=email_fragment),
+            self._html_start,
+            self._html.render(email=email_fragment),
+            self._end,
+        ))
+        return message_id, message.encode('ascii')
+
+
 def delete_email(message_id: str, folder: str = '[Gmail]/Sent Mail') -> bool:
     """
     Delete an email from a specified folder.
@@ -99,31 +207,40 @@ def delete_email(message_id: str, folder: str = '[Gmail]/Sent Mail') -> bool:
     Returns:
         bool: True if deletion was successful, False otherwise
     """
+    return delete_emails([message_id], folder) == 1
+
+
+def delete_emails(message_ids: list[str], folder: str = '[Gmail]/Sent Mail') -> int:
+    """Delete many emails from folder over a single IMAP session. Returns the number deleted."""
+    mail = Mail()
+    if not mail.connect():
+        lg.error('✗ Failed to connect to IMAP server')
+        return 0
     try:
-        mail = Mail()
-        if not mail.connect():
-            lg.error('✗ Failed to connect to IMAP server')
-            return False
-    except Exception as e:
-        lg.error(f"✗ Error connecting to IMAP server while trying to delete an email\n{str(e)}")
-        return False
-    message_id = message_id.strip('<>') # Remove angle brackets if present
-    return mail.delete_email(message_id, folder)
+        return mail.delete_emails(message_ids, folder)
+    finally:
+        mail.close()
+
+
+def already_sent_today(schedule: str, shared: bool = False) -> bool:
+    """Check if a newsletter for this schedule was already sent today, to anyone. An interrupted
+    send is resumed with --resend: the send queue skips the recipients who already got it.
+    shared: check the ledger of the send workers."""
+    queue = SendLedger() if shared else SendQueue()
+    try:
+        return queue.counts(schedule, Day()).get(SENT, 0) > 0
+    finally:
+        queue.close()
 
 
-def already_sent_today(schedule: str) -> bool:
-    """Check if a newsletter for this schedule was already sent today."""
-    log_file = Path(__file__).parent.parent / 'data' / 'mailerlog.txt'
-    today = str(Day())
+def interrupted_today(schedule: str, shared: bool = False) -> bool:
+    """True if a send for this schedule started today but recipients are still pending or half-sent,
+    so that --resend is needed to finish it. shared: check the ledger of the send workers."""
+    queue = SendLedger() if shared else SendQueue()
     try:
-        with open(log_file, 'r', encoding='utf-8') as f:
-            return any(
-                parts[0] == schedule and parts[1] == today
-                for line in f
-                if len(parts := line.strip().split()) >= 3
-            )
-    except FileNotFoundError:
-        return False
+        return queue.counts(schedule, Day()).get(SENT, 0) > 0 and not queue.is_complete(schedule, Day())
+    finally:
+        queue.close()
 
 
 def update_last_sent_timestamp(schedule: str) -> None:
@@ -142,88 +259,230 @@ def update_last_sent_timestamp(schedule: str) -> None:
         json.dump(last_sent_data, f, indent=2)
 
 
-def mailerlog(s: str=''):
-    log_file = Path(__file__).parent.parent / 'data' / 'mailerlog.txt'
-    with open(log_file, 'a', encoding='utf-8') as f:
-        f.write(f"{s}\n")
+def smtp_send(server: smtplib.SMTP, from_addr: str, recipient: str, message: bytes) -> str:
+    """Like server.sendmail for a single recipient, but returns the server's final response
+    (e.g. '250 2.0.0 Ok: queued as 4Xy...') for the send queue."""
+    server.ehlo_or_helo_if_needed()
+    try:
+        code, response = server.mail(from_addr)
+        if code != 250:
+            raise smtplib.SMTPSenderRefused(code, response, from_addr)
+        code, response = server.rcpt(recipient)
+        if code not in (250, 251):
+            raise smtplib.SMTPRecipientsRefused({recipient: (code, response)})
+        code, response = server.data(message)
+        if code != 250:
+            raise smtplib.SMTPDataError(code, response)
+    except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused):
+        try:
+            server.rset()
+        except smtplib.SMTPServerDisconnected:
+            pass
+        raise
+    return f"{code} {response.decode('utf-8', 'replace')}"
 
 
-def get_mailerlog(day:Day) -> set:
-    res = set()
-    log_file = Path(__file__).parent.parent / 'data' / 'mailerlog.txt'
-    with open(log_file, 'r', encoding='utf-8') as f:
-        for line in f:
-            try:
-                schedule, sent_day, receipient = line.strip().split()
-                if sent_day == str(day):
-                    res.add(receipient)
-            except:
-                pass
-    return res
+def smtp_error(e: Exception) -> str:
+    """The SMTP response in an smtplib exception, or the exception text."""
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        code, response = next(iter(e.recipients.values()))
+        return f"{code} {response.decode('utf-8', 'replace')}"
+    if isinstance(e, smtplib.SMTPResponseException):
+        error = e.smtp_error.decode('utf-8', 'replace') if isinstance(e.smtp_error, bytes) else e.smtp_error
+        return f"{e.smtp_code} {error}"
+    return str(e)
 
 
-def send_newsletter(schedule: str, newsletter_html: str, title: str):
-    subscribers = get_subscribers(schedule)
-    already_mailed = get_mailerlog(Day())
-    subscribers = [s for s in subscribers if s not in already_mailed]
+def _is_connection_error(e: Exception) -> bool:
+    """True for errors that mean the connection is gone rather than that the recipient was refused."""
+    if isinstance(e, smtplib.SMTPServerDisconnected):
+        return True
+    if isinstance(e, smtplib.SMTPResponseException):
+        return e.smtp_code == 421  # Service not available, closing transmission channel
+    return isinstance(e, OSError) and not isinstance(e, smtplib.SMTPException)
 
-    # Rate limiting: Send max 100 emails per batch with 1-second delay
-    BATCH_SIZE = 100
 
-    # Collect Message-IDs for deletion after sending
-    message_ids_to_delete = []
+class SmtpSession:
+    """An SMTP connection that heals itself.
 
-    with logged_in_smtp() as server:
-        for i, recipient in enumerate(subscribers, 1):
+    Entering the session connects and logs in. When the connection turns out to be dropped
+    (disconnect, 421, socket error), send() reconnects, logs in again, RSETs and retries the same
+    recipient, waiting SMTP_RETRY_BACKOFF seconds, doubling, between attempts. Refusals of the
+    recipient or message are raised straight away. Reconnects and retries are counted in stats.
+    """
+
+    def __init__(self, stats: SendStats | None = None, connect=smtp_login,
+                 attempts: int = SMTP_SEND_ATTEMPTS, backoff: float = SMTP_RETRY_BACKOFF):
+        self.stats = stats or SendStats()
+        self.connect = connect
+        self.attempts = attempts
+        self.backoff = backoff
+        self.server = None
+
+    def __enter__(self):
+        self._reconnect()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _reconnect(self) -> None:
+        self._drop()
+        self.stats.count('connects')
+        self.server = self.connect()
+        self.server.rset()
+
+    def _drop(self) -> None:
+        if self.server:
             try:
-                # Personalize the HTML content
-                html = newsletter_html.replace("[EMAIL]", recipient)
-
-                # Create and send the message
-                msg = create_message(
-                    recipient=recipient,
-                    subject=title,
-                    html_content=html,
-                    reply_to=REPLY_TO_EMAIL
-                )
-
-                # Add tracking headers
-                msg['X-Campaign-ID'] = f"ai-newsletter-{datetime.now(timezone.utc).strftime('%Y%m%d')}"
-
-                # Send the email
-                server.sendmail(DISPLAY_FROM_EMAIL, [recipient], msg.as_string())
-                lg.info(f"Email sent to {recipient}")
-
-                # Collect Message-ID for later deletion (if not @harmsen.nl)
-                if '@harmsen.nl' not in recipient.lower():
-                    message_ids_to_delete.append(msg['Message-ID'])
-
-                # Log successful send
-                mailerlog(f"{schedule} {Day()} {recipient}")
-
-                # Rate limiting
-                if i % BATCH_SIZE == 0 and i < len(subscribers):
-                    lg.info(f"Sent {i} emails, pausing for 60 seconds...")
-                    time.sleep(60)
-                else:
-                    time.sleep(1)  # Small delay between emails
+                self.server.close()
+            except Exception:
+                pass
+            self.server = None
 
+    def send(self, from_addr: str, recipient: str, message: bytes) -> str:
+        """Send message to recipient and return the server's response, see smtp_send."""
+        for attempt in range(self.attempts):
+            try:
+                if self.server is None:
+                    self.stats.count('reconnects')
+                    self._reconnect()
+                return smtp_send(self.server, from_addr, recipient, message)
             except Exception as e:
-                lg.error(f"Error sending to {recipient}: {str(e)}")
+                if not _is_connection_error(e) or attempt == self.attempts - 1:
+                    raise
+                wait = self.backoff * 2 ** attempt
+                lg.warning(f"SMTP connection lost sending to {recipient} ({e}), retrying in {wait:.0f}s")
+                self.stats.count('retries')
+                self._drop()
+                time.sleep(wait)
+
+    def close(self) -> None:
+        if self.server:
+            try:
+                self.server.quit()
+            except Exception as e:
+                lg.error(f"Error closing SMTP connection: {e}")
+            self.server = None
+
+
+class MaildirSink:
+    """Transport that stores every message as a file in a Maildir instead of sending it.
+    Same interface as SmtpSession, for previews and load tests without a mail server."""
+
+    def __init__(self, directory: str | Path):
+        self.directory = Path(directory)
+        for sub in ('tmp', 'new', 'cur'):
+            (self.directory / sub).mkdir(parents=True, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def send(self, from_addr: str, recipient: str, message: bytes) -> str:
+        name = f'{time.time_ns()}.{uuid.uuid4().hex}.ainews'
+        tmp = self.directory / 'tmp' / name
+        tmp.write_bytes(message)
+        os.replace(tmp, self.directory / 'new' / name)  # Maildir delivery: write in tmp/, move to new/
+        return f'250 Stored as {name}'
+
+
+def transport(stats: SendStats, spec: str | None = None):
+    """Session factory for send_parallel for the transport in spec, default MAIL_TRANSPORT."""
+    spec = spec or MAIL_TRANSPORT
+    if spec == 'smtp':
+        return lambda: SmtpSession(stats)
+    if spec.startswith('smtp://'):
+        host, _, port = spec.removeprefix('smtp://').partition(':')
+        return lambda: SmtpSession(stats, connect=lambda: smtp_login(host, int(port or 25), secure=False))
+    if spec.startswith('maildir:'):
+        return lambda: MaildirSink(spec.removeprefix('maildir:'))
+    raise ValueError(f'Unknown mail transport {spec}')
+
+
+def deliver(schedule: str, newsletter_html: str, title: str, recipients: list[str] | Iterable[list[str]],
+            queue: SendQueue, session_factory, limiter: SendLimiter | None = None, stats: SendStats | None = None,
+            day: Day | None = None, connections: int = SMTP_CONNECTIONS, scheduler: DomainScheduler | None = None,
+            metrics_dir: Path | None = None) -> tuple[SendStats, list[tuple[str, str]]]:
+    """Send the newsletter to the recipients that still need it according to queue. recipients is a
+    list or a stream of lists, such as iter_subscribers(). scheduler and metrics_dir are passed on
+    to send_parallel. Returns the send statistics and (recipient, Message-ID) of the sent messages."""
+    day = day or Day()
+    stats = stats or SendStats()
+
+    def claimed():
+        # Enqueue and claim per chunk, so sending starts while later chunks are still being read.
+        # send_parallel pulls the next chunk only when its workers are about to run out (FEED_LIMIT).
+        for chunk in chunks:
+            queue.enqueue(schedule, day, chunk)
+            yield queue.claim(schedule, day, chunk)
+        if cancelled := queue.cancel_pending(schedule, day):
+            lg.info(f"{cancelled} recipients of an earlier run are no longer subscribed, skipped")
+
+    chunks = batched(recipients, CLAIM_CHUNK) if isinstance(recipients, list) else recipients
+    builder = BulkMessageBuilder(
+        subject=title,
+        html_content=newsletter_html,
+        reply_to=REPLY_TO_EMAIL,
+        campaign_id=f"ai-newsletter-{datetime.now(timezone.utc).strftime('%Y%m%d')}"
+    )
+    message_ids = []
+
+    def send_one(session, recipient):
+        # Personalize and send the message
+        message_id, message = builder.build(recipient)
+        try:
+            response = session.send(DISPLAY_FROM_EMAIL, recipient, message)
+        except Exception as e:
+            response = smtp_error(e)
+            if response.startswith('4'):
+                # Temporary: retried later in this run, or made pending again for the next run (see defer below)
+                raise Deferred(response) from e
+            queue.mark_failed(schedule, day, recipient, response)
+            raise
+        queue.mark_sent(schedule, day, recipient, message_id, response)
+        lg.info(f"Email sent to {recipient}")
+        message_ids.append((recipient, message_id))
+        return response
+
+    # Parallel sessions, paced by the provider's per-second/minute/day quota
+    limiter = limiter or SendLimiter(already_sent_today=queue.sent_count(day))
+    send_parallel(claimed(), session_factory, send_one, limiter, connections, stats,
+                  on_deferred=lambda recipient, response: queue.defer(schedule, day, recipient, response),
+                  scheduler=scheduler, metrics_dir=metrics_dir)
+    queue.flush()
+    lg.info(f"Send queue for {schedule} {day}: {queue.counts(schedule, day)}")
+    return stats, message_ids
+
+
+def send_newsletter(schedule: str, newsletter_html: str, title: str, shard: str = ''):
+    """Send the newsletter to all subscribers of schedule. With shard 'i/n' only to shard i of n,
+    claimed in the shared SendLedger, with 1/n of the SMTP quota (see src/ledger.py)."""
+    if shard:
+        index, shards = parse_shard(shard)
+        queue = SendLedger(index, shards)
+        limiter = SendLimiter(SMTP_MAX_PER_SECOND / shards, SMTP_MAX_PER_MINUTE / shards, SMTP_MAX_PER_DAY / shards,
+                              already_sent_today=queue.sent_count(Day()) // shards)
+    else:
+        queue = SendQueue()
+        limiter = None
+    stats = SendStats(shard or '1/1')
+    try:
+        stats, sent = deliver(schedule, newsletter_html, title, iter_subscribers(schedule), queue,
+                              transport(stats), limiter=limiter, stats=stats)
+    finally:
+        queue.close()
 
-    # Delete sent emails after a delay to allow Gmail to process them
-    if message_ids_to_delete:
+    # Delete sent emails (if not @harmsen.nl) from Sent Mail after a delay to allow Gmail to process them
+    message_ids_to_delete = [message_id for recipient, message_id in sent if '@harmsen.nl' not in recipient.lower()]
+    if message_ids_to_delete and MAIL_TRANSPORT == 'smtp':
         lg.info(f"Waiting 10 seconds before deleting {len(message_ids_to_delete)} sent emails...")
         time.sleep(10)
 
-        deleted_count = 0
-        for message_id in message_ids_to_delete:
-            if delete_email(message_id):
-                deleted_count += 1
-            time.sleep(1)  # Small delay between deletions
-
+        deleted_count = delete_emails(message_ids_to_delete)
         lg.info(f"Successfully deleted {deleted_count}/{len(message_ids_to_delete)} sent emails")
 
-    lg.info(f"Newsletter sending completed. Sent to {len(subscribers)} recipients.\n")
-    mailerlog()
+    lg.info(f"Newsletter sending completed. Sent to {stats.sent}/{stats.sent + stats.failed} recipients.\n")
     update_last_sent_timestamp(schedule)
@@ -0,0 +1,139 @@
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+from justlog import lg
+
+"""
+Live metrics of a newsletter send run.
+
+While send_parallel runs, a MetricsReporter thread writes the SendStats every METRICS_INTERVAL
+seconds to data/send_metrics.json and, in the Prometheus text format, to data/send_metrics.prom
+(for node_exporter's textfile collector), and logs one progress line with rate and ETA. A shard
+i/n of a sharded send writes send_metrics_iofn.json/.prom and labels its series shard="i/n".
+Files are replaced atomically so a reader never sees a half-written file.
+"""
+
+METRICS_DIR = Path(__file__).parent.parent / 'data'
+METRICS_INTERVAL = 10  # seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)  # seconds
+
+
+def latency_histogram(latencies: list[float]) -> list[tuple[float, int]]:
+    """Cumulative (upper bound, count) pairs as in a Prometheus histogram, ending with +Inf."""
+    return [(bound, sum(1 for latency in latencies if latency <= bound)) for bound in LATENCY_BUCKETS] + \
+        [(float('inf'), len(latencies))]
+
+
+def snapshot(stats, limiter=None) -> dict:
+    latencies = list(stats.latencies)
+    return {
+        'updated_at': time.time(),
+        'shard': stats.shard,
+        'total': stats.total,
+        'sent': stats.sent,
+        'failed': stats.failed,
+        'remaining': stats.remaining,
+        'deferrals': stats.deferrals,
+        'reconnects': stats.reconnects,
+        'retries': stats.retries,
+        'elapsed_seconds': round(stats.elapsed, 1),
+        'rate_per_second': round(stats.rate, 3),
+        'eta_seconds': round(stats.eta, 0) if stats.eta is not None else None,
+        'quota_per_second': limiter.per_second if limiter else None,
+        'quota_per_minute': limiter.per_minute if limiter else None,
+        'latency_p50': stats.latency_percentile(50),
+        'latency_p95': stats.latency_percentile(95),
+        'latency_sum': sum(latencies),
+        'latency_histogram': [['+Inf' if bound == float('inf') else bound, count]
+                              for bound, count in latency_histogram(latencies)],
+        'responses': dict(stats.codes),
+        'finished': stats.finished is not None,
+    }
+
+
+def prometheus_text(data: dict) -> str:
+    """The metrics in data in the Prometheus text format, every series labelled with the shard."""
+    shard = f'shard="{data["shard"]}"'
+    lines = ['# HELP ainews_send_messages_total Newsletter messages by outcome.',
+             '# TYPE ainews_send_messages_total counter']
+    lines += [f'ainews_send_messages_total{{{shard},outcome="{outcome}"}} {data[outcome]}'
+              for outcome in ('sent', 'failed')]
+    lines += ['# HELP ainews_send_deferrals_total 4xx deferrals, also of messages that were sent on a later try.',
+              '# TYPE ainews_send_deferrals_total counter',
+              f'ainews_send_deferrals_total{{{shard}}} {data["deferrals"]}']
+    lines += ['# HELP ainews_send_responses_total SMTP replies by code.',
+              '# TYPE ainews_send_responses_total counter']
+    lines += [f'ainews_send_responses_total{{{shard},code="{code}"}} {count}'
+              for code, count in sorted(data['responses'].items())]
+    lines += ['# HELP ainews_send_latency_seconds Time to send one message.',
+              '# TYPE ainews_send_latency_seconds histogram']
+    lines += [f'ainews_send_latency_seconds_bucket{{{shard},le="{bound}"}} {count}'
+              for bound, count in data['latency_histogram']]
+    lines += [f'ainews_send_latency_seconds_sum{{{shard}}} {data["latency_sum"]:.6f}',
+              f'ainews_send_latency_seconds_count{{{shard}}} {data["latency_histogram"][-1][1]}']
+    for name, key in (('remaining', 'remaining'), ('rate_per_second', 'rate_per_second'),
+                      ('reconnects', 'reconnects'), ('retries', 'retries')):
+        lines += [f'# TYPE ainews_send_{name} gauge', f'ainews_send_{name}{{{shard}}} {data[key]}']
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_files(directory: Path, shard: str = '1/1') -> tuple[Path, Path]:
+    """The JSON and Prometheus file for shard: send_metrics.json/.prom, or send_metrics_2of4.json/.prom
+    for shard 2/4, so the workers of a sharded send don't overwrite each other's metrics."""
+    name = 'send_metrics' if shard == '1/1' else f'send_metrics_{shard.replace("/", "of")}'
+    return directory / f'{name}.json', directory / f'{name}.prom'
+
+
+def _write_atomic(path: Path, content: str) -> None:
+    tmp = path.with_name(path.name + '.tmp')
+    tmp.write_text(content, encoding='utf-8')
+    os.replace(tmp, path)
+
+
+def write_metrics(stats, limiter=None, directory: Path | None = None) -> dict:
+    directory = Path(directory or METRICS_DIR)
+    directory.mkdir(parents=True, exist_ok=True)
+    data = snapshot(stats, limiter)
+    json_file, prom_file = metrics_files(directory, data['shard'])
+    _write_atomic(json_file, json.dumps(data, indent=2))
+    _write_atomic(prom_file, prometheus_text(data))
+    return data
+
+
+class MetricsReporter:
+    """Context manager that writes the metrics of stats every interval seconds, and once more at the end."""
+
+    def __init__(self, stats, limiter=None, interval: float | None = None, directory: Path | None = None):
+        self.stats = stats
+        self.limiter = limiter
+        self.interval = interval or METRICS_INTERVAL
+        self.directory = directory
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='send-metrics', daemon=True)
+
+    def _report(self) -> None:
+        try:
+            data = write_metrics(self.stats, self.limiter, self.directory)
+        except OSError as e:
+            lg.warning(f'Could not write send metrics: {e}')
+            return
+        if not data['finished']:
+            eta = f"{data['eta_seconds'] / 60:.0f} min" if data['eta_seconds'] is not None else '?'
+            lg.info(f"Send progress: {data['sent'] + data['failed']}/{data['total']} "
+                    f"({data['failed']} failed), {data['rate_per_second']:.2f} msg/s, ETA {eta}")
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self._report()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self._report()
@@ -0,0 +1,60 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """Thread-safe token bucket: `rate` tokens per second, holding at most `capacity`.
+
+    The level may go negative through `adjust` when a call turned out to cost more than
+    was reserved; new takes then wait until the debt is paid off.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, n: float = 1) -> float:
+        """Seconds until n tokens are available (0 if available now)."""
+        with self._lock:
+            self._refill()
+            n = min(n, self.capacity)
+            return 0.0 if self.tokens >= n else (n - self.tokens) / self.rate
+
+    def take(self, n: float = 1) -> None:
+        with self._lock:
+            self._refill()
+            self.tokens -= min(n, self.capacity)
+
+    def try_take(self, n: float = 1) -> float:
+        """Take n tokens if available and return 0, else return the seconds to wait."""
+        with self._lock:
+            self._refill()
+            n = min(n, self.capacity)
+            if self.tokens >= n:
+                self.tokens -= n
+                return 0.0
+            return (n - self.tokens) / self.rate
+
+    def acquire(self, n: float = 1) -> None:
+        """Block until n tokens could be taken."""
+        while (wait := self.try_take(n)) > 0:
+            time.sleep(wait)
+
+    def adjust(self, n: float) -> None:
+        """Charge (n > 0) or refund (n < 0) tokens after the fact."""
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens - n)
+
+    def drain(self) -> None:
+        with self._lock:
+            self.tokens = 0
+            self.updated = time.monotonic()
@@ -1,10 +1,21 @@
+import hashlib
+import json
+import mimetypes
 import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
 
 import boto3
 import requests
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
 from PIL import Image
 from io import BytesIO
 
+from justlog import lg
+
 """
 Use the AWS Command-Line Interface (CLI) aws configure command to store your credentials in a file, 
 which will be automatically used by your code.
@@ -35,30 +46,160 @@ class S3ImagesUploadFailed(Exception):
     pass
 
 
+# Streams are uploaded in parts of this size, so memory use is bounded by chunksize * max_concurrency
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024, multipart_chunksize=8 * 1024 * 1024,
+                                 max_concurrency=4)
+
+# Content-hashed keys never change content, so every cache may keep them for good
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+HASH_LENGTH = 16
+
+MANIFEST_FILE = Path(__file__).parent.parent / 'data' / 's3_manifest.json'
+MANIFEST_TTL = 24 * 3600  # Seconds before a cached key is checked against the bucket again
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def shared_client(region_name='eu-west-1'):
+    """ Returns a process-wide boto3 S3 client for region_name, created on first use.
+    boto3 clients are thread-safe and slow to create, so they are shared."""
+    with _clients_lock:
+        if region_name not in _clients:
+            _clients[region_name] = boto3.client('s3', region_name=region_name)
+        return _clients[region_name]
+
+
+def _not_found(e: ClientError) -> bool:
+    return e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+
+def _pil_format(key):
+    ext = os.path.splitext(key)[-1].strip('.').upper()
+    if ext in ['JPG', 'JPEG']:
+        return 'JPEG'
+    elif ext in ['PNG']:
+        return 'PNG'
+    elif ext in ['WEBP']:
+        return 'WEBP'
+    raise S3ImagesInvalidExtension('Extension is invalid')
+
+
+class KeyManifest:
+    """ Local cache of known bucket keys and their metadata, persisted as json.
+    Entries expire after ttl seconds and are invalidated whenever this process writes the key."""
+
+    def __init__(self, path=MANIFEST_FILE, ttl=MANIFEST_TTL):
+        self.path = Path(path)
+        self.ttl = ttl
+        self._entries = None
+        self._lock = threading.Lock()
+
+    def _load(self) -> dict:
+        if self._entries is None:
+            try:
+                with open(self.path, 'r') as f:
+                    self._entries = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                self._entries = {}
+        return self._entries
+
+    def _save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'w') as f:
+            json.dump(self._entries, f)
+
+    def get(self, bucket_name, object_name) -> dict | None:
+        """ Returns the cached metadata of a key if it is known and fresh."""
+        with self._lock:
+            entry = self._load().get(bucket_name, {}).get(object_name)
+            if entry and time.time() - entry['checked'] < self.ttl:
+                return entry
+            return None
+
+    def put_many(self, bucket_name, entries: dict[str, dict]):
+        now = time.time()
+        with self._lock:
+            bucket = self._load().setdefault(bucket_name, {})
+            for object_name, meta in entries.items():
+                bucket[object_name] = {**meta, 'checked': now}
+            self._save()
+
+    def put(self, bucket_name, object_name, meta: dict):
+        self.put_many(bucket_name, {object_name: meta})
+
+    def invalidate(self, bucket_name, object_name):
+        with self._lock:
+            if self._load().get(bucket_name, {}).pop(object_name, None) is not None:
+                self._save()
+
+
+_manifest = None
+_manifest_lock = threading.Lock()
+
+
+def key_manifest() -> KeyManifest:
+    """ Returns the process-wide KeyManifest."""
+    global _manifest
+    with _manifest_lock:
+        if _manifest is None:
+            _manifest = KeyManifest()
+        return _manifest
+
+
+class _EncoderOutput:
+    """Read end of the pipe from an encoder thread. At end of file it raises the encoder's error instead
+    of returning b'', so a failed encode aborts the upload instead of storing a truncated image."""
+
+    def __init__(self, reader, encoder: threading.Thread, errors: list, object_name: str):
+        self.reader = reader
+        self.encoder = encoder
+        self.errors = errors
+        self.object_name = object_name
+
+    def read(self, size=-1):
+        data = self.reader.read(size)
+        if not data and size != 0:
+            self.encoder.join()
+            if self.errors:
+                raise S3ImagesUploadFailed(f'Failed to encode image {self.object_name}') from self.errors[0]
+        return data
+
+
 class S3:
-    def __init__(self, bucket_name, region_name='eu-west-1'):
-        self.client = boto3.client('s3', region_name=region_name)
+    def __init__(self, bucket_name, region_name='eu-west-1', manifest: KeyManifest | None = None):
+        self.client = shared_client(region_name)
         self.bucket_name = bucket_name
+        self.manifest = manifest or key_manifest()
 
-    def add(self, file_path, object_name=None):
+    def add(self, file_path, object_name=None, extra_args=None):
         if not object_name:
             object_name = file_path
-        self.client.upload_file(file_path, self.bucket_name, object_name)
+        self.client.upload_file(file_path, self.bucket_name, object_name, ExtraArgs=extra_args)
+        self.manifest.invalidate(self.bucket_name, object_name)
         return self.url(object_name)
 
     def add_from_url(self, url, object_name):
         """ Add an image from a url to the bucket, with name object_name"""
-        response = requests.get(url)
-        if response.status_code == 200:
-            self.client.put_object(Bucket=self.bucket_name, Key=object_name, Body=response.content)
-            return self.url(object_name)
-        else:
-            raise S3ImagesUploadFailed(f'Failed to get image from {url}')
+        return self.stream_from_url(url, object_name)
+
+    def stream_from_url(self, url, object_name):
+        """ Pipe the body of url straight into a (multipart) upload, without loading it in memory"""
+        with requests.get(url, stream=True, timeout=30) as response:
+            if response.status_code != 200:
+                raise S3ImagesUploadFailed(f'Failed to get image from {url}')
+            response.raw.decode_content = True
+            extra_args = {'ContentType': response.headers['Content-Type']} if 'Content-Type' in response.headers else None
+            self.client.upload_fileobj(response.raw, self.bucket_name, object_name,
+                                       ExtraArgs=extra_args, Config=TRANSFER_CONFIG)
+        self.manifest.invalidate(self.bucket_name, object_name)
+        return self.url(object_name)
 
     def add_from_file_data(self, data, object_name, mime_type=None):
         """ Add an image from a url to the bucket, with name object_name"""
         print('S3 ADD FROM FILE DATA', object_name, mime_type)
         self.client.put_object(Bucket=self.bucket_name, Key=object_name, Body=data, ContentType=mime_type)
+        self.manifest.invalidate(self.bucket_name, object_name)
         return self.url(object_name)
 
     def get_data(self, object_name):
@@ -66,22 +207,33 @@ class S3:
         return self.client.get_object(Bucket=self.bucket_name, Key=object_name)['Body'].read()
 
     def add_from_pil_image(self, image: Image, object_name: str):
-        def get_safe_ext(key):
-            ext = os.path.splitext(key)[-1].strip('.').upper()
-            if ext in ['JPG', 'JPEG']:
-                return 'JPEG'
-            elif ext in ['PNG']:
-                return 'PNG'
-            elif ext in ['WEBP']:
-                return 'WEBP'
-            raise S3ImagesInvalidExtension('Extension is invalid')
-
-        buffer = BytesIO()
-        image.image.save(buffer, get_safe_ext(object_name))
-        buffer.seek(0)
-        sent_data = self.client.put_object(Bucket=self.bucket_name, Key=object_name, Body=buffer)
-        if sent_data['ResponseMetadata']['HTTPStatusCode'] != 200:
-            raise S3ImagesUploadFailed('Failed to upload image {} to bucket {}'.format(object_name, self.bucket_name))
+        return self.stream_from_pil_image(image, object_name)
+
+    def stream_from_pil_image(self, image: Image, object_name: str):
+        """ Encode image in the format given by the extension of object_name and pipe the encoder
+        output straight into a (multipart) upload, without buffering the whole file"""
+        image = getattr(image, 'image', image)  # Also accept wrappers that hold the PIL image in .image
+        fmt = _pil_format(object_name)
+        read_fd, write_fd = os.pipe()
+        errors = []
+
+        def encode():
+            try:
+                with os.fdopen(write_fd, 'wb') as writer:
+                    image.save(writer, fmt)
+            except Exception as e:
+                errors.append(e)
+
+        encoder = threading.Thread(target=encode, daemon=True)
+        encoder.start()
+        try:
+            with os.fdopen(read_fd, 'rb') as reader:
+                self.client.upload_fileobj(_EncoderOutput(reader, encoder, errors, object_name), self.bucket_name,
+                                           object_name, ExtraArgs={'ContentType': f'image/{fmt.lower()}'},
+                                           Config=TRANSFER_CONFIG)
+        finally:
+            encoder.join()
+        self.manifest.invalidate(self.bucket_name, object_name)
         return self.url(object_name)
 
     def download(self, object_name, file_path):
@@ -89,16 +241,49 @@ class S3:
 
     def delete(self, object_name):
         response = self.client.delete_object(Bucket=self.bucket_name, Key=object_name)
+        self.manifest.invalidate(self.bucket_name, object_name)
         return response
 
-    def list(self):
-        response = self.client.list_objects_v2(Bucket=self.bucket_name)
-        return [c['Key'] for c in response['Contents']]
+    def list(self, prefix=''):
+        """ Returns all keys starting with prefix, following pagination, and records them in the manifest."""
+        keys = {}
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+            for c in page.get('Contents', []):
+                keys[c['Key']] = {'etag': c['ETag'].strip('"'), 'size': c['Size']}
+        if keys:
+            self.manifest.put_many(self.bucket_name, keys)
+        return list(keys)
 
     def head_object(self, object_name):
         response = self.client.head_object(Bucket=self.bucket_name, Key=object_name)
         return response
 
+    def metadata(self, object_name) -> dict | None:
+        """ Returns etag, size, content type and user metadata of an object, or None if it doesn't exist.
+        Served from the manifest when fresh, otherwise with a single head_object request."""
+        cached = self.manifest.get(self.bucket_name, object_name)
+        if cached and 'metadata' in cached:
+            return cached
+        try:
+            head = self.head_object(object_name)
+        except ClientError as e:
+            if _not_found(e):
+                self.manifest.invalidate(self.bucket_name, object_name)
+                return None
+            raise
+        meta = {'etag': head.get('ETag', '').strip('"'),
+                'size': head.get('ContentLength'),
+                'content_type': head.get('ContentType'),
+                'metadata': head.get('Metadata', {})}
+        self.manifest.put(self.bucket_name, object_name, meta)
+        return meta
+
+    def exists(self, object_name) -> bool:
+        if self.manifest.get(self.bucket_name, object_name):
+            return True
+        return self.metadata(object_name) is not None
+
     def mime_type(self, object_name):
         return self.head_object(object_name)['ContentType']
 
@@ -112,7 +297,7 @@ class S3:
         w, h = size
         name, ext = object_name.rsplit('.', 1)
         sized_name = f'{name}_{w}x{h}.{ext}'
-        if sized_name not in self.list():
+        if not self.exists(sized_name):
             self.create_sized(object_name, sized_name, size)
         return self.url(sized_name)
 
@@ -125,6 +310,95 @@ class S3:
         return self.add_from_pil_image(image, sized_name)
 
 
+def file_digests(file_path) -> tuple[str, str]:
+    """ Returns the (md5, sha256) hex digests of a file."""
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(chunk)
+            sha256.update(chunk)
+    return md5.hexdigest(), sha256.hexdigest()
+
+
+def hashed_name(file_path, sha256: str, prefix='') -> str:
+    """ Content-addressed key for a file: <prefix><stem>-<hash><suffix>"""
+    path = Path(file_path)
+    return f'{prefix}{path.stem}-{sha256[:HASH_LENGTH]}{path.suffix}'
+
+
+class UploadManager:
+    """ Uploads files to a bucket on a small thread pool, sharing one client.
+    submit() and submit_hashed() return a Future that resolves to the public url. Uploads whose
+    content is already in the bucket under the same key (same sha256 metadata or same ETag) are skipped."""
+
+    def __init__(self, bucket_name, region_name='eu-west-1', max_workers=4, attempts=5):
+        self.s3 = S3(bucket_name, region_name)
+        self.max_workers = max_workers
+        self.attempts = attempts
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _pool(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='s3-upload')
+            return self._executor
+
+    def submit(self, file_path, object_name) -> Future:
+        return self._pool().submit(self._upload, str(file_path), object_name)
+
+    def submit_hashed(self, file_path, prefix='') -> Future:
+        """ Upload under a content-hashed key with long-lived immutable cache headers,
+        so reruns never overwrite a key that clients may have cached."""
+        return self._pool().submit(self._upload, str(file_path), None, prefix)
+
+    def is_uploaded(self, object_name, md5, sha256) -> bool:
+        meta = self.s3.metadata(object_name)
+        if meta is None:
+            return False
+        return meta['metadata'].get('sha256') == sha256 or meta['etag'] == md5
+
+    def _upload(self, file_path, object_name=None, prefix='') -> str:
+        md5, sha256 = file_digests(file_path)
+        extra_args = {'Metadata': {'sha256': sha256},
+                      'ContentType': mimetypes.guess_type(file_path)[0] or 'application/octet-stream'}
+        if object_name is None:
+            object_name = hashed_name(file_path, sha256, prefix)
+            extra_args['CacheControl'] = IMMUTABLE_CACHE_CONTROL
+        for attempt in range(self.attempts):
+            try:
+                if self.is_uploaded(object_name, md5, sha256):
+                    lg.info(f'{object_name} already in bucket {self.s3.bucket_name}, skipping upload')
+                    return self.s3.url(object_name)
+                return self.s3.add(file_path, object_name, extra_args=extra_args)
+            except Exception as e:
+                if attempt == self.attempts - 1:
+                    raise S3ImagesUploadFailed(f'Failed to upload {object_name} after {self.attempts} attempts') from e
+                wait_time = 5 * (2 ** attempt)
+                lg.error(f'S3 upload of {object_name} attempt {attempt + 1}/{self.attempts} failed: '
+                         f'{type(e).__name__}: {e}. Retrying in {wait_time}s...')
+                time.sleep(wait_time)
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=wait)
+                self._executor = None
+
+
+_managers = {}
+_managers_lock = threading.Lock()  # Each singleton has its own lock: UploadManager() takes the other two
+
+
+def upload_manager(bucket_name='harmsen.nl') -> UploadManager:
+    """ Returns the process-wide UploadManager for bucket_name."""
+    with _managers_lock:
+        if bucket_name not in _managers:
+            _managers[bucket_name] = UploadManager(bucket_name)
+        return _managers[bucket_name]
+
+
 if __name__ == '__main__':
     s3 = S3('harmsen.nl')
     s3.add('/users/hp/Downloads/retriever.jpg', 'retriever.jpg')
@@ -0,0 +1,156 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from justai.models.basemodel import RatelimitException
+from justlog import lg
+
+from src.ratelimit import TokenBucket
+
+"""
+Shared scheduler for all LLM calls, so concurrent stages don't discover the provider
+limits one 429 at a time.
+
+Every call reserves one request and an estimated number of tokens from its provider's
+requests-per-minute and tokens-per-minute buckets. Waiting calls are served by priority
+class (CRITICAL first) and, within a class, by the stage that has been served least so far,
+so a burst from one stage cannot starve the others. A RatelimitException pauses the whole
+provider for RATELIMIT_PAUSE seconds instead of letting every caller retry on its own.
+"""
+
+CRITICAL = 0  # On the critical path of the run (summary, editor, visual selection)
+NORMAL = 1
+BACKGROUND = 2  # Nice-to-have work like source extraction
+
+# Requests and tokens per minute, overridable with e.g. ANTHROPIC_RPM / ANTHROPIC_TPM
+PROVIDER_LIMITS = {
+    'anthropic': {'rpm': 50, 'tpm': 80_000},
+    'openai': {'rpm': 500, 'tpm': 500_000},
+    'google': {'rpm': 60, 'tpm': 250_000},
+}
+RATELIMIT_PAUSE = 30
+CHARS_PER_TOKEN = 4
+
+
+def provider_for(model_name: str) -> str:
+    if model_name.startswith('claude'):
+        return 'anthropic'
+    if model_name.startswith('gemini'):
+        return 'google'
+    return 'openai'
+
+
+def estimate_tokens(prompt: str, max_tokens: int = 0) -> int:
+    return len(prompt) // CHARS_PER_TOKEN + max_tokens
+
+
+class Scheduler:
+    def __init__(self, limits: dict[str, dict[str, int]] | None = None):
+        limits = limits or PROVIDER_LIMITS
+        self._requests = {}
+        self._tokens = {}
+        for provider, limit in limits.items():
+            rpm = int(os.getenv(f'{provider.upper()}_RPM', limit['rpm']))
+            tpm = int(os.getenv(f'{provider.upper()}_TPM', limit['tpm']))
+            self._requests[provider] = TokenBucket(rpm / 60, rpm)
+            self._tokens[provider] = TokenBucket(tpm / 60, tpm)
+        self._cond = threading.Condition()
+        self._queues = defaultdict(list)  # provider -> heap of (priority, served, seq, ticket)
+        self._served = defaultdict(int)  # (provider, stage) -> calls admitted
+        self._paused_until = defaultdict(float)
+        self._seq = itertools.count()
+
+    def _wait_time(self, provider: str, tokens: int) -> float:
+        return max(self._paused_until[provider] - time.monotonic(),
+                   self._requests[provider].wait_time(1),
+                   self._tokens[provider].wait_time(tokens))
+
+    def acquire(self, provider: str, tokens: int, priority: int = NORMAL, stage: str = '') -> None:
+        """Block until this call is first in line for provider and the budgets allow it."""
+        with self._cond:
+            ticket = object()
+            queue = self._queues[provider]
+            heapq.heappush(queue, (priority, self._served[(provider, stage)], next(self._seq), ticket))
+            while True:
+                if queue[0][3] is ticket:
+                    wait = self._wait_time(provider, tokens)
+                    if wait <= 0:
+                        heapq.heappop(queue)
+                        self._requests[provider].take(1)
+                        self._tokens[provider].take(tokens)
+                        self._served[(provider, stage)] += 1
+                        self._cond.notify_all()
+                        return
+                    self._cond.wait(wait)
+                else:
+                    self._cond.wait()
+
+    def settle(self, provider: str, reserved: int, used: int) -> None:
+        """Correct the token budget once the real usage of a call is known."""
+        if used:
+            self._tokens[provider].adjust(used - reserved)
+
+    def pause(self, provider: str, seconds: float = RATELIMIT_PAUSE) -> None:
+        """Hold back all calls to provider after it signalled a rate limit."""
+        with self._cond:
+            self._paused_until[provider] = max(self._paused_until[provider], time.monotonic() + seconds)
+            self._requests[provider].drain()
+            self._cond.notify_all()
+        lg.warning(f'Rate limited by {provider}, pausing all {provider} calls for {seconds}s')
+
+    @contextmanager
+    def slot(self, model_name: str, tokens: int, priority: int = NORMAL, stage: str = ''):
+        provider = provider_for(model_name)
+        self.acquire(provider, tokens, priority, stage)
+        try:
+            yield
+        except RatelimitException:
+            self.pause(provider)
+            raise
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> Scheduler:
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = Scheduler()
+        return _scheduler
+
+
+class ScheduledModel:
+    """Wraps a justai Model so that prompt() and generate_image() go through the scheduler.
+    Everything else is passed through to the wrapped model."""
+
+    def __init__(self, model, model_name: str, priority: int = NORMAL, stage: str = '', max_tokens: int = 0):
+        self._model = model
+        self._model_name = model_name
+        self._priority = priority
+        self._stage = stage
+        self._max_tokens = max_tokens
+
+    def prompt(self, prompt: str, *args, **kwargs):
+        scheduler = get_scheduler()
+        tokens = estimate_tokens(prompt, self._max_tokens)
+        with scheduler.slot(self._model_name, tokens, self._priority, self._stage):
+            result = self._model.prompt(prompt, *args, **kwargs)
+        try:
+            used = self._model.last_token_count()[2]
+            scheduler.settle(provider_for(self._model_name), tokens, int(used))
+        except (AttributeError, TypeError, ValueError, IndexError):
+            pass
+        return result
+
+    def generate_image(self, prompt: str, *args, **kwargs):
+        with get_scheduler().slot(self._model_name, estimate_tokens(prompt), self._priority, self._stage):
+            return self._model.generate_image(prompt, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._model, name)
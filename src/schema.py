@@ -0,0 +1,169 @@
+import argparse
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+from justlog import lg
+from sqlalchemy import (DDL, Column, Date, DateTime, ForeignKey, Index, Integer, MetaData, String, Table, Text, create_engine,
+                        event, func, literal_column, select)
+
+"""
+Explicit definitions of the database tables this project reads and writes, and the indexes
+its hot queries need.
+
+The newsletter and subscriber tables are created and owned by the website (Django app
+'nieuwsbrief'); only the columns used here are declared, so queries don't need runtime
+reflection. The article history tables belong to this project. migrate() creates what doesn't
+exist yet:
+
+- nieuwsbrief_subscriber (status, email): get_subscribers / iter_subscribers, index-only
+- nieuwsbrief_subscriber (email): bounce handling and status lookups
+- nieuwsbrief_newsletter (schedule, sent): add_to_database / get_newsletter, queried with a
+  range on sent (see database.day_range) instead of date(sent) = ..., which no index can serve
+- nieuwsbrief_article with (schedule, day) for the last issues, and on PostgreSQL a GIN index on
+  the Dutch tsvector of title and summary for topic searches
+- nieuwsbrief_article_link with (url) for "has this link appeared before"
+
+    python -m src.schema migrate
+    python -m src.schema backfill
+    python -m src.schema benchmark --rows 200000
+"""
+
+metadata = MetaData()
+
+newsletter_table = Table(
+    'nieuwsbrief_newsletter', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('schedule', String(10), nullable=False),
+    Column('title', String(255)),
+    Column('sent', DateTime(timezone=True), nullable=False),
+    Column('text', Text),
+    Column('image_url', String(500)),
+    Index('nieuwsbrief_newsletter_schedule_sent_idx', 'schedule', 'sent'),
+)
+
+subscriber_table = Table(
+    'nieuwsbrief_subscriber', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('email', String(254)),
+    Column('status', String(20)),
+    Column('updated_at', DateTime(timezone=True)),
+    Index('nieuwsbrief_subscriber_status_email_idx', 'status', 'email'),
+    Index('nieuwsbrief_subscriber_email_idx', 'email'),
+)
+
+article_table = Table(
+    'nieuwsbrief_article', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('schedule', String(10), nullable=False),
+    Column('day', Date, nullable=False),
+    Column('position', Integer, nullable=False),
+    Column('title', Text, nullable=False),
+    Column('summary', Text, nullable=False),
+    Index('nieuwsbrief_article_schedule_day_idx', 'schedule', 'day'),
+)
+
+article_link_table = Table(
+    'nieuwsbrief_article_link', metadata,
+    Column('article_id', Integer, ForeignKey('nieuwsbrief_article.id', ondelete='CASCADE'), primary_key=True),
+    Column('url', Text, primary_key=True),
+    Index('nieuwsbrief_article_link_url_idx', 'url'),
+)
+
+# Full-text index, PostgreSQL only. Queries must use article_search, the same expression, to use it.
+SEARCH_INDEX = 'nieuwsbrief_article_search_idx'
+article_search = func.to_tsvector(literal_column("'dutch'::regconfig"),
+                                  article_table.c.title + literal_column("' '") + article_table.c.summary)
+search_index_ddl = DDL(f"CREATE INDEX IF NOT EXISTS {SEARCH_INDEX} ON nieuwsbrief_article "
+                       f"USING gin (to_tsvector('dutch'::regconfig, title || ' ' || summary))")
+event.listen(article_table, 'after_create', search_index_ddl.execute_if(dialect='postgresql'))
+ARTICLE_TABLES = [article_table, article_link_table]
+
+
+def migrate(engine) -> list[str]:
+    """Create the missing article tables and indexes. Returns the names of the indexes created."""
+    metadata.create_all(engine, tables=ARTICLE_TABLES, checkfirst=True)
+    created = []
+    for table in metadata.sorted_tables:
+        with engine.begin() as conn:
+            existing = {i['name'] for i in engine.dialect.get_indexes(conn, table.name)}
+            for index in sorted(table.indexes, key=lambda i: i.name):
+                if index.name not in existing:
+                    index.create(conn)
+                    created.append(index.name)
+            if table is article_table and engine.dialect.name == 'postgresql' and SEARCH_INDEX not in existing:
+                conn.execute(search_index_ddl)
+                created.append(SEARCH_INDEX)
+    for name in created:
+        lg.info(f'Created index {name}')
+    return created
+
+
+def _seed(engine, rows: int) -> None:
+    """Fill fresh tables, without the indexes, with rows subscribers and a newsletter per schedule per day."""
+    metadata.create_all(engine)
+    rng = random.Random(1)
+    statuses = ['daily'] * 6 + ['weekly'] * 2 + ['unsubscribed', 'undeliverable']
+    with engine.begin() as conn:
+        for table in metadata.sorted_tables:
+            for index in table.indexes:
+                index.drop(conn)
+        conn.execute(subscriber_table.insert(), [
+            {'email': f'lezer{i}@example{i % 500}.com', 'status': rng.choice(statuses)} for i in range(rows)])
+        start = datetime(2015, 1, 1, 7, tzinfo=timezone.utc)
+        conn.execute(newsletter_table.insert(), [
+            {'schedule': schedule, 'title': f'{schedule} {d}', 'sent': start + timedelta(days=d), 'text': 'x' * 200}
+            for d in range(rows // 20) for schedule in ('daily', 'weekly')])
+
+
+def _time(engine, query, repeat: int) -> float:
+    with engine.connect() as conn:
+        conn.execute(query).fetchall()  # warm up
+        started = time.perf_counter()
+        for _ in range(repeat):
+            conn.execute(query).fetchall()
+    return (time.perf_counter() - started) / repeat
+
+
+def benchmark(url: str | None = None, rows: int = 200_000, repeat: int = 20) -> None:
+    """Time the hot queries on a seeded table, before and after migrate()."""
+    from src.database import day_range
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(url or f'sqlite:///{tmp}/benchmark.db')
+        _seed(engine, rows)
+        day = (datetime(2015, 1, 1) + timedelta(days=rows // 40)).date()
+        start, end = day_range(day)
+        n, s = newsletter_table.c, subscriber_table.c
+        queries = {
+            'subscribers by status': select(s.email).where(s.status == 'daily', s.email.isnot(None)),
+            'subscriber by email': select(s.status, s.updated_at).where(s.email == f'lezer{rows // 2}@example0.com'),
+            'newsletter by date(sent)': select(n.title).where(n.schedule == 'daily', func.date(n.sent) == day),
+            'newsletter by sent range': select(n.title).where(n.schedule == 'daily', n.sent >= start, n.sent < end),
+        }
+        before = {name: _time(engine, query, repeat) for name, query in queries.items()}
+        migrate(engine)
+        after = {name: _time(engine, query, repeat) for name, query in queries.items()}
+        engine.dispose()
+
+    print(f'{rows} subscribers, {rows // 10} newsletters ({engine.dialect.name})')
+    for name in queries:
+        print(f'{name:28} {before[name] * 1000:8.2f} ms -> {after[name] * 1000:8.2f} ms with indexes')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Database indexes for the newsletter tables')
+    parser.add_argument('command', choices=('migrate', 'backfill', 'benchmark'))
+    parser.add_argument('--rows', type=int, default=200_000, help='benchmark: number of subscribers to seed')
+    parser.add_argument('--url', help='benchmark: empty database to seed (default: a temporary SQLite file)')
+    args = parser.parse_args()
+    if args.command in ('migrate', 'backfill'):
+        from dotenv import load_dotenv
+        from src.database import backfill_articles, get_engine
+        load_dotenv()
+        print(migrate(get_engine()) or 'All indexes exist')
+        if args.command == 'backfill':
+            print(f'Imported {backfill_articles()} issues from the cache')
+    else:
+        benchmark(args.url, args.rows)
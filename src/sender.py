@@ -0,0 +1,401 @@
+import heapq
+import os
+import re
+import threading
+import time
+from collections import Counter, deque
+from datetime import date
+from pathlib import Path
+from typing import Callable, ContextManager, Iterable
+
+from justlog import lg
+
+from src.metrics import MetricsReporter
+from src.ratelimit import TokenBucket
+
+"""
+Concurrent newsletter sending.
+
+SMTP_CONNECTIONS worker threads each hold their own authenticated SMTP session and pull
+recipients from a shared queue. All workers share one SendLimiter, set to the provider's
+real quotas, so the pace is the quota itself instead of fixed sleeps.
+
+Recipients are handed out by a DomainScheduler: round-robin over destination domains, with
+at most DOMAIN_CONCURRENCY messages in flight per domain and a per-domain rate that is
+adjusted AIMD-style: it grows by DOMAIN_RATE_STEP after every accepted message and halves when
+the domain defers one with a 4xx. Deferred recipients go back in the queue after a delay.
+"""
+
+# Quotas of the SMTP provider, overridable from the environment
+SMTP_CONNECTIONS = int(os.getenv('SMTP_CONNECTIONS', '4'))
+SMTP_MAX_PER_SECOND = float(os.getenv('SMTP_MAX_PER_SECOND', '5'))
+SMTP_MAX_PER_MINUTE = float(os.getenv('SMTP_MAX_PER_MINUTE', '120'))
+SMTP_MAX_PER_DAY = float(os.getenv('SMTP_MAX_PER_DAY', '2000'))
+
+# Limits per destination domain
+DOMAIN_CONCURRENCY = 2
+DOMAIN_RATE = 2.0  # messages per second to start with
+DOMAIN_MIN_RATE = 0.05
+DOMAIN_MAX_RATE = 10.0
+DOMAIN_RATE_STEP = 0.1  # added per accepted message
+DEFER_RETRIES = 3
+DEFER_DELAY = 30  # seconds before the first retry of a deferred recipient, doubled per retry
+FEED_LIMIT = 1000  # recipients read (and claimed) ahead of the workers when recipients is a stream
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+class Deferred(Exception):
+    """Raised by send_one when the receiving server defers a message with a 4xx."""
+    pass
+
+
+class SendLimiter:
+    """Token buckets for the per-second and per-minute quota plus a count of today's sends for the
+    daily quota. The daily quota is a hard limit per calendar day, not a bucket that refills."""
+
+    def __init__(self, per_second: float = SMTP_MAX_PER_SECOND, per_minute: float = SMTP_MAX_PER_MINUTE,
+                 per_day: float = SMTP_MAX_PER_DAY, already_sent_today: int = 0):
+        self.per_second = per_second
+        self.per_minute = per_minute
+        self.per_day = per_day
+        self.day = date.today()
+        self.sent_today = already_sent_today
+        self.buckets = [TokenBucket(per_second, max(per_second, 1)), TokenBucket(per_minute / 60, per_minute)]
+        self._lock = threading.Lock()
+
+    def acquire(self, max_wait: float = 3600) -> None:
+        """Block until a message may be sent. Raises QuotaExceeded as soon as today's sends reach the
+        daily quota, or if the other quotas would make us wait longer than max_wait seconds."""
+        while True:
+            with self._lock:
+                if (today := date.today()) != self.day:
+                    self.day, self.sent_today = today, 0
+                if self.sent_today >= self.per_day:
+                    raise QuotaExceeded(f'Daily send quota of {self.per_day:g} messages reached')
+                wait = max(bucket.wait_time(1) for bucket in self.buckets)
+                if wait <= 0:
+                    for bucket in self.buckets:
+                        bucket.take(1)
+                    self.sent_today += 1
+                    return
+            if wait > max_wait:
+                raise QuotaExceeded(f'Send quota exhausted, next slot in {wait / 3600:.1f} hours')
+            time.sleep(min(wait, 1))
+
+
+class SendStats:
+    """Counters of a send run, per-message send latencies and SMTP response codes. shard is the
+    'i/n' of a sharded send, for the metrics."""
+
+    def __init__(self, shard: str = '1/1'):
+        self.shard = shard
+        self.sent = 0
+        self.failed = 0
+        self.total = 0
+        self.latencies = []
+        self.codes = Counter()
+        self.connects = 0
+        self.reconnects = 0
+        self.retries = 0
+        self.deferrals = 0
+        self.started = time.monotonic()
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def record(self, ok: bool) -> None:
+        with self._lock:
+            if ok:
+                self.sent += 1
+            else:
+                self.failed += 1
+
+    def observe(self, latency: float, code: str) -> None:
+        """Record the duration and SMTP reply code of one send attempt."""
+        with self._lock:
+            self.latencies.append(latency)
+            self.codes[code] += 1
+
+    def latency_percentile(self, p: float) -> float:
+        with self._lock:
+            latencies = sorted(self.latencies)
+        return latencies[min(int(len(latencies) * p / 100), len(latencies) - 1)] if latencies else 0.0
+
+    @property
+    def remaining(self) -> int:
+        return max(self.total - self.sent - self.failed, 0)
+
+    @property
+    def eta(self) -> float | None:
+        """Seconds until all recipients are done at the current rate."""
+        done = self.sent + self.failed
+        return self.remaining * self.elapsed / done if done else None
+
+    def count(self, counter: str) -> None:
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def rate(self) -> float:
+        return self.sent / self.elapsed if self.elapsed else 0.0
+
+    def summary(self) -> str:
+        return (f'{self.sent} sent, {self.failed} failed in {self.elapsed:.0f}s '
+                f'({self.rate:.2f} msg/s, {self.rate * 60:.0f} msg/min), '
+                f'{self.connects} connections, {self.reconnects} reconnects, {self.retries} retries, '
+                f'{self.deferrals} deferrals')
+
+    def report(self, limiter: 'SendLimiter | None' = None) -> str:
+        """Final summary: latency percentiles, responses by code and the rate against the quota."""
+        errors = {code: n for code, n in sorted(self.codes.items()) if not code.startswith('2')}
+        lines = [self.summary(),
+                 f'Send latency p50 {self.latency_percentile(50) * 1000:.0f} ms, '
+                 f'p95 {self.latency_percentile(95) * 1000:.0f} ms, max {self.latency_percentile(100) * 1000:.0f} ms',
+                 f'Errors by SMTP code: {errors or "none"}']
+        if limiter:
+            lines.append(f'Rate {self.rate:.2f} msg/s = {100 * self.rate / limiter.per_second:.0f}% of the '
+                         f'{limiter.per_second:g}/s quota, {self.rate * 60:.0f} msg/min = '
+                         f'{100 * self.rate * 60 / limiter.per_minute:.0f}% of the {limiter.per_minute:g}/min quota')
+        return '\n'.join(lines)
+
+
+def response_code(e: Exception) -> str:
+    """The SMTP reply code in an exception from send_one, or the exception's class name."""
+    if code := getattr(e, 'smtp_code', None):
+        return str(code)
+    if match := re.search(r'\b([2-5]\d\d)\b', str(e)):
+        return match.group(1)
+    return type(e).__name__
+
+
+def domain_of(recipient: str) -> str:
+    return recipient.rpartition('@')[2].lower()
+
+
+class DomainState:
+    def __init__(self, rate: float):
+        self.todo = deque()
+        self.in_flight = 0
+        self.rate = rate
+        self.next_at = 0.0
+
+
+class DomainScheduler:
+    """Hands out recipients round-robin over their domains, within each domain's limits. rate,
+    max_rate and defer_delay default to DOMAIN_RATE, DOMAIN_MAX_RATE and DEFER_DELAY."""
+
+    def __init__(self, recipients: Iterable[str] = (), more_to_come: bool = False, rate: float | None = None,
+                 max_rate: float | None = None, defer_delay: float | None = None):
+        self.rate = rate or DOMAIN_RATE
+        self.max_rate = max_rate or DOMAIN_MAX_RATE
+        self.defer_delay = DEFER_DELAY if defer_delay is None else defer_delay
+        self.domains = {}
+        self.rotation = deque()
+        self.deferred = []  # heap of (ready_at, seq, recipient, tries)
+        self.tries = {}
+        self.seq = 0
+        self.closed = False
+        self.more_to_come = more_to_come
+        self._cond = threading.Condition()
+        self.add(recipients)
+
+    def add(self, recipients: Iterable[str]) -> None:
+        """Add recipients, also while workers are already sending."""
+        with self._cond:
+            for recipient in recipients:
+                domain = domain_of(recipient)
+                if domain not in self.domains:
+                    self.domains[domain] = DomainState(self.rate)
+                    self.rotation.append(domain)
+                self.domains[domain].todo.append(recipient)
+            self._cond.notify_all()
+
+    def end_of_input(self) -> None:
+        """No more recipients will be added; next() returns None once all are done."""
+        with self._cond:
+            self.more_to_come = False
+            self._cond.notify_all()
+
+    def wait_for_room(self, limit: int) -> None:
+        """Block until fewer than limit recipients are waiting to be handed out, or the scheduler is closed."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.closed or sum(len(state.todo) for state in self.domains.values()) < limit)
+
+    def remaining(self) -> int:
+        with self._cond:
+            return sum(len(state.todo) + state.in_flight for state in self.domains.values()) + len(self.deferred)
+
+    def next(self) -> str | None:
+        """Block until a recipient may be sent to and return it. None when everything is done."""
+        with self._cond:
+            while not self.closed:
+                now = time.monotonic()
+                while self.deferred and self.deferred[0][0] <= now:
+                    _, _, recipient, _ = heapq.heappop(self.deferred)
+                    self.domains[domain_of(recipient)].todo.appendleft(recipient)
+                wake_at = self.deferred[0][0] if self.deferred else None
+                busy = False
+                for _ in range(len(self.rotation)):
+                    domain = self.rotation[0]
+                    self.rotation.rotate(-1)
+                    state = self.domains[domain]
+                    busy |= state.in_flight > 0
+                    if not state.todo or state.in_flight >= DOMAIN_CONCURRENCY:
+                        continue
+                    if state.next_at > now:
+                        wake_at = min(wake_at or state.next_at, state.next_at)
+                        continue
+                    state.in_flight += 1
+                    state.next_at = now + 1 / state.rate
+                    return state.todo.popleft()
+                if wake_at is None and not busy and not self.more_to_come:
+                    return None
+                self._cond.wait(timeout=max(wake_at - now, 0.01) if wake_at else None)
+            return None
+
+    def done(self, recipient: str, outcome: str) -> bool:
+        """Report the outcome ('sent', 'failed' or 'deferred') for recipient and adjust its domain's
+        rate. Returns True if a deferred recipient was put back in the queue."""
+        with self._cond:
+            state = self.domains[domain_of(recipient)]
+            state.in_flight -= 1
+            requeued = False
+            if outcome == 'deferred':
+                state.rate = max(state.rate / 2, DOMAIN_MIN_RATE)
+                state.next_at = time.monotonic() + 1 / state.rate
+                tries = self.tries[recipient] = self.tries.get(recipient, 0) + 1
+                if tries <= DEFER_RETRIES:
+                    self.seq += 1
+                    ready_at = time.monotonic() + self.defer_delay * 2 ** (tries - 1)
+                    heapq.heappush(self.deferred, (ready_at, self.seq, recipient, tries))
+                    requeued = True
+            elif outcome == 'sent':
+                state.rate = min(state.rate + DOMAIN_RATE_STEP, self.max_rate)
+            self._cond.notify_all()
+            return requeued
+
+    def close(self) -> None:
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+def send_parallel(recipients: list[str] | Iterable[list[str]],
+                  session_factory: Callable[[], ContextManager],
+                  send_one: Callable[[object, str], str | None],
+                  limiter: SendLimiter,
+                  connections: int = SMTP_CONNECTIONS,
+                  stats: SendStats | None = None,
+                  on_deferred: Callable[[str, str], None] | None = None,
+                  scheduler: DomainScheduler | None = None,
+                  metrics_dir: Path | None = None) -> SendStats:
+    """Send to all recipients over `connections` parallel sessions. recipients is a list, or an
+    iterable of lists that is read in a separate thread while the first ones are being sent.
+
+    A stream is read no further than FEED_LIMIT recipients ahead of the workers.
+
+    session_factory() returns a context manager that yields a logged-in session;
+    send_one(session, recipient) sends one message and returns the server's response, raises
+    on failure, or raises Deferred when the message should be tried again later. A recipient that
+    is still deferred after DEFER_RETRIES retries is passed to on_deferred(recipient, response),
+    to be tried again by a later run. scheduler is an empty DomainScheduler with other domain
+    limits than the defaults. Progress and metrics are written every METRICS_INTERVAL seconds to
+    metrics_dir, default METRICS_DIR (see src/metrics.py).
+    """
+    stats = stats or SendStats()
+    stats.started = time.monotonic()
+    scheduler = scheduler or DomainScheduler()
+    if isinstance(recipients, (list, tuple)):
+        scheduler.add(recipients)
+        stats.total = len(recipients)
+        feeder = None
+    else:
+        # A stream of chunks (e.g. from iter_subscribers): start sending while the rest is still being read
+        scheduler.more_to_come = True
+        connections = max(connections, 1)
+
+        def feed():
+            # Backpressure: the next chunk is only pulled from the stream, which is where deliver() claims
+            # it, when the workers are within FEED_LIMIT recipients of running out
+            try:
+                iterator = iter(recipients)
+                while True:
+                    scheduler.wait_for_room(FEED_LIMIT)
+                    if scheduler.closed or (chunk := next(iterator, None)) is None:
+                        break
+                    stats.total += len(chunk)
+                    scheduler.add(chunk)
+            except Exception as e:
+                lg.error(f'Reading recipients failed, sending only to those read so far: {e}')
+            finally:
+                scheduler.end_of_input()
+
+        feeder = threading.Thread(target=feed, name='smtp-feed')
+        feeder.start()
+
+    running = 0
+    running_lock = threading.Lock()
+
+    def worker():
+        nonlocal running
+        try:
+            with session_factory() as session:
+                while (recipient := scheduler.next()) is not None:
+                    try:
+                        limiter.acquire()
+                    except QuotaExceeded as e:
+                        lg.error(f'{e}, stopping. {scheduler.remaining()} recipients left unsent')
+                        scheduler.close()
+                        return
+                    started = time.monotonic()
+                    try:
+                        response = send_one(session, recipient)
+                        stats.observe(time.monotonic() - started, (response or '250')[:3])
+                        scheduler.done(recipient, 'sent')
+                        stats.record(ok=True)
+                    except Deferred as e:
+                        stats.observe(time.monotonic() - started, response_code(e))
+                        stats.count('deferrals')
+                        if scheduler.done(recipient, 'deferred'):
+                            lg.warning(f'Sending to {recipient} deferred ({e}), will retry')
+                        else:
+                            lg.error(f'Sending to {recipient} deferred ({e}), giving up for this run')
+                            stats.record(ok=False)
+                            if on_deferred:
+                                on_deferred(recipient, str(e))
+                    except Exception as e:
+                        stats.observe(time.monotonic() - started, response_code(e))
+                        lg.error(f'Error sending to {recipient}: {e}')
+                        scheduler.done(recipient, 'failed')
+                        stats.record(ok=False)
+        except Exception as e:
+            lg.error(f'SMTP worker stopped: {e}')
+        finally:
+            with running_lock:
+                running -= 1
+                last = running == 0
+            if last:
+                # Nobody is left to send, e.g. because no session could log in: stop the feeder too
+                scheduler.close()
+
+    workers = [threading.Thread(target=worker, name=f'smtp-{i}')
+               for i in range(min(connections, scheduler.remaining()) if feeder is None else connections)]
+    running = len(workers)
+    with MetricsReporter(stats, limiter, directory=metrics_dir):
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        if feeder:
+            feeder.join()
+        if left := scheduler.remaining():
+            lg.error(f'{left} recipients were not sent to')
+        stats.finished = time.monotonic()
+    lg.info(stats.report(limiter))
+    return stats
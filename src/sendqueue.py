@@ -0,0 +1,192 @@
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from justdays import Day
+from justlog import lg
+
+"""
+Persistent send queue for the newsletter.
+
+Every (schedule, day, recipient) is one row in data/sendqueue.db with its status, attempt count,
+retry time, last SMTP response and Message-ID. Recipients are enqueued as pending before sending
+and claimed as 'sending' in one transaction. A sent row is written before the next message goes
+out; failures, which are retried anyway, are buffered and written in batches of FLUSH_ROWS rows
+(or every FLUSH_SECONDS) and always on close(). A run that is interrupted therefore resumes with
+exactly the recipients that are not sent yet. Only a kill during an SMTP transaction can leave a
+recipient in 'sending' that did get the message. A recipient whose server keeps deferring (4xx)
+goes back to pending with a retry time; deferrals don't count towards MAX_ATTEMPTS.
+
+The old data/mailerlog.txt is imported once as sent rows.
+"""
+
+DB_FILE = Path(__file__).parent.parent / 'data' / 'sendqueue.db'
+LEGACY_LOG = Path(__file__).parent.parent / 'data' / 'mailerlog.txt'
+PENDING, SENDING, SENT, FAILED = 'pending', 'sending', 'sent', 'failed'
+MAX_ATTEMPTS = 3
+FLUSH_ROWS = 50
+FLUSH_SECONDS = 5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sends (
+    schedule TEXT NOT NULL,
+    day TEXT NOT NULL,
+    recipient TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    retry_at REAL,
+    smtp_response TEXT,
+    message_id TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (schedule, day, recipient)
+);
+CREATE INDEX IF NOT EXISTS sends_schedule_day_status ON sends (schedule, day, status);
+CREATE INDEX IF NOT EXISTS sends_day_recipient ON sends (day, recipient, status);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+
+class SendQueue:
+    def __init__(self, path: Path = DB_FILE, legacy_log: Path = LEGACY_LOG):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Shared by the SMTP worker threads, serialized by self._lock
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(SCHEMA)
+        self._lock = threading.RLock()
+        self._buffer = []
+        self._last_flush = time.monotonic()
+        self._import_legacy_log(Path(legacy_log))
+
+    def _transaction(self, sql: str, rows: list[tuple]) -> None:
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                self._db.executemany(sql, rows)
+                self._db.execute('COMMIT')
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+
+    def _import_legacy_log(self, log_file: Path) -> None:
+        if self._db.execute("SELECT 1 FROM meta WHERE key = 'mailerlog_imported'").fetchone():
+            return
+        rows = []
+        if log_file.exists():
+            with open(log_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) == 3:
+                        rows.append((*parts, SENT, 1, time.time()))
+        self._transaction('INSERT OR IGNORE INTO sends (schedule, day, recipient, status, attempts, updated_at) '
+                          'VALUES (?, ?, ?, ?, ?, ?)', rows)
+        self._transaction("INSERT INTO meta (key, value) VALUES ('mailerlog_imported', ?)", [(str(time.time()),)])
+        if rows:
+            lg.info(f'Imported {len(rows)} sends from {log_file.name} into the send queue')
+
+    def enqueue(self, schedule: str, day: Day, recipients: list[str]) -> None:
+        """Add recipients as pending; recipients already in the queue for this schedule and day keep their row."""
+        now = time.time()
+        self._transaction('INSERT OR IGNORE INTO sends (schedule, day, recipient, updated_at) VALUES (?, ?, ?, ?)',
+                          [(schedule, str(day), recipient, now) for recipient in recipients])
+
+    def claim(self, schedule: str, day: Day, recipients: list[str] | None = None) -> list[str]:
+        """Mark all recipients that still need this newsletter as 'sending' and return them.
+        That is: pending rows (deferred ones once their retry time has come), rows left in 'sending'
+        by an interrupted run and failed rows that are due for a retry. Recipients that already got a
+        newsletter today (in any schedule) are skipped and marked sent. With recipients, only those are considered (a primary key lookup)."""
+        day, now = str(day), time.time()
+        only = ''
+        if recipients is not None:
+            if not recipients:
+                return []
+            only = f" AND recipient IN ({', '.join('?' * len(recipients))})"
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self._db.execute(
+                    """SELECT recipient, EXISTS (SELECT 1 FROM sends other
+                                                 WHERE other.day = s.day AND other.recipient = s.recipient
+                                                 AND other.status = 'sent')
+                       FROM sends s
+                       WHERE schedule = ? AND day = ?
+                       AND (status = 'sending'
+                            OR (status = 'pending' AND (retry_at IS NULL OR retry_at <= ?))
+                            OR (status = 'failed' AND attempts < ? AND retry_at <= ?))""" + only,
+                    (schedule, day, now, MAX_ATTEMPTS, now, *(recipients or ()))).fetchall()
+                todo = [recipient for recipient, sent_elsewhere in rows if not sent_elsewhere]
+                done = [recipient for recipient, sent_elsewhere in rows if sent_elsewhere]
+                self._db.executemany('UPDATE sends SET status = ?, updated_at = ? '
+                                     'WHERE schedule = ? AND day = ? AND recipient = ?',
+                                     [(SENDING, now, schedule, day, r) for r in todo] +
+                                     [(SENT, now, schedule, day, r) for r in done])
+                self._db.execute('COMMIT')
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+        return todo
+
+    def cancel_pending(self, schedule: str, day: Day) -> int:
+        """Give up on rows that are still pending after all current subscribers were claimed,
+        i.e. recipients of an interrupted run who have unsubscribed since. Deferred rows that are not
+        due yet are left alone."""
+        now = time.time()
+        with self._lock:
+            cursor = self._db.execute("UPDATE sends SET status = ?, attempts = ?, smtp_response = ?, updated_at = ? "
+                                      "WHERE schedule = ? AND day = ? AND status = 'pending' "
+                                      "AND (retry_at IS NULL OR retry_at <= ?)",
+                                      (FAILED, MAX_ATTEMPTS, 'No longer subscribed', now, schedule, str(day), now))
+        return cursor.rowcount
+
+    def mark_sent(self, schedule: str, day: Day, recipient: str, message_id: str, smtp_response: str = '') -> None:
+        """Written at once, together with buffered failures, so a crash can't make the next run send it again."""
+        self._record(schedule, day, recipient, SENT, smtp_response, message_id, None, flush=True)
+
+    def mark_failed(self, schedule: str, day: Day, recipient: str, smtp_response: str, retry_in: float = 600) -> None:
+        self._record(schedule, day, recipient, FAILED, smtp_response, None, time.time() + retry_in)
+
+    def defer(self, schedule: str, day: Day, recipient: str, smtp_response: str, retry_in: float = 600) -> None:
+        """Put a recipient the receiving server deferred (4xx) back to pending from retry_in seconds from
+        now. A deferral is not a failed attempt, so it doesn't count towards MAX_ATTEMPTS."""
+        now = time.time()
+        self._transaction('UPDATE sends SET status = ?, retry_at = ?, smtp_response = ?, updated_at = ? '
+                          'WHERE schedule = ? AND day = ? AND recipient = ?',
+                          [(PENDING, now + retry_in, smtp_response, now, schedule, str(day), recipient)])
+
+    def _record(self, schedule, day, recipient, status, smtp_response, message_id, retry_at, flush=False) -> None:
+        with self._lock:
+            self._buffer.append((status, retry_at, smtp_response, message_id, time.time(), schedule, str(day), recipient))
+            if flush or len(self._buffer) >= FLUSH_ROWS or time.monotonic() - self._last_flush >= FLUSH_SECONDS:
+                self.flush()
+
+    def flush(self) -> None:
+        """Write buffered results in one transaction."""
+        with self._lock:
+            if self._buffer:
+                self._transaction('UPDATE sends SET status = ?, attempts = attempts + 1, retry_at = ?, '
+                                  'smtp_response = ?, message_id = COALESCE(?, message_id), updated_at = ? '
+                                  'WHERE schedule = ? AND day = ? AND recipient = ?', self._buffer)
+                self._buffer = []
+            self._last_flush = time.monotonic()
+
+    def counts(self, schedule: str, day: Day) -> dict[str, int]:
+        """{status: number of recipients} for schedule on day."""
+        return dict(self._db.execute('SELECT status, COUNT(*) FROM sends WHERE schedule = ? AND day = ? GROUP BY status',
+                                     (schedule, str(day))).fetchall())
+
+    def sent_count(self, day: Day) -> int:
+        """Messages sent on day over all schedules, for the daily SMTP quota."""
+        return self._db.execute("SELECT COUNT(*) FROM sends WHERE day = ? AND status = 'sent'",
+                                (str(day),)).fetchone()[0]
+
+    def is_complete(self, schedule: str, day: Day) -> bool:
+        """True if schedule was sent on day and nothing is left pending or half-sent."""
+        counts = self.counts(schedule, day)
+        return counts.get(SENT, 0) > 0 and not counts.get(PENDING) and not counts.get(SENDING)
+
+    def close(self) -> None:
+        self.flush()
+        self._db.close()
@@ -1,35 +1,33 @@
-import os
 import traceback
-from typing import List
+from typing import Iterator, List
 from contextlib import contextmanager
-from sqlalchemy import create_engine, MetaData, select, update
+from sqlalchemy import String, Table, any_, bindparam, select, update
+from sqlalchemy.dialects.postgresql import ARRAY
 from dotenv import load_dotenv
 
 from justlog import lg
 
+from src.database import get_engine, get_table
+
+
+class _Tables:
+    """tables[name] for db(): reflects each table once per process, see database.get_table."""
+
+    def __getitem__(self, name: str) -> Table:
+        return get_table(name)
+
 
 @contextmanager
 def db():
     """
-    Context manager that provides database connection and metadata tables.
+    Context manager that provides a pooled database connection and the tables.
 
     Usage:
         with db() as (conn, tables):
             # use conn and tables
     """
-    db_url = _normalize_db_url(os.getenv("DATABASE_URL"))
-    if not db_url:
-        raise ValueError("DATABASE_URL environment variable not set or invalid")
-
-    engine = create_engine(db_url)
-    metadata = MetaData()
-    metadata.reflect(bind=engine)
-
-    try:
-        with engine.connect() as conn:
-            yield conn, metadata.tables
-    finally:
-        engine.dispose()
+    with get_engine().connect() as conn:
+        yield conn, _Tables()
 
 
 def get_subscribers(status: str) -> List[str]:
@@ -47,50 +45,80 @@ def get_subscribers(status: str) -> List[str]:
         raise Exception(f"Error getting subscribers: {e}")
 
 
-def get_subscriber_status(email: str) -> dict | None:
-    """Get subscriber status and updated_at timestamp."""
+def iter_subscribers(status: str, chunk_size: int = 1000) -> Iterator[list[str]]:
+    """Yield the subscribers with status in lists of up to chunk_size, read with a server-side
+    cursor, so the caller can start on the first chunk before the rest is read."""
+    with db() as (conn, tables):
+        subscriber_table = tables['nieuwsbrief_subscriber']
+        query = select(subscriber_table.c.email).where(
+            subscriber_table.c.status == status,
+            subscriber_table.c.email.isnot(None)
+        )
+        result = conn.execution_options(stream_results=True, yield_per=chunk_size).execute(query)
+        for partition in result.partitions():
+            if emails := [row[0] for row in partition if row[0]]:
+                yield emails
+
+
+def _email_in(conn, column, emails: list[str]):
+    """column = ANY(:emails) with the list as one array parameter on PostgreSQL, IN (...) elsewhere."""
+    if conn.dialect.name == 'postgresql':
+        return column == any_(bindparam('emails', list(emails), type_=ARRAY(String)))
+    return column.in_(list(emails))
+
+
+def get_subscriber_statuses(emails: list[str]) -> dict[str, dict]:
+    """Status and updated_at for each of emails that is a subscriber, in one query."""
+    if not emails:
+        return {}
     try:
         with db() as (conn, tables):
             t = tables['nieuwsbrief_subscriber']
-            query = select(t.c.status, t.c.updated_at).where(t.c.email == email)
-            row = conn.execute(query).fetchone()
-            if row:
-                return {'status': row[0], 'updated_at': row[1]}
+            query = select(t.c.email, t.c.status, t.c.updated_at).where(_email_in(conn, t.c.email, emails))
+            return {row[0]: {'status': row[1], 'updated_at': row[2]} for row in conn.execute(query)}
     except Exception as e:
-        lg.error(f'Error getting subscriber status for {email}: {e}')
-    return None
+        lg.error(f'Error getting subscriber statuses for {len(emails)} emails: {e}')
+    return {}
 
 
-def update_subscription(email: str, status: str) -> bool:
-    """Update subscriber status. Resets bounce history when re-subscribing."""
+def get_subscriber_status(email: str) -> dict | None:
+    """Get subscriber status and updated_at timestamp."""
+    return get_subscriber_statuses([email]).get(email)
+
+
+def update_subscriptions(emails: list[str], status: str) -> int:
+    """Set status for all emails in one transaction. Resets bounce history of the subscribers that
+    were updated when re-subscribing. Returns the number of subscribers updated."""
+    if not emails:
+        return 0
     try:
         with db() as (conn, tables):
             subscriber_table = tables['nieuwsbrief_subscriber']
 
             with conn.begin():
-                query = update(subscriber_table).where(subscriber_table.c.email == email).values(status=status)
-                result = conn.execute(query)
-                if result.rowcount > 0:
-                    lg.info(f"Updated {email} to status '{status}'")
-                    # Reset bounce history when re-subscribing
-                    if status in ('daily', 'weekly'):
-                        from src.undelivered import reset_undelivered
-                        reset_undelivered(email)
-                    return True
-                else:
-                    lg.error(f"Failed to update status for {email}")
-                    return False
+                query = (update(subscriber_table)
+                         .where(_email_in(conn, subscriber_table.c.email, emails))
+                         .values(status=status)
+                         .returning(subscriber_table.c.email))
+                updated = [row[0] for row in conn.execute(query)]
+        lg.info(f"Updated {len(updated)}/{len(emails)} subscribers to status '{status}'")
+        # Reset bounce history when re-subscribing
+        if updated and status in ('daily', 'weekly'):
+            from src.undelivered import reset_undelivered
+            reset_undelivered(*updated)
+        return len(updated)
 
     except Exception as e:
-        lg.error(f'Error in update_subscription\n{traceback.format_exc()}')
-        return False
+        lg.error(f'Error in update_subscriptions\n{traceback.format_exc()}')
+        return 0
 
 
-def _normalize_db_url(db_url: str) -> str:
-    """Ensure the database URL uses the postgresql:// scheme."""
-    if db_url and db_url.startswith('postgres://'):
-        return 'postgresql://' + db_url[11:]
-    return db_url
+def update_subscription(email: str, status: str) -> bool:
+    """Update subscriber status. Resets bounce history when re-subscribing."""
+    if update_subscriptions([email], status):
+        return True
+    lg.error(f"Failed to update status for {email}")
+    return False
 
 
 if __name__ == "__main__":
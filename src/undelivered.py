@@ -7,8 +7,7 @@ from justdays import Day
 
 from src.gmail import Mail
 from justlog import lg
-from src.mailer import delete_email
-from src.subscribers import update_subscription, get_subscriber_status
+from src.subscribers import update_subscriptions, get_subscriber_statuses
 
 undelivered_file = Path(__file__).parent.parent / 'data' / 'undelivered.json'
 
@@ -46,13 +45,13 @@ def save_undelivered_data(data: dict[str, dict]) -> None:
         json.dump(data, f, indent=2)
 
 
-def reset_undelivered(email: str) -> None:
-    """Remove bounce history for an email address (e.g. on re-subscribe)."""
+def reset_undelivered(*emails: str) -> None:
+    """Remove bounce history for email addresses (e.g. on re-subscribe), with one file rewrite."""
     data = load_undelivered_data()
-    if email in data:
-        del data[email]
+    reset = [email for email in emails if data.pop(email, None) is not None]
+    if reset:
         save_undelivered_data(data)
-        lg.info(f'Reset bounce history for {email}')
+        lg.info(f'Reset bounce history for {", ".join(reset)}')
 
 
 def cleanup_stale_entries(data: dict[str, dict]) -> dict[str, dict]:
@@ -133,29 +132,28 @@ def parse_undelivered_emails(undelivered_emails):
     return emails_to_delete, emails_to_mark_undeliverable
 
 
-def delete_emails(emails_to_delete):
-    deleted_count = 0
-    for email_id in emails_to_delete:
-        if delete_email(email_id, folder='INBOX'):
-            deleted_count += 1
+def delete_emails(mail: Mail, emails_to_delete):
+    deleted_count = mail.delete_emails(emails_to_delete, folder='INBOX')
     lg.info(f'Deleted {deleted_count}/{len(emails_to_delete)} undelivered emails')
 
 
 def mark_undeliverable(emails_to_mark_undeliverable):
-    marked = 0
+    statuses = get_subscriber_statuses(emails_to_mark_undeliverable)
+    data = load_undelivered_data()
+    resubscribed = []
+    undeliverable = []
     for email_address in emails_to_mark_undeliverable:
         # Check if subscriber re-subscribed after their last bounce
-        sub = get_subscriber_status(email_address)
+        sub = statuses.get(email_address)
         if sub and sub['status'] in ('daily', 'weekly') and sub.get('updated_at'):
-            data = load_undelivered_data()
-            entry = data.get(email_address, {})
-            last_bounce = entry.get('last_bounce')
+            last_bounce = data.get(email_address, {}).get('last_bounce')
             if last_bounce and sub['updated_at'].replace(tzinfo=None) > Day(last_bounce).as_datetime():
                 lg.info(f'{email_address} re-subscribed after last bounce, resetting counter')
-                reset_undelivered(email_address)
+                resubscribed.append(email_address)
                 continue
-        update_subscription(email_address, 'undeliverable')
-        marked += 1
+        undeliverable.append(email_address)
+    reset_undelivered(*resubscribed)
+    marked = update_subscriptions(undeliverable, 'undeliverable')
     lg.info(f'{marked} emails marked as undeliverable\n')
 
 
@@ -164,7 +162,7 @@ def handle_undelivered():
     try:
         undelivered_emails = get_undelivered_emails(mail)
         emails_to_delete, emails_to_mark_undeliverable = parse_undelivered_emails(undelivered_emails)
-        delete_emails(emails_to_delete)
+        delete_emails(mail, emails_to_delete)
         mark_undeliverable(emails_to_mark_undeliverable)
     except Exception as e:
         lg.error(f'Error processing undelivered emails - {e}\n')
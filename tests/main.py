@@ -3,6 +3,7 @@ import json
 import os
 import sys
 import tempfile
+from contextlib import contextmanager
 from pathlib import Path
 from unittest.mock import patch, MagicMock
 
@@ -26,9 +27,12 @@ def _sample_articles() -> list[dict]:
     ]
 
 
+@contextmanager
 def _patch_cache_prefix(tmpdir: Path):
-    """Patch cache_file_prefix zodat caches in tmpdir landen."""
-    return patch('src.ai.cache_file_prefix', lambda schedule: str(tmpdir / f'test_{schedule}'))
+    """Patch cache_file_prefix en de circuit breaker state zodat alles in tmpdir landt."""
+    with patch('src.ai.cache_file_prefix', lambda schedule: str(tmpdir / f'test_{schedule}')), \
+            patch('src.circuit.STATE_FILE', tmpdir / 'circuits.json'):
+        yield
 
 
 def test_cache_hit_skips_llm():
@@ -205,6 +209,1169 @@ def test_retry_prompt_uses_exponential_backoff():
     print('  PASS test_retry_prompt_uses_exponential_backoff')
 
 
+def test_hedge_threshold_from_history():
+    """Drempel is het percentiel van de opgeslagen latencies, met default bij te weinig historie."""
+    from src import hedge
+
+    with tempfile.TemporaryDirectory() as tmp:
+        with patch('src.hedge.HISTORY_FILE', Path(tmp) / 'latency.json'):
+            assert hedge.hedge_threshold('model') == hedge.DEFAULT_THRESHOLD
+            for seconds in range(11, 31):
+                hedge.record_latency('model', seconds)
+            assert hedge.hedge_threshold('model') == 28, hedge.hedge_threshold('model')
+            # Calls that hung or failed are slower than their censored time, so they raise the threshold
+            for _ in range(10):
+                hedge.record_latency('model', 60, censored=True)
+            assert hedge.hedge_threshold('model') == 60, hedge.hedge_threshold('model')
+    assert hedge.percentile([10, 20, {'censored': 15}, 30], 50) == 20
+    print('  PASS test_hedge_threshold_from_history')
+
+
+def test_hedged_call_takes_fastest_response():
+    """Als het eerste request blijft hangen wint het gehedgede request."""
+    import threading
+    from src import hedge
+
+    release = threading.Event()
+    calls = []
+
+    def slow_then_fast():
+        calls.append(1)
+        if len(calls) == 1:
+            release.wait(5)
+            return 'slow'
+        return 'fast'
+
+    with tempfile.TemporaryDirectory() as tmp:
+        with patch('src.hedge.HISTORY_FILE', Path(tmp) / 'latency.json'), \
+                patch('src.hedge.hedge_threshold', return_value=0.05), \
+                patch('src.hedge._hedges_used', 0):
+            result = hedge.hedged_call('model', slow_then_fast)
+            assert result == 'fast', result
+            assert len(calls) == 2
+            # The winner's time counts from the original request; the hung original is censored
+            won, hung = hedge.load_history()['model']
+            assert won >= 0.05 and hung == {'censored': won}, (won, hung)
+    release.set()
+    print('  PASS test_hedged_call_takes_fastest_response')
+
+
+def test_circuit_opens_after_repeated_failures():
+    """Na MIN_CALLS mislukkingen staat het circuit open; een geslaagde probe sluit het weer."""
+    from src import circuit
+
+    with tempfile.TemporaryDirectory() as tmp:
+        with patch('src.circuit.STATE_FILE', Path(tmp) / 'circuits.json'):
+            circuit.record('model', ok=True)
+            circuit.record('model', ok=False)
+            assert not circuit.is_open('model')
+            circuit.record('model', ok=False)
+            assert circuit.is_open('model')
+            circuit.record('model', ok=True)
+            assert not circuit.is_open('model')
+    print('  PASS test_circuit_opens_after_repeated_failures')
+
+
+def test_editor_falls_back_when_circuit_open():
+    """Bij een open circuit voor Opus gaat de editor direct naar Sonnet en toont het Colofon dat."""
+    with tempfile.TemporaryDirectory() as tmp:
+        tmpdir = Path(tmp)
+        with _patch_cache_prefix(tmpdir):
+            from src import ai, circuit
+
+            for _ in range(circuit.MIN_CALLS):
+                circuit.record(ai.EDITOR_MODEL, ok=False)
+
+            mock_instance = MagicMock()
+            mock_instance.prompt.side_effect = [
+                {'title': 't1', 'summary': 's1'},
+                {'title': 't2', 'summary': 's2'},
+            ]
+            with patch('src.ai.Model', return_value=mock_instance) as mock_model, \
+                    patch.dict('src.ai.used_models', clear=True):
+                ai.edit_articles('daily', _sample_articles(), cached=False)
+                models = {call.args[0] for call in mock_model.call_args_list}
+                assert models == {ai.COPY_WRITE_MODEL}, models
+                assert ai.used_model_name('editor') == ai.COPY_WRITE_MODEL_NAME
+    print('  PASS test_editor_falls_back_when_circuit_open')
+
+
+def test_fallback_counts_only_transient_errors_against_circuit():
+    """Alleen transport- en overload-fouten tellen voor het circuit; een validatiefout wordt een paar keer
+    zonder wachten opnieuw geprobeerd en gaat dan naar het volgende model."""
+    from justai.models.basemodel import ModelOverloadException
+    with tempfile.TemporaryDirectory() as tmp:
+        tmpdir = Path(tmp)
+        with _patch_cache_prefix(tmpdir):
+            from src import ai, circuit
+
+            mock_instance = MagicMock()
+            mock_instance.prompt.side_effect = ValueError('invalid JSON')
+            with patch('src.ai.Model', return_value=mock_instance), patch.dict('src.ai.used_models', clear=True):
+                for _ in range(circuit.MIN_CALLS):
+                    try:
+                        ai.prompt_with_fallback('editor', 'prompt')
+                    except ValueError:
+                        pass
+                # Retried a few times per model, and neither circuit opened
+                assert mock_instance.prompt.call_count == 2 * ai.ANSWER_ATTEMPTS_PER_MODEL * circuit.MIN_CALLS
+                assert not circuit.is_open(ai.EDITOR_MODEL) and not circuit.is_open(ai.COPY_WRITE_MODEL)
+
+            # One bad answer doesn't cost the primary model its turn
+            mock_instance = MagicMock()
+            mock_instance.prompt.side_effect = [ValueError('invalid JSON'), {'ok': True}]
+            with patch('src.ai.Model', return_value=mock_instance), patch('src.ai.time.sleep') as sleep, \
+                    patch.dict('src.ai.used_models', clear=True):
+                assert ai.prompt_with_fallback('editor', 'prompt') == {'ok': True}
+                assert ai.used_model_name('editor') == ai.EDITOR_MODEL_NAME
+                sleep.assert_not_called()
+
+            mock_instance = MagicMock()
+            mock_instance.prompt.side_effect = [ModelOverloadException('overloaded')] * circuit.MIN_CALLS + [{'ok': True}]
+            with patch('src.ai.Model', return_value=mock_instance), patch('src.ai.time.sleep'), \
+                    patch.dict('src.ai.used_models', clear=True):
+                assert ai.prompt_with_fallback('editor', 'prompt') == {'ok': True}
+                assert circuit.is_open(ai.EDITOR_MODEL)
+                assert ai.used_model_name('editor') == ai.COPY_WRITE_MODEL_NAME
+            assert not list(tmpdir.glob('*.tmp'))
+    print('  PASS test_fallback_counts_only_transient_errors_against_circuit')
+
+
+def test_scheduler_serves_critical_calls_first():
+    """Bij een leeg budget gaat een CRITICAL call voor een eerder binnengekomen NORMAL call."""
+    import threading
+    import time
+    from src.scheduler import Scheduler, CRITICAL, NORMAL
+
+    scheduler = Scheduler({'openai': {'rpm': 600, 'tpm': 1_000_000}})
+    scheduler._requests['openai'].drain()
+    order = []
+
+    def call(name, priority):
+        scheduler.acquire('openai', tokens=10, priority=priority, stage=name)
+        order.append(name)
+
+    threads = [threading.Thread(target=call, args=('normal', NORMAL)),
+               threading.Thread(target=call, args=('critical', CRITICAL))]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.02)
+    for thread in threads:
+        thread.join(5)
+    assert order == ['critical', 'normal'], order
+    print('  PASS test_scheduler_serves_critical_calls_first')
+
+
+def test_scheduled_model_pauses_provider_on_ratelimit():
+    """Een RatelimitException pauzeert de hele provider en wordt doorgegeven aan de aanroeper."""
+    from justai.models.basemodel import RatelimitException
+    from src.scheduler import Scheduler, ScheduledModel
+
+    scheduler = Scheduler({'anthropic': {'rpm': 60, 'tpm': 100_000}})
+    inner = MagicMock()
+    inner.prompt.side_effect = RatelimitException('429')
+    with patch('src.scheduler.get_scheduler', return_value=scheduler):
+        try:
+            ScheduledModel(inner, 'claude-sonnet-4-6').prompt('hallo')
+            raise AssertionError('expected RatelimitException')
+        except RatelimitException:
+            pass
+    assert scheduler._wait_time('anthropic', 1) > 20
+    print('  PASS test_scheduled_model_pauses_provider_on_ratelimit')
+
+
+def test_optimize_image_creates_slot_sized_variants():
+    """Een grote PNG levert 1x (552px) en 2x (1104px) varianten op die kleiner zijn dan het origineel."""
+    from PIL import Image, ImageDraw
+    from src.images import optimize_image
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'infographic.png'
+        image = Image.new('RGB', (1536, 1024), 'white')
+        draw = ImageDraw.Draw(image)
+        for i in range(0, 1536, 64):
+            draw.rectangle([i, 100, i + 32, 900], fill=(11, 92, 171))
+        image.save(path, 'PNG')
+
+        variants = optimize_image(path)
+        assert [density for _, density in variants] == [1, 2]
+        widths = [Image.open(variant).width for variant, _ in variants]
+        assert widths == [552, 1104], widths
+        assert all(variant.stat().st_size < path.stat().st_size for variant, _ in variants)
+    print('  PASS test_optimize_image_creates_slot_sized_variants')
+
+
+def test_optimize_image_never_upscales():
+    """De header van 550px breed krijgt alleen een 1x variant, zonder opschalen."""
+    from PIL import Image
+    from src.images import optimize_image
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'header.png'
+        Image.effect_noise((550, 275), 64).convert('RGB').save(path, 'PNG')
+        variants = optimize_image(path)
+        assert len(variants) == 1
+        assert Image.open(variants[0][0]).size == (550, 275)
+    print('  PASS test_optimize_image_never_upscales')
+
+
+def test_upload_manager_skips_unchanged_content():
+    """Een bestand met dezelfde inhoud als het object in de bucket wordt niet opnieuw geüpload."""
+    from botocore.exceptions import ClientError
+    from src.s3 import UploadManager, KeyManifest, file_digests
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'image_1x.jpg'
+        path.write_bytes(b'jpeg bytes')
+        md5, sha256 = file_digests(path)
+
+        client = MagicMock()
+        client.meta.region_name = 'eu-west-1'
+        client.head_object.return_value = {'ETag': f'"{md5}"', 'Metadata': {}}
+        with patch('src.s3.shared_client', return_value=client), \
+                patch('src.s3.key_manifest', return_value=KeyManifest(Path(tmp) / 'manifest.json')):
+            manager = UploadManager('bucket')
+            url = manager.submit(path, 'nieuwsbrief/image_1x.jpg').result(5)
+            assert url == 'https://s3.eu-west-1.amazonaws.com/bucket/nieuwsbrief/image_1x.jpg'
+            client.upload_file.assert_not_called()
+
+            client.head_object.side_effect = ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+            manager.submit(path, 'nieuwsbrief/image_2x.jpg').result(5)
+            client.upload_file.assert_called_once()
+            assert client.upload_file.call_args.kwargs['ExtraArgs']['Metadata'] == {'sha256': sha256}
+            manager.shutdown()
+    print('  PASS test_upload_manager_skips_unchanged_content')
+
+
+def test_upload_manager_singleton_does_not_deadlock():
+    """upload_manager() maakt via S3() ook de gedeelde client en het manifest aan, zonder te blokkeren."""
+    import threading
+    import src.s3
+
+    result = []
+    with patch('src.s3.boto3.client', return_value=MagicMock()), patch.object(src.s3, '_managers', {}), \
+            patch.object(src.s3, '_clients', {}), patch.object(src.s3, '_manifest', None):
+        thread = threading.Thread(target=lambda: result.append(src.s3.upload_manager('bucket')), daemon=True)
+        thread.start()
+        thread.join(5)
+        assert not thread.is_alive(), 'upload_manager() deadlocked'
+        assert src.s3.upload_manager('bucket') is result[0]
+    print('  PASS test_upload_manager_singleton_does_not_deadlock')
+
+
+def test_sized_checks_existence_without_listing():
+    """S3.sized doet een head_object op de sized key (en cachet die) in plaats van de bucket te listen."""
+    from src.s3 import S3, KeyManifest
+
+    with tempfile.TemporaryDirectory() as tmp:
+        client = MagicMock()
+        client.meta.region_name = 'eu-west-1'
+        client.head_object.return_value = {'ETag': '"abc"', 'ContentLength': 10, 'Metadata': {}}
+        with patch('src.s3.shared_client', return_value=client):
+            s3 = S3('bucket', manifest=KeyManifest(Path(tmp) / 'manifest.json'))
+            for _ in range(3):
+                url = s3.sized('retriever.jpg', (30, 30))
+            assert url.endswith('/bucket/retriever_30x30.jpg')
+            client.head_object.assert_called_once_with(Bucket='bucket', Key='retriever_30x30.jpg')
+            client.list_objects_v2.assert_not_called()
+    print('  PASS test_sized_checks_existence_without_listing')
+
+
+def test_stream_from_pil_image_pipes_encoder_output():
+    """De encoder-output gaat via een pipe naar upload_fileobj en levert een geldige afbeelding op."""
+    from io import BytesIO
+    from PIL import Image
+    from src.s3 import S3, KeyManifest, S3ImagesUploadFailed
+
+    uploaded = BytesIO()
+
+    def upload_fileobj(fileobj, bucket, key, ExtraArgs=None, Config=None):
+        assert not hasattr(fileobj, 'getvalue'), 'verwacht een stream, geen buffer'
+        while chunk := fileobj.read(4096):
+            uploaded.write(chunk)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        client = MagicMock()
+        client.meta.region_name = 'eu-west-1'
+        client.upload_fileobj.side_effect = upload_fileobj
+        with patch('src.s3.shared_client', return_value=client):
+            s3 = S3('bucket', manifest=KeyManifest(Path(tmp) / 'manifest.json'))
+            url = s3.stream_from_pil_image(Image.effect_noise((400, 300), 50), 'noise.png')
+
+    assert url.endswith('/bucket/noise.png')
+    assert client.upload_fileobj.call_args.kwargs['ExtraArgs'] == {'ContentType': 'image/png'}
+    assert Image.open(BytesIO(uploaded.getvalue())).size == (400, 300)
+
+    # Faalt de encoder halverwege, dan mislukt de upload in plaats van de halve bytes op te slaan
+    class BrokenImage:
+        def save(self, writer, fmt):
+            writer.write(b'\x89PNG partial')
+            raise OSError('encoder crashed')
+
+    committed = []
+
+    def upload_and_commit(fileobj, bucket, key, ExtraArgs=None, Config=None):
+        data = b''
+        while chunk := fileobj.read(4096):
+            data += chunk
+        committed.append(data)
+
+    client.upload_fileobj.side_effect = upload_and_commit
+    with tempfile.TemporaryDirectory() as tmp, patch('src.s3.shared_client', return_value=client):
+        s3 = S3('bucket', manifest=KeyManifest(Path(tmp) / 'manifest.json'))
+        try:
+            s3.stream_from_pil_image(BrokenImage(), 'broken.png')
+            raise AssertionError('expected S3ImagesUploadFailed')
+        except S3ImagesUploadFailed as e:
+            assert isinstance(e.__cause__, OSError)
+    assert committed == []
+    print('  PASS test_stream_from_pil_image_pipes_encoder_output')
+
+
+def test_submit_hashed_uses_content_key_and_cache_headers():
+    """Hashed uploads krijgen een key met de inhoudshash, immutable Cache-Control en het juiste content type."""
+    from botocore.exceptions import ClientError
+    from src.s3 import UploadManager, KeyManifest, IMMUTABLE_CACHE_CONTROL, file_digests
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / '2026-10-19_1x.jpg'
+        path.write_bytes(b'jpeg bytes')
+        _, sha256 = file_digests(path)
+
+        client = MagicMock()
+        client.meta.region_name = 'eu-west-1'
+        client.head_object.side_effect = ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        with patch('src.s3.shared_client', return_value=client), \
+                patch('src.s3.key_manifest', return_value=KeyManifest(Path(tmp) / 'manifest.json')):
+            manager = UploadManager('bucket')
+            url = manager.submit_hashed(path, 'nieuwsbrief/').result(5)
+            manager.shutdown()
+
+    key = f'nieuwsbrief/2026-10-19_1x-{sha256[:16]}.jpg'
+    assert url.endswith('/bucket/' + key), url
+    args = client.upload_file.call_args
+    assert args.args[2] == key
+    assert args.kwargs['ExtraArgs']['CacheControl'] == IMMUTABLE_CACHE_CONTROL
+    assert args.kwargs['ExtraArgs']['ContentType'] == 'image/jpeg'
+    print('  PASS test_submit_hashed_uses_content_key_and_cache_headers')
+
+
+def test_compiled_template_matches_replace():
+    """Het gecompileerde template rendert exact hetzelfde als str.replace op [EMAIL]."""
+    from src.formatter import CompiledTemplate
+
+    html_doc = '<a href="x?email=[EMAIL]">Afmelden</a> · <a href="y?email=[EMAIL]">Wissel</a>'
+    template = CompiledTemplate.compile(html_doc)
+    assert template.slots == ['email', 'email']
+    assert template.render(email='a@b.nl') == html_doc.replace('[EMAIL]', 'a@b.nl')
+
+    multi = CompiledTemplate.compile('[NAME] <[EMAIL]>', {'[EMAIL]': 'email', '[NAME]': 'name'})
+    assert multi.render(email='a@b.nl', name='Anna') == 'Anna <a@b.nl>'
+    assert CompiledTemplate.compile('geen slots').render(email='a@b.nl') == 'geen slots'
+    print('  PASS test_compiled_template_matches_replace')
+
+
+def test_bulk_message_matches_create_message():
+    """BulkMessageBuilder levert na decoderen dezelfde headers en inhoud als create_message."""
+    import email
+    from src.mailer import BulkMessageBuilder, create_message
+
+    html_doc = ('<p>Héllo wereld — ' + 'lange regel met tekst ' * 20 + '</p>\n'
+                '<a href="https://harmsen.nl/nieuwsbrief/afmelden/?email=[EMAIL]">Afmelden</a>[EMAIL]')
+    builder = BulkMessageBuilder('HP\'s AI daily — 19 oktober', html_doc, 'nieuwsbrief@harmsen.nl', 'campagne')
+    decoded = lambda value: str(email.header.make_header(email.header.decode_header(value)))
+    for recipient in ('lezer+test=1@example.com', 'jürgen@münchen.de'):
+        message_id, raw = builder.build(recipient)
+
+        assert all(len(line) <= 78 for line in raw.split(b'\r\n')), 'regels langer dan 78 tekens'
+        bulk = email.message_from_bytes(raw)
+        reference = create_message(recipient, 'HP\'s AI daily — 19 oktober',
+                                   html_doc.replace('[EMAIL]', recipient), 'nieuwsbrief@harmsen.nl')
+
+        assert bulk['Message-ID'] == message_id
+        assert bulk['X-Campaign-ID'] == 'campagne'
+        for header in ('From', 'To', 'Reply-To', 'List-Unsubscribe', 'List-Unsubscribe-Post', 'Precedence', 'Subject'):
+            assert ' '.join(decoded(bulk[header]).split()) == decoded(reference[header]), header
+        # Regeleinden zijn in de QP-versie canoniek CRLF
+        bulk_parts = [p.get_payload(decode=True).replace(b'\r\n', b'\n') for p in bulk.walk() if not p.is_multipart()]
+        reference_parts = [p.get_payload(decode=True) for p in reference.walk() if not p.is_multipart()]
+        assert bulk_parts == reference_parts
+    assert '?email=j%C3%BCrgen@m%C3%BCnchen.de>' in bulk['List-Unsubscribe']
+    print('  PASS test_bulk_message_matches_create_message')
+
+
+def test_optimize_html_shrinks_and_keeps_content():
+    """De optimizer maakt de nieuwsbrief kleiner zonder tekst, links of [EMAIL]-slots te verliezen."""
+    import re
+    import src.html_optimizer
+    from src.formatter import build_html_email
+    from src.html_optimizer import optimize_html, normalize_style
+
+    assert normalize_style(' margin: 0 0 8px 0; color : #333 ;') == 'margin:0 0 8px 0;color:#333'
+
+    items = [{'title': f'Titel {i}', 'summary': f'Zin een.\nZin twee van artikel {i}.',
+              'links': ['https://example.com/a']} for i in range(6)]
+    html_doc = build_html_email('daily', items, 'HP\'s AI daily', 'Intro', 'https://example.com/i.jpg')
+    optimized = optimize_html(html_doc)
+
+    assert len(optimized) < 0.9 * len(html_doc), (len(optimized), len(html_doc))
+    assert optimized.count('[EMAIL]') == html_doc.count('[EMAIL]')
+    assert '<!--' not in optimized
+    text = lambda h: ' '.join(re.sub(r'<[^>]+>', ' ', h).split())
+    assert text(optimized) == text(re.sub(r'<!--.*?-->', '', html_doc, flags=re.S))
+    # Standaard blijven alle stijlen inline, ook voor clients die <style> negeren
+    assert 'class="s0"' not in optimized
+    assert optimized.count(' style="') == html_doc.count(' style="') - html_doc.count(' style=""')
+    assert optimize_html('<p>Tekst <img src="a.png"> en <br> meer</p>') == '<p>Tekst <img src="a.png"> en <br> meer</p>'
+
+    with patch.object(src.html_optimizer, 'DEDUPE_STYLES', True):
+        deduped = optimize_html(html_doc)
+    assert re.search(r'<style>.*\.s0\{', deduped)
+    assert text(re.sub(r'<style>.*?</style>', '', deduped)) == text(optimized)
+    # Breedte en display blijven inline staan
+    assert 'style="width:100%;max-width:552px;height:auto;display:block;border-radius:8px"' in deduped
+    print('  PASS test_optimize_html_shrinks_and_keeps_content')
+
+
+def test_send_parallel_uses_own_session_per_worker():
+    """Elke worker heeft een eigen sessie; alle ontvangers worden precies één keer verstuurd."""
+    import threading
+    from contextlib import contextmanager
+    import src.metrics
+    import src.sender
+    from src.metrics import write_metrics
+    from src.sender import SendLimiter, SendStats, send_parallel
+
+    sessions = []
+    sent = []
+    lock = threading.Lock()
+
+    @contextmanager
+    def session_factory():
+        session = object()
+        with lock:
+            sessions.append(session)
+        yield session
+
+    def send_one(session, recipient):
+        if recipient == 'fout@example.com':
+            raise RuntimeError('550 rejected')
+        with lock:
+            sent.append((session, recipient))
+
+    recipients = [f'lezer{i}@example{i % 3}.com' for i in range(30)] + ['fout@example.com']
+    with tempfile.TemporaryDirectory() as tmp, patch.object(src.sender, 'DOMAIN_RATE', 1000), \
+            patch.object(src.metrics, 'METRICS_DIR', Path(tmp)):
+        stats = send_parallel(recipients, session_factory, send_one,
+                              SendLimiter(per_second=1000, per_minute=60000, per_day=100000), connections=3)
+        metrics = json.loads((Path(tmp) / 'send_metrics.json').read_text())
+        prom = (Path(tmp) / 'send_metrics.prom').read_text()
+    assert len(sessions) == 3
+    assert sorted(r for _, r in sent) == sorted(recipients[:-1])
+    assert (stats.sent, stats.failed) == (30, 1)
+    assert metrics['finished'] and metrics['sent'] == 30 and metrics['remaining'] == 0
+    assert metrics['responses'] == {'250': 30, '550': 1}
+    assert metrics['latency_histogram'][-1] == ['+Inf', 31]
+    assert 'ainews_send_responses_total{shard="1/1",code="550"} 1' in prom
+    assert 'ainews_send_messages_total{shard="1/1",outcome="sent"} 30' in prom
+    assert 'ainews_send_deferrals_total{shard="1/1"} 0' in prom
+    assert all('shard="1/1"' in line for line in prom.splitlines() if not line.startswith('#'))
+
+    # Shards van één verzending schrijven elk hun eigen bestanden
+    with tempfile.TemporaryDirectory() as tmp:
+        for shard in ('1/2', '2/2'):
+            write_metrics(SendStats(shard), directory=Path(tmp))
+        assert sorted(p.name for p in Path(tmp).iterdir()) == [
+            'send_metrics_1of2.json', 'send_metrics_1of2.prom', 'send_metrics_2of2.json', 'send_metrics_2of2.prom']
+        assert 'ainews_send_remaining{shard="2/2"} 0' in (Path(tmp) / 'send_metrics_2of2.prom').read_text()
+    print('  PASS test_send_parallel_uses_own_session_per_worker')
+
+
+def test_send_parallel_returns_when_no_session_opens():
+    """Als geen enkele sessie kan inloggen, stopt ook het inlezen van de stroom en keert send_parallel terug."""
+    import threading
+    from src.sender import SendLimiter, send_parallel
+
+    def session_factory():
+        raise OSError('535 Authentication failed')
+
+    def stream():
+        for c in range(5):
+            yield [f'lezer{c}-{i}@example{i % 7}.com' for i in range(500)]
+
+    result = []
+    with tempfile.TemporaryDirectory() as tmp:
+        call = threading.Thread(target=lambda: result.append(send_parallel(
+            stream(), session_factory, lambda session, recipient: '250', SendLimiter(1000, 60000, 100000),
+            connections=2, metrics_dir=Path(tmp))), daemon=True)
+        call.start()
+        call.join(5)
+    assert not call.is_alive(), 'send_parallel blocked'
+    assert result[0].sent == 0
+    print('  PASS test_send_parallel_returns_when_no_session_opens')
+
+
+def test_send_limiter_stops_at_daily_quota():
+    """Het dagquotum (inclusief wat vandaag al verstuurd is) wordt niet overschreden, ook niet na wachten."""
+    import time
+    from datetime import date, timedelta
+    from src.sender import SendLimiter, QuotaExceeded
+
+    limiter = SendLimiter(per_second=100, per_minute=6000, per_day=2000, already_sent_today=1998)
+    limiter.acquire()
+    limiter.acquire()
+    for _ in range(2):
+        started = time.monotonic()
+        try:
+            limiter.acquire()
+            raise AssertionError('expected QuotaExceeded')
+        except QuotaExceeded:
+            pass
+        assert time.monotonic() - started < 0.1
+        time.sleep(0.1)
+    assert limiter.sent_today == 2000
+
+    # Een nieuwe dag begint weer bij nul
+    limiter.day = date.today() - timedelta(days=1)
+    limiter.acquire()
+    assert limiter.sent_today == 1
+    print('  PASS test_send_limiter_stops_at_daily_quota')
+
+
+def test_send_queue_resumes_interrupted_send():
+    """Een onderbroken verzending gaat verder met precies de ontvangers die nog niets kregen."""
+    import sqlite3
+    from justdays import Day
+    from src.sendqueue import SendQueue
+
+    day = Day()
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy = Path(tmp) / 'mailerlog.txt'
+        legacy.write_text(f'weekly {day} oud@example.com\n\n')
+        queue = SendQueue(Path(tmp) / 'sendqueue.db', legacy)
+        assert queue.sent_count(day) == 1
+
+        queue.enqueue('daily', day, ['a@example.com', 'b@example.com', 'c@example.com', 'oud@example.com'])
+        assert sorted(queue.claim('daily', day)) == ['a@example.com', 'b@example.com', 'c@example.com']
+        queue.mark_sent('daily', day, 'a@example.com', '<1@harmsen.nl>', '250 Ok')
+        queue.mark_failed('daily', day, 'b@example.com', '550 No such user', retry_in=3600)
+        # Een verzonden rij staat direct op schijf, ook als het proces hierna crasht
+        raw = sqlite3.connect(Path(tmp) / 'sendqueue.db')
+        assert dict(raw.execute("SELECT recipient, status FROM sends WHERE schedule = 'daily' AND recipient < 'c'")
+                    .fetchall()) == {'a@example.com': 'sent', 'b@example.com': 'sending'}
+        raw.close()
+        queue.close()
+        assert not SendQueue(Path(tmp) / 'sendqueue.db', legacy).is_complete('daily', day)
+
+        # c was claimed but never finished: a new run picks it up, b waits for its retry time
+        queue = SendQueue(Path(tmp) / 'sendqueue.db', legacy)
+        queue.enqueue('daily', day, ['a@example.com', 'b@example.com', 'c@example.com'])
+        assert queue.claim('daily', day) == ['c@example.com']
+        queue.mark_sent('daily', day, 'c@example.com', '<2@harmsen.nl>', '250 Ok')
+        assert queue.counts('daily', day) == {'sent': 3, 'failed': 1}
+        assert queue.is_complete('daily', day)
+        queue.close()
+    print('  PASS test_send_queue_resumes_interrupted_send')
+
+
+def test_deferred_recipient_stays_pending_without_using_attempts():
+    """Een ontvanger die na alle herkansingen nog 4xx krijgt, blijft pending tot retry_at en telt niet als poging."""
+    import sqlite3
+    from justdays import Day
+    import src.sender
+    from src.sender import Deferred, SendLimiter, send_parallel
+    from src.sendqueue import MAX_ATTEMPTS, SendQueue
+
+    @contextmanager
+    def session():
+        yield None
+
+    def send_one(session, recipient):
+        if recipient == 'vol@example.nl':
+            raise Deferred('452 4.2.2 Mailbox full')
+        queue.mark_sent('daily', day, recipient, f'<{recipient}>', '250 Ok')
+        return '250 Ok'
+
+    day = Day()
+    with tempfile.TemporaryDirectory() as tmp:
+        queue = SendQueue(Path(tmp) / 'sendqueue.db', Path(tmp) / 'mailerlog.txt')
+        queue.enqueue('daily', day, ['a@example.com', 'vol@example.nl'])
+        claimed = queue.claim('daily', day)
+        deferred = []
+        with patch.object(src.sender, 'DEFER_DELAY', 0), patch.object(src.sender, 'DOMAIN_RATE', 1000):
+            send_parallel(claimed, session, send_one, SendLimiter(1000, 60000, 100000), connections=2,
+                          on_deferred=lambda recipient, response: (deferred.append(recipient),
+                                                                   queue.defer('daily', day, recipient, response)),
+                          metrics_dir=Path(tmp))
+        assert deferred == ['vol@example.nl']
+        row = sqlite3.connect(Path(tmp) / 'sendqueue.db').execute(
+            "SELECT status, attempts, smtp_response FROM sends WHERE recipient = 'vol@example.nl'").fetchone()
+        assert row == ('pending', 0, '452 4.2.2 Mailbox full')
+
+        # Niet opnieuw geclaimd en niet geannuleerd voordat retry_at verstreken is, daarna wel weer aan de beurt
+        queue.enqueue('daily', day, ['a@example.com', 'vol@example.nl'])
+        assert queue.claim('daily', day) == []
+        assert queue.cancel_pending('daily', day) == 0
+        for _ in range(MAX_ATTEMPTS + 1):
+            queue.defer('daily', day, 'vol@example.nl', '452 4.2.2 Mailbox full', retry_in=0)
+            assert queue.claim('daily', day) == ['vol@example.nl']
+        queue.close()
+    print('  PASS test_deferred_recipient_stays_pending_without_using_attempts')
+
+
+def test_delete_emails_batches_imap_commands():
+    """Alle Message-IDs worden met gecombineerde searches opgezocht en in één COPY/STORE/EXPUNGE verwijderd."""
+    import src.gmail
+    from src.gmail import Mail, _uid_set
+
+    class FakeImap:
+        def __init__(self):
+            self.commands = []
+
+        def select(self, folder, readonly=True):
+            self.commands.append(('select', folder))
+            return 'OK', [b'3']
+
+        def uid(self, command, *args):
+            self.commands.append((command, *args))
+            if command == 'search':
+                count = args[1].count('HEADER Message-ID')
+                assert args[1].count('OR ') == count - 1
+                return 'OK', [' '.join(str(100 + len(self.commands) * 10 + i) for i in range(count)).encode()]
+            return 'OK', [b'']
+
+        def expunge(self):
+            self.commands.append(('expunge',))
+            return 'OK', [b'']
+
+    assert _uid_set({1, 2, 3, 7, 9, 10}) == '1:3,7,9:10'
+    mail = Mail()
+    mail.mail = FakeImap()
+    message_ids = [f'<{i}@harmsen.nl>' for i in range(5)] + ['42']
+    with patch.object(src.gmail, 'SEARCH_CHUNK', 2):
+        assert mail.delete_emails(message_ids) == 6
+    names = [command[0] for command in mail.mail.commands]
+    assert names == ['select', 'search', 'search', 'search', 'copy', 'store', 'expunge']
+    assert '42' in mail.mail.commands[4][1].split(',')
+
+    # delete_email is een enkele delete_emails
+    import src.mailer
+    with patch.object(src.mailer, 'delete_emails', return_value=1) as delete_emails:
+        assert src.mailer.delete_email('<1@harmsen.nl>')
+    delete_emails.assert_called_once_with(['<1@harmsen.nl>'], '[Gmail]/Sent Mail')
+    print('  PASS test_delete_emails_batches_imap_commands')
+
+
+def test_undelivered_fetches_only_delivery_status_parts():
+    """Bounces worden per batch gelezen: eerst BODYSTRUCTURE, dan alleen delivery-status en text/plain."""
+    import re
+    import src.gmail
+    from src.gmail import Mail
+
+    report = ('((("TEXT" "PLAIN" ("CHARSET" "UTF-8") NIL NIL "7BIT" 120 4 NIL NIL NIL)'
+              '("TEXT" "HTML" ("CHARSET" "UTF-8") NIL NIL "QUOTED-PRINTABLE" 400 10 NIL NIL NIL) "ALTERNATIVE" '
+              '("BOUNDARY" "b1") NIL NIL)("MESSAGE" "DELIVERY-STATUS" NIL NIL NIL "7BIT" 300 NIL NIL NIL)'
+              '("MESSAGE" "RFC822" NIL NIL NIL "7BIT" 90000 (NIL "AI daily" NIL NIL NIL NIL NIL NIL NIL NIL) '
+              '("TEXT" "HTML" NIL NIL NIL "7BIT" 80000 100 NIL NIL NIL) 200 NIL NIL NIL) "REPORT" '
+              '("REPORT-TYPE" "delivery-status" "BOUNDARY" "b0") NIL NIL)')
+    dsn = 'Reporting-MTA: dns; googlemail.com\r\n\r\nFinal-Recipient: rfc822; {0}\r\nAction: failed\r\nStatus: {1}\r\nDiagnostic-Code: smtp; {2}\r\n'
+    bounces = {
+        11: (report, {'1.1': b"Address not found", '2': dsn.format('weg@example.com', '5.1.1', '550 5.1.1 No such user').encode()}),
+        12: (report, {'1.1': b"Message blocked", '2': dsn.format('streng@example.nl', '5.7.1', '554 blocked as spam').encode()}),
+        13: ('("TEXT" "PLAIN" ("CHARSET" "us-ascii") NIL NIL "BASE64" 200 5 NIL NIL NIL)',
+             {'1': b'RGVsaXZlcnkgaW5jb21wbGV0ZTogd2UgaGFkIHRyb3VibGUgZGVsaXZlcmluZyB5b3VyIG1lc3NhZ2UgdG8g\r\n'
+                   b'dm9sQGV4YW1wbGUub3JnLiA0NTIgNC4yLjIgTWFpbGJveCBmdWxs\r\n'}),
+    }
+
+    class FakeImap:
+        def __init__(self):
+            self.commands = []
+
+        def select(self, folder, readonly=True):
+            return 'OK', [b'3']
+
+        def uid(self, command, *args):
+            self.commands.append((command, *args))
+            if command == 'search':
+                return 'OK', [b'11 12 13']
+            uids = [uid for r in args[0].split(',') for uid in range(int(r.split(':')[0]), int(r.split(':')[-1]) + 1)]
+            data = []
+            for uid in uids:
+                structure, parts = bounces[uid]
+                line = f'{uid} (UID {uid}'.encode()
+                if 'BODYSTRUCTURE' in args[1]:
+                    line += f' BODYSTRUCTURE {structure}'.encode()
+                    data.append((line + b' BODY[HEADER.FIELDS (X-FAILED-RECIPIENTS)] {2}', b'\r\n'))
+                    line = b''
+                for number in re.findall(r'BODY\.PEEK\[([\d.]+)\]', args[1]):
+                    data.append((line + f' BODY[{number}]<0> {{{len(parts[number])}}}'.encode(), parts[number]))
+                    line = b''
+                data.append(line + b')')
+            return 'OK', data
+
+    mail = Mail()
+    mail.mail = FakeImap()
+    with patch.object(src.gmail, 'FETCH_CHUNK', 2):
+        undelivered = mail.get_undelivered()
+    assert undelivered == [
+        {'email_id': '11', 'recipient_email': 'weg@example.com', 'is_spam_rejection': False, 'is_permanent': True},
+        {'email_id': '12', 'recipient_email': 'streng@example.nl', 'is_spam_rejection': True, 'is_permanent': True},
+        {'email_id': '13', 'recipient_email': 'vol@example.org', 'is_spam_rejection': False, 'is_permanent': False},
+    ], undelivered
+    fetches = [command[2] for command in mail.mail.commands if command[0] == 'fetch']
+    # Two structure batches, then one fetch per part layout; never the whole message or the attached original
+    assert len(fetches) == 4 and sum('BODYSTRUCTURE' in items for items in fetches) == 2
+    assert not any('RFC822' in items or 'PEEK[3]' in items or 'PEEK[1.2]' in items for items in fetches)
+    print('  PASS test_undelivered_fetches_only_delivery_status_parts')
+
+
+def test_smtp_login_always_uses_starttls_and_login():
+    """Productie-SMTP doet altijd STARTTLS en login; alleen de smtp://-testtransport verbindt zonder."""
+    from unittest.mock import MagicMock
+    import src.mailer
+    from src.mailer import smtp_login
+
+    env = {'EMAIL_HOST': 'smtp.example.com', 'EMAIL_HOST_USER': 'nieuwsbrief', 'EMAIL_HOST_PASSWORD': 'geheim'}
+    with patch.object(src.mailer.smtplib, 'SMTP') as smtp, patch.dict(os.environ, env):
+        server = smtp.return_value = MagicMock()
+        server.has_extn.return_value = False
+        smtp_login()
+        server.starttls.assert_called_once()
+        server.login.assert_called_once_with('nieuwsbrief', 'geheim')
+
+        with patch.dict(os.environ, {'EMAIL_HOST_PASSWORD': ''}):
+            try:
+                smtp_login()
+                raise AssertionError('expected ValueError')
+            except ValueError:
+                pass
+
+        server.reset_mock()
+        smtp_login('127.0.0.1', 2525, secure=False)
+        server.starttls.assert_not_called()
+        server.login.assert_not_called()
+    print('  PASS test_smtp_login_always_uses_starttls_and_login')
+
+
+def test_smtp_session_reconnects_and_retries():
+    """Een weggevallen verbinding wordt hersteld en dezelfde ontvanger opnieuw geprobeerd."""
+    import smtplib
+    from src.mailer import SmtpSession
+    from src.sender import SendStats
+
+    class FakeServer:
+        drops = 1  # The first connection is dropped at the first MAIL FROM
+
+        def __init__(self):
+            self.sent = []
+
+        def ehlo_or_helo_if_needed(self):
+            pass
+
+        def rset(self):
+            return 250, b'Ok'
+
+        def mail(self, sender):
+            if FakeServer.drops:
+                FakeServer.drops -= 1
+                raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+            return 250, b'Ok'
+
+        def rcpt(self, recipient):
+            if recipient.startswith('onbekend'):
+                return 550, b'No such user'
+            self.sent.append(recipient)
+            return 250, b'Ok'
+
+        def data(self, message):
+            return 250, b'Ok: queued'
+
+        def close(self):
+            pass
+
+        def quit(self):
+            pass
+
+    servers = []
+
+    def connect():
+        servers.append(FakeServer())
+        return servers[-1]
+
+    stats = SendStats()
+    with SmtpSession(stats, connect=connect, backoff=0) as session:
+        assert session.send('nieuwsbrief@harmsen.nl', 'a@example.com', b'x') == '250 Ok: queued'
+        try:
+            session.send('nieuwsbrief@harmsen.nl', 'onbekend@example.com', b'x')
+            raise AssertionError('expected SMTPRecipientsRefused')
+        except smtplib.SMTPRecipientsRefused:
+            pass
+    assert len(servers) == 2 and servers[1].sent == ['a@example.com']
+    assert (stats.connects, stats.reconnects, stats.retries) == (2, 1, 1)
+    print('  PASS test_smtp_session_reconnects_and_retries')
+
+
+def test_domain_scheduler_interleaves_and_requeues_deferrals():
+    """Domeinen worden afgewisseld; een 4xx halveert het tempo van dat domein en de ontvanger komt terug."""
+    import src.sender
+    from src.sender import DomainScheduler
+
+    recipients = [f'g{i}@gmail.com' for i in range(4)] + ['a@xs4all.nl', 'b@xs4all.nl', 'c@ziggo.nl']
+    with patch.object(src.sender, 'DOMAIN_RATE', 1000), patch.object(src.sender, 'DEFER_DELAY', 0):
+        scheduler = DomainScheduler(recipients)
+        order = []
+        while (recipient := scheduler.next()) is not None:
+            order.append(recipient)
+            if recipient == 'g1@gmail.com' and order.count(recipient) == 1:
+                rate = scheduler.domains['gmail.com'].rate
+                assert scheduler.done(recipient, 'deferred')
+                assert scheduler.domains['gmail.com'].rate == rate / 2
+            else:
+                scheduler.done(recipient, 'sent')
+    assert order[:3] == ['g0@gmail.com', 'a@xs4all.nl', 'c@ziggo.nl']
+    assert sorted(set(order)) == sorted(recipients) and order.count('g1@gmail.com') == 2
+    assert scheduler.remaining() == 0
+    print('  PASS test_domain_scheduler_interleaves_and_requeues_deferrals')
+
+
+def test_deliver_through_fake_smtp_and_maildir():
+    """De nieuwsbrief gaat via de echte SMTP-code naar de lokale testserver, of naar een Maildir."""
+    from justdays import Day
+    import src.metrics
+    import src.sender
+    from src.fakesmtp import FakeSmtpServer
+    from src.mailer import deliver, transport
+    from src.sender import SendStats
+    from src.sendqueue import SendQueue
+
+    recipients = [f'lezer{i}@example{i % 4}.com' for i in range(20)]
+    html_doc = '<html><body><p>Hallo [EMAIL]</p></body></html>'
+    with tempfile.TemporaryDirectory() as tmp, patch.object(src.sender, 'DOMAIN_RATE', 1000), \
+            patch.object(src.metrics, 'METRICS_DIR', Path(tmp)):
+        queue = SendQueue(Path(tmp) / 'sendqueue.db', Path(tmp) / 'mailerlog.txt')
+        stats = SendStats()
+        with FakeSmtpServer() as server:
+            stats, sent = deliver('daily', html_doc, 'Test', recipients, queue,
+                                  transport(stats, f'smtp://127.0.0.1:{server.port}'), stats=stats, connections=3)
+        assert server.messages == stats.sent == len(sent) == 20
+        assert queue.counts('daily', Day()) == {'sent': 20}
+
+        stats = SendStats()
+        deliver('weekly', html_doc, 'Test', ['nieuw@example.com'], queue, transport(stats, f'maildir:{tmp}/maildir'),
+                stats=stats)
+        messages = list((Path(tmp) / 'maildir' / 'new').iterdir())
+        assert len(messages) == 1 and b'To: nieuw@example.com' in messages[0].read_bytes()
+        queue.close()
+    print('  PASS test_deliver_through_fake_smtp_and_maildir')
+
+
+def test_send_ledger_shards_claim_each_recipient_once():
+    """Workers verdelen de lijst op hash en claimen elke ontvanger precies één keer in het gedeelde grootboek."""
+    import time
+    from justdays import Day
+    from sqlalchemy import create_engine
+    from src.ledger import SendLedger, shard_of
+
+    day = Day()
+    recipients = [f'lezer{i}@example.com' for i in range(200)]
+    assert [shard_of(r, 3) for r in recipients] == [shard_of(r.upper(), 3) for r in recipients]
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f'sqlite:///{tmp}/ledger.db')
+        workers = [SendLedger(i, 3, engine) for i in (1, 2, 3)]
+        claimed = []
+        for worker in workers:
+            worker.enqueue('daily', day, recipients)
+            claimed.append(worker.claim('daily', day))
+        assert sorted(sum(claimed, [])) == sorted(recipients)
+        assert all(claimed)
+
+        # A second process for shard 1 (e.g. started twice on the same host) gets nothing that is already claimed
+        duplicate = SendLedger(1, 3, engine)
+        assert duplicate.worker == workers[0].worker
+        duplicate.enqueue('daily', day, recipients)
+        assert duplicate.claim('daily', day) == []
+
+        for worker, mine in zip(workers, claimed):
+            for recipient in mine:
+                worker.mark_sent('daily', day, recipient, f'<{recipient}>', '250 Ok')
+            worker.close()
+        assert workers[0].counts('daily', day) == {'sent': 200}
+        assert workers[0].is_complete('daily', day) and workers[0].sent_count(day) == 200
+
+        # Rows in 'sending' are only taken over once the lease of the first process has expired;
+        # recording results extends it
+        first, second = SendLedger(engine=engine, lease=0.5), SendLedger(engine=engine, lease=0.5)
+        weekly = ['x@example.nl', 'y@example.nl', 'z@example.nl']
+        first.enqueue('weekly', day, weekly)
+        mine = first.claim('weekly', day)
+        time.sleep(0.3)
+        first.mark_sent('weekly', day, mine[0], '<1>', '250 Ok')
+        time.sleep(0.3)
+        second.enqueue('weekly', day, weekly)
+        assert second.claim('weekly', day) == []
+        time.sleep(0.3)
+        assert sorted(second.claim('weekly', day)) == sorted(mine[1:])
+    print('  PASS test_send_ledger_shards_claim_each_recipient_once')
+
+
+def test_shared_engine_reflects_each_table_once():
+    """Eén engine per proces; tabellen uit schema.py worden niet gereflecteerd, andere één keer."""
+    from sqlalchemy import MetaData, create_engine, text
+    import src.database
+    from src.schema import subscriber_table
+    from src.subscribers import db, get_subscriber_status, get_subscribers
+
+    with tempfile.TemporaryDirectory() as tmp:
+        url = f'sqlite:///{tmp}/subscribers.db'
+        with create_engine(url).begin() as conn:
+            conn.execute(text('CREATE TABLE nieuwsbrief_subscriber (email TEXT, status TEXT, updated_at TIMESTAMP)'))
+            conn.execute(text("INSERT INTO nieuwsbrief_subscriber VALUES ('a@example.com', 'daily', NULL), "
+                              "('b@example.com', 'weekly', NULL)"))
+            conn.execute(text('CREATE TABLE nieuwsbrief_other (id INTEGER)'))
+
+        with patch.dict(os.environ, {'DATABASE_URL': url}), patch.object(src.database, '_engine', None), \
+                patch.object(src.database, '_metadata', MetaData()), \
+                patch.object(MetaData, 'reflect', autospec=True, side_effect=MetaData.reflect) as reflect:
+            assert get_subscribers('daily') == ['a@example.com']
+            assert get_subscriber_status('b@example.com')['status'] == 'weekly'
+            with db() as (conn, tables):
+                assert tables['nieuwsbrief_subscriber'] is subscriber_table
+            engine = src.database.get_engine()
+            assert src.database.db_connect()[0] is engine
+            other = src.database.get_table('nieuwsbrief_other')
+            assert src.database.get_table('nieuwsbrief_other') is other
+            assert [call.kwargs['only'] for call in reflect.call_args_list] == [['nieuwsbrief_other']]
+            engine.dispose()
+    print('  PASS test_shared_engine_reflects_each_table_once')
+
+
+def test_schema_indexes_serve_newsletter_day_range():
+    """migrate() maakt de indexen één keer aan; get_newsletter vindt de nieuwsbrief via een bereik op sent."""
+    from datetime import datetime, timezone
+    from sqlalchemy import create_engine, text
+    import src.database
+    from justdays import Day
+    from src.schema import metadata, migrate, newsletter_table
+
+    with tempfile.TemporaryDirectory() as tmp:
+        url = f'sqlite:///{tmp}/newsletters.db'
+        engine = create_engine(url)
+        metadata.create_all(engine)
+        with engine.begin() as conn:
+            for index in newsletter_table.indexes:
+                index.drop(conn)
+            conn.execute(newsletter_table.insert(), [
+                {'schedule': 'daily', 'title': 'Gisteren', 'text': '<p>1</p>',
+                 'sent': datetime(2025, 6, 1, 23, 30, tzinfo=src.database.AMSTERDAM_TZ)},
+                {'schedule': 'daily', 'title': 'Vandaag', 'text': '<p>2</p>',
+                 'sent': datetime(2025, 6, 2, 0, 30, tzinfo=src.database.AMSTERDAM_TZ)},
+                {'schedule': 'weekly', 'title': 'Week', 'text': '<p>3</p>',
+                 'sent': datetime(2025, 6, 2, 7, 0, tzinfo=src.database.AMSTERDAM_TZ)},
+            ])
+
+        assert migrate(engine) == ['nieuwsbrief_newsletter_schedule_sent_idx']
+        assert migrate(engine) == []
+
+        with patch.object(src.database, 'db_connect', return_value=(engine, newsletter_table)):
+            assert src.database.get_newsletter('daily', Day('2025-06-02')) == ('Vandaag', '<p>2</p>')
+            assert src.database.get_newsletter('daily', Day('2025-06-03')) is None
+
+        start, end = src.database.day_range(Day('2025-06-02').as_date())
+        query = newsletter_table.select().where(newsletter_table.c.schedule == 'daily',
+                                                newsletter_table.c.sent >= start, newsletter_table.c.sent < end)
+        with engine.connect() as conn:
+            compiled = query.compile(engine, compile_kwargs={'literal_binds': True})
+            plan = ' '.join(str(row[-1]) for row in conn.execute(text(f'EXPLAIN QUERY PLAN {compiled}')))
+        assert 'nieuwsbrief_newsletter_schedule_sent_idx' in plan, plan
+        engine.dispose()
+
+    # Wintertijd is UTC+1, en op de dag van de zomertijd-overgang duurt een dag 23 uur
+    utc = lambda moment: moment.astimezone(timezone.utc).replace(tzinfo=None)
+    start, end = src.database.day_range(Day('2025-01-15').as_date())
+    assert (utc(start), utc(end)) == (datetime(2025, 1, 14, 23), datetime(2025, 1, 15, 23))
+    start, end = src.database.day_range(Day('2025-03-30').as_date())
+    assert (utc(start), utc(end)) == (datetime(2025, 3, 29, 23), datetime(2025, 3, 30, 22))
+    print('  PASS test_schema_indexes_serve_newsletter_day_range')
+
+
+def test_article_history_replaces_cache_lookups():
+    """Artikelen staan in de historie-tabel; dedupe-historie, links en onderwerpen komen uit de database."""
+    from sqlalchemy import MetaData
+    import src.database
+    from justdays import Day
+    from src.database import backfill_articles, get_last_newsletter_summaries, has_appeared, store_articles
+
+    with tempfile.TemporaryDirectory() as tmp:
+        url = f'sqlite:///{tmp}/history.db'
+        today = Day()
+        cache_dir = Path(tmp) / 'cache'
+        cache_dir.mkdir()
+        old = today - 3
+        (cache_dir / f'{old}_summary.jsonl').write_text(json.dumps(
+            {'title': 'Oud nieuws', 'summary': 'Iets over robots.', 'links': ['https://example.com/robots']}) + '\n')
+        (cache_dir / f'{old}_edited.jsonl').write_text(json.dumps(
+            {'title': 'Oud nieuws, geredigeerd', 'summary': 'Iets over robots.', 'links': ['https://example.com/robots']}) + '\n')
+
+        with patch.dict(os.environ, {'DATABASE_URL': url}), patch.object(src.database, '_engine', None), \
+                patch.object(src.database, '_metadata', MetaData()):
+            store_articles('daily', today - 1, [
+                {'title': 'Nieuw taalmodel', 'summary': 'Een lab brengt een taalmodel uit.',
+                 'links': ['https://News.example.com/model/?utm_source=x&id=7#top']},
+                {'title': 'Chips', 'summary': 'Tekort aan chips.', 'links': []}])
+            store_articles('daily', today, [{'title': 'Vandaag', 'summary': 'Huidige run.', 'links': []}])
+            store_articles('weekly', today - 1, [{'title': 'Weekoverzicht', 'summary': 'Week.', 'links': []}])
+            # Opnieuw opslaan vervangt het nummer
+            store_articles('daily', today - 1, [
+                {'title': 'Nieuw taalmodel', 'summary': 'Een lab brengt een taalmodel uit.',
+                 'links': ['https://news.example.com/model?id=7']},
+                {'title': 'Chips', 'summary': 'Tekort aan chips.', 'links': []}])
+
+            assert backfill_articles(cache_dir) == 1
+            assert backfill_articles(cache_dir) == 0
+
+            summaries = get_last_newsletter_summaries('daily', limit=5)
+            assert 'Vandaag' not in summaries and 'Weekoverzicht' not in summaries
+            assert summaries.index('Nieuw taalmodel') < summaries.index('Chips') < summaries.index('Oud nieuws, geredigeerd')
+            assert get_last_newsletter_summaries('daily', limit=1).count('Nieuwsbrief ') == 1
+
+            assert has_appeared(url='https://news.example.com/model/?id=7&utm_medium=mail')
+            assert has_appeared(url='https://example.com/robots')
+            assert not has_appeared(url='https://example.com/robots', days=2)
+            assert has_appeared(topic='taalmodel') and not has_appeared(topic='quantum')
+            src.database.get_engine().dispose()
+    print('  PASS test_article_history_replaces_cache_lookups')
+
+
+def test_mark_undeliverable_uses_constant_queries():
+    """Bounces worden met één statusquery en één update verwerkt, ongeacht het aantal adressen."""
+    from datetime import datetime
+    from sqlalchemy import MetaData, create_engine, event, text
+    import src.database
+    import src.undelivered
+    from src.undelivered import mark_undeliverable
+
+    with tempfile.TemporaryDirectory() as tmp:
+        url = f'sqlite:///{tmp}/subscribers.db'
+        emails = [f'lezer{i}@example.com' for i in range(20)]
+        with create_engine(url).begin() as conn:
+            conn.execute(text('CREATE TABLE nieuwsbrief_subscriber (email TEXT, status TEXT, updated_at TIMESTAMP)'))
+            for email in emails:
+                conn.execute(text("INSERT INTO nieuwsbrief_subscriber VALUES (:email, 'daily', :updated_at)"),
+                             {'email': email, 'updated_at': datetime(2020, 1, 1)})
+            # lezer0 re-subscribed after the last bounce
+            conn.execute(text("UPDATE nieuwsbrief_subscriber SET updated_at = :now WHERE email = 'lezer0@example.com'"),
+                         {'now': datetime.now()})
+        undelivered_file = Path(tmp) / 'undelivered.json'
+        undelivered_file.write_text(json.dumps({e: {'count': 2, 'permanent_count': 1, 'last_bounce': '2025-01-01'}
+                                                for e in emails}))
+
+        with patch.dict(os.environ, {'DATABASE_URL': url}), patch.object(src.database, '_engine', None), \
+                patch.object(src.database, '_metadata', MetaData()), \
+                patch.object(src.undelivered, 'undelivered_file', undelivered_file):
+            engine = src.database.get_engine()
+            src.database.get_table('nieuwsbrief_subscriber')
+            statements = []
+            listener = lambda *args: statements.append(args[2])
+            event.listen(engine, 'before_cursor_execute', listener)
+            mark_undeliverable(emails)
+            event.remove(engine, 'before_cursor_execute', listener)
+            with engine.connect() as conn:
+                rows = dict(conn.execute(text('SELECT email, status FROM nieuwsbrief_subscriber')).fetchall())
+            engine.dispose()
+        assert rows['lezer0@example.com'] == 'daily'
+        assert all(rows[e] == 'undeliverable' for e in emails[1:])
+        assert 'lezer0@example.com' not in json.loads(undelivered_file.read_text())
+        assert [st.split()[0] for st in statements] == ['SELECT', 'UPDATE']
+    print('  PASS test_mark_undeliverable_uses_constant_queries')
+
+
+def test_resubscribe_resets_bounces_only_of_updated_subscribers():
+    """Bij heraanmelding wordt alleen de bouncegeschiedenis gewist van adressen die echt zijn bijgewerkt."""
+    from sqlalchemy import MetaData, create_engine, text
+    import src.database
+    import src.undelivered
+    from src.subscribers import update_subscriptions
+
+    with tempfile.TemporaryDirectory() as tmp:
+        url = f'sqlite:///{tmp}/subscribers.db'
+        with create_engine(url).begin() as conn:
+            conn.execute(text('CREATE TABLE nieuwsbrief_subscriber (email TEXT, status TEXT, updated_at TIMESTAMP)'))
+            conn.execute(text("INSERT INTO nieuwsbrief_subscriber VALUES ('terug@example.com', 'undeliverable', NULL)"))
+        undelivered_file = Path(tmp) / 'undelivered.json'
+        bounce = {'count': 2, 'permanent_count': 1, 'last_bounce': '2025-01-01'}
+        undelivered_file.write_text(json.dumps({'terug@example.com': bounce, 'onbekend@example.com': bounce}))
+
+        with patch.dict(os.environ, {'DATABASE_URL': url}), patch.object(src.database, '_engine', None), \
+                patch.object(src.database, '_metadata', MetaData()), \
+                patch.object(src.undelivered, 'undelivered_file', undelivered_file):
+            assert update_subscriptions(['terug@example.com', 'onbekend@example.com'], 'daily') == 1
+            src.database.get_engine().dispose()
+        assert list(json.loads(undelivered_file.read_text())) == ['onbekend@example.com']
+    print('  PASS test_resubscribe_resets_bounces_only_of_updated_subscribers')
+
+
+def test_streamed_subscribers_are_sent_before_the_list_is_read():
+    """Met een stroom van chunks begint het verzenden al na de eerste chunk, en er wordt niet verder
+    vooruit gelezen (en geclaimd) dan FEED_LIMIT ontvangers."""
+    import threading
+    from justdays import Day
+    from sqlalchemy import MetaData, create_engine, text
+    import src.database
+    import src.metrics
+    import src.sender
+    from src.mailer import deliver, transport
+    from src.sender import SendStats
+    from src.sendqueue import SendQueue
+    from src.subscribers import iter_subscribers
+
+    with tempfile.TemporaryDirectory() as tmp:
+        url = f'sqlite:///{tmp}/subscribers.db'
+        with create_engine(url).begin() as conn:
+            conn.execute(text('CREATE TABLE nieuwsbrief_subscriber (email TEXT, status TEXT, updated_at TIMESTAMP)'))
+            for i in range(25):
+                conn.execute(text("INSERT INTO nieuwsbrief_subscriber VALUES (:email, :status, NULL)"),
+                             {'email': f'lezer{i}@example{i % 5}.com', 'status': 'daily' if i % 5 else 'weekly'})
+        with patch.dict(os.environ, {'DATABASE_URL': url}), patch.object(src.database, '_engine', None), \
+                patch.object(src.database, '_metadata', MetaData()):
+            chunks = list(iter_subscribers('daily', chunk_size=8))
+            src.database.get_engine().dispose()
+        assert [len(chunk) for chunk in chunks] == [8, 8, 4]
+
+        first_sent = threading.Event()
+        sent_before_second_chunk = []
+        ahead = []
+
+        def stream():
+            yield chunks[0]
+            sent_before_second_chunk.append(first_sent.wait(timeout=5))
+            for chunk in chunks[1:]:
+                ahead.append(stats.total - stats.sent - stats.failed)
+                yield chunk
+
+        stats = SendStats()
+        factory = transport(stats, f'maildir:{tmp}/maildir')
+
+        def session_factory():
+            session = factory()
+            send = session.send
+            session.send = lambda *args: (send(*args), first_sent.set())[0]
+            return session
+
+        queue = SendQueue(Path(tmp) / 'sendqueue.db', Path(tmp) / 'mailerlog.txt')
+        queue.enqueue('daily', Day(), ['oud-abonnee@example.com'])
+        with patch.object(src.sender, 'DOMAIN_RATE', 1000), patch.object(src.metrics, 'METRICS_DIR', Path(tmp)), \
+                patch.object(src.sender, 'FEED_LIMIT', 3):
+            stats, sent = deliver('daily', '<p>[EMAIL]</p>', 'Test', stream(), queue, session_factory, stats=stats,
+                                  connections=2)
+        assert sent_before_second_chunk == [True]
+        # Bij elke nieuwe chunk wachten er minder dan FEED_LIMIT, plus wat de workers onderhanden hebben
+        assert len(ahead) == 2 and max(ahead) < 3 + 2, ahead
+        assert stats.sent == stats.total == 20
+        assert queue.counts('daily', Day()) == {'sent': 20, 'failed': 1}
+        queue.close()
+    print('  PASS test_streamed_subscribers_are_sent_before_the_list_is_read')
+
+
 def main():
     os.environ.setdefault('DATABASE_URL', 'postgresql://test/test')
     tests = [
@@ -216,6 +1383,41 @@ def main():
         test_retry_prompt_exhausts_and_reraises_connection_error,
         test_retry_prompt_still_retries_ratelimit,
         test_retry_prompt_uses_exponential_backoff,
+        test_hedge_threshold_from_history,
+        test_hedged_call_takes_fastest_response,
+        test_circuit_opens_after_repeated_failures,
+        test_editor_falls_back_when_circuit_open,
+        test_fallback_counts_only_transient_errors_against_circuit,
+        test_scheduler_serves_critical_calls_first,
+        test_scheduled_model_pauses_provider_on_ratelimit,
+        test_optimize_image_creates_slot_sized_variants,
+        test_optimize_image_never_upscales,
+        test_upload_manager_skips_unchanged_content,
+        test_upload_manager_singleton_does_not_deadlock,
+        test_sized_checks_existence_without_listing,
+        test_stream_from_pil_image_pipes_encoder_output,
+        test_submit_hashed_uses_content_key_and_cache_headers,
+        test_compiled_template_matches_replace,
+        test_bulk_message_matches_create_message,
+        test_optimize_html_shrinks_and_keeps_content,
+        test_send_parallel_uses_own_session_per_worker,
+        test_send_parallel_returns_when_no_session_opens,
+        test_send_limiter_stops_at_daily_quota,
+        test_send_queue_resumes_interrupted_send,
+        test_deferred_recipient_stays_pending_without_using_attempts,
+        test_delete_emails_batches_imap_commands,
+        test_undelivered_fetches_only_delivery_status_parts,
+        test_smtp_login_always_uses_starttls_and_login,
+        test_smtp_session_reconnects_and_retries,
+        test_domain_scheduler_interleaves_and_requeues_deferrals,
+        test_deliver_through_fake_smtp_and_maildir,
+        test_send_ledger_shards_claim_each_recipient_once,
+        test_shared_engine_reflects_each_table_once,
+        test_schema_indexes_serve_newsletter_day_range,
+        test_article_history_replaces_cache_lookups,
+        test_mark_undeliverable_uses_constant_queries,
+        test_resubscribe_resets_bounces_only_of_updated_subscribers,
+        test_streamed_subscribers_are_sent_before_the_list_is_read,
     ]
     failed = 0
     for t in tests: